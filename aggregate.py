@@ -0,0 +1,69 @@
+# Server-side point aggregation for the scatter map
+#
+# At world zoom the full dataset is ~190k markers, which makes for a
+# multi-megabyte response the browser struggles to draw. Above a configurable
+# number of points, markers are bucketed into a lat/lon grid whose cell size
+# follows the map zoom, giving one marker per cell per attack type, placed at
+# the centroid of its points and carrying the attack count and total kills.
+# A marker's area grows with both: its attacks plus its kills, each kill
+# weighing GTD_MAP_KILL_WEIGHT attacks, so that a cell of few but deadly
+# attacks stands out next to one of many harmless ones.
+
+import os
+
+import numpy as np
+
+# Largest selection drawn point by point, bigger ones get aggregated
+MAX_RAW_POINTS = int(os.environ.get("GTD_MAP_MAX_POINTS", "5000"))
+
+# Grid cells across one map tile width, the finer the more markers
+CELLS_PER_TILE = 16
+
+# Attacks a kill counts for in the size of a marker, 0 to size by attacks alone
+KILL_WEIGHT = float(os.environ.get("GTD_MAP_KILL_WEIGHT", "1"))
+
+
+# Grid cell size in degrees at a mapbox zoom level (a tile spans 360 / 2**zoom degrees)
+def cell_size(zoom):
+    return 360.0 / (2 ** max(zoom, 0)) / CELLS_PER_TILE
+
+
+# Whether a selection of n points should be aggregated rather than drawn raw
+def should_aggregate(n, max_points=None):
+    return n > (MAX_RAW_POINTS if max_points is None else max_points)
+
+
+# Bucket the points of a filtered frame into grid cells per attack type
+#
+# Returns a frame with latitude, longitude, attacktype1_txt, attacks (points in
+# the bucket), nkill (their total kills) and size (the marker size of both),
+# one row per non-empty bucket.
+def aggregate_points(frame, zoom):
+    import pandas as pd
+
+    lat = frame["latitude"].to_numpy(dtype=np.float64)
+    lon = frame["longitude"].to_numpy(dtype=np.float64)
+    attack = frame["attacktype1_txt"]
+    codes = np.asarray(attack.cat.codes, dtype=np.int64)
+    nkill = np.nan_to_num(frame["nkill"].to_numpy(dtype=np.float64))
+
+    valid = np.isfinite(lat) & np.isfinite(lon) & (codes >= 0)
+    lat, lon, codes, nkill = lat[valid], lon[valid], codes[valid], nkill[valid]
+
+    size = cell_size(zoom)
+    columns = int(np.ceil(360.0 / size)) + 1
+    cell_y = np.floor((lat + 90.0) / size).astype(np.int64)
+    cell_x = np.floor((lon + 180.0) / size).astype(np.int64)
+    keys = (cell_y * columns + cell_x) * len(attack.cat.categories) + codes
+
+    buckets, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    kills = np.bincount(inverse, nkill)
+    return pd.DataFrame({
+        "latitude": np.bincount(inverse, lat) / counts,
+        "longitude": np.bincount(inverse, lon) / counts,
+        "attacktype1_txt": pd.Categorical.from_codes(buckets % len(attack.cat.categories), attack.cat.categories),
+        "attacks": counts,
+        "nkill": kills,
+        "size": counts + KILL_WEIGHT * kills,
+    })
@@ -1,43 +1,87 @@
 
-import pandas as pd
+import logging
+import threading
+
 import dash
 from dash import dcc, html, Input, Output
-import plotly.express as px
 
-# Load local dataset (Render will use this path)
-df = pd.read_csv("global_terror.csv")
-# Dropdown options
-countries = [{'label': c, 'value': c} for c in sorted(df['country_txt'].dropna().unique())]
-years = sorted(df['iyear'].dropna().unique())
+import datastore
+import figures
+from figure_cache import FigureCache, cache_key
+import coalesce
+from partitions import CountryPartitions
+import instrumentation
+from reloader import Reloader, LAZY_STARTUP
+
+# Dropdown options, from the vocabularies stored in the cache: enough to serve the page before the data has loaded
+class DatasetOptions:
+    def __init__(self, cache):
+        self.version = cache.version
+        self.countries = [{'label': c, 'value': c} for c in cache.categories()['country_txt']]
+        self.years = cache.meta['years']
+
+# Everything the dashboard uses from one version of the dataset, swapped in as a whole when it changes
+class DataSnapshot(DatasetOptions):
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.cache = cache  # Keeps this version of the cache from being removed while in use
+        # Served from the typed column cache, as the rows of every country
+        # with its attacks per year for the trend chart
+        self.partitions = CountryPartitions(cache)
 
 # Initialize app
 app = dash.Dash(__name__)
 server = app.server  # Needed for deployment on Render
 
-# Layout
-app.layout = html.Div([
-    html.H1("🌍 Global Terrorism Dashboard", style={'textAlign': 'center'}),
-
-    html.Div([
-        html.Label("Select Country:"),
-        dcc.Dropdown(id='country-dropdown', options=countries, value='India'),
-    ], style={'width': '48%', 'display': 'inline-block'}),
-
-    html.Div([
-        html.Label("Select Year:"),
-        dcc.Slider(
-            id='year-slider',
-            min=min(years),
-            max=max(years),
-            value=2015,
-            marks={str(year): str(year) for year in years[::5]},
-            step=1
-        )
-    ], style={'width': '48%', 'display': 'inline-block', 'padding': '0px 20px 20px 20px'}),
+# Cache of figures for repeated selections, emptied when the dataset changes
+figure_cache = FigureCache()
+
+# Figure builds shared by identical requests arriving together, in this worker or another
+coalescer = coalesce.Coalescer()
+
+# Drop the figures of the previous data, and build those of the default view in the background (GTD_PREWARM)
+def swap_data(data):
+    figure_cache.set_version(data.version)
+    if coalesce.PREWARM:
+        threading.Thread(target=prewarm, args=(data,), name="gtd-prewarm", daemon=True).start()
+
+# Load local dataset (Render will use this path), reloaded when it changes if GTD_RELOAD_SECONDS is set.
+# It loads in the background unless GTD_LAZY_STARTUP=0, the callbacks waiting for it.
+reloader = Reloader("global_terror.csv", DataSnapshot, on_swap=swap_data)
+if LAZY_STARTUP:
+    reloader.start()
+else:
+    reloader.load()
+
+# Layout, built on every page load so that the options follow the current data
+def serve_layout():
+    data = reloader.current() or DatasetOptions(datastore.open_cache("global_terror.csv"))
+    countries, years = data.countries, data.years
+    return html.Div([
+        html.H1("🌍 Global Terrorism Dashboard", style={'textAlign': 'center'}),
+
+        html.Div([
+            html.Label("Select Country:"),
+            dcc.Dropdown(id='country-dropdown', options=countries, value='India'),
+        ], style={'width': '48%', 'display': 'inline-block'}),
+
+        html.Div([
+            html.Label("Select Year:"),
+            dcc.Slider(
+                id='year-slider',
+                min=min(years),
+                max=max(years),
+                value=2015,
+                marks={str(year): str(year) for year in years[::5]},
+                step=1
+            )
+        ], style={'width': '48%', 'display': 'inline-block', 'padding': '0px 20px 20px 20px'}),
+
+        dcc.Graph(id='attack-map'),
+        dcc.Graph(id='attack-trend')
+    ])
 
-    dcc.Graph(id='attack-map'),
-    dcc.Graph(id='attack-trend')
-])
+app.layout = serve_layout
 
 # Callback
 @app.callback(
@@ -47,25 +91,77 @@ app.layout = html.Div([
      Input('year-slider', 'value')]
 )
 def update_graph(selected_country, selected_year):
-    filtered_df = df[(df['country_txt'] == selected_country) & (df['iyear'] == selected_year)]
-
-    map_fig = px.scatter_mapbox(
-        filtered_df,
-        lat="latitude",
-        lon="longitude",
-        hover_name="city",
-        hover_data=["attacktype1_txt", "nkill", "nwound"],
-        color="attacktype1_txt",
-        zoom=3,
-        height=500
-    )
-    map_fig.update_layout(mapbox_style="carto-positron", margin={"r":0,"t":0,"l":0,"b":0})
-
-    trend_df = df[df['country_txt'] == selected_country].groupby('iyear').size().reset_index(name='attacks')
-    trend_fig = px.line(trend_df, x='iyear', y='attacks', title=f'Attacks Over Time in {selected_country}')
-    #trend_fig = px.line(trend_df, x='iyear', y='attacks')
+    return graph_figures(reloader.snapshot(), selected_country, selected_year)
 
+# Map and trend figures, from the figure cache or built once for identical requests arriving together
+@instrumentation.traced('graph')
+def graph_figures(data, selected_country, selected_year):
+    key = cache_key('graph', version=data.version, country=selected_country, year=selected_year)
+    with instrumentation.span('cache'):
+        cached = figure_cache.get(key)
+        if cached is not None:
+            return figures.loads(cached[0]), figures.loads(cached[1])
+
+    built = []
+    def serialized():
+        built.extend(build_graph_figures(data, selected_country, selected_year))
+        with instrumentation.span('serialize'):
+            payload = (figures.dumps(built[0]), figures.dumps(built[1]))
+        instrumentation.record('bytes', len(payload[0]) + len(payload[1]))
+        return payload
+
+    payload = coalescer.run(key, serialized)
+    figure_cache.put(key, payload)
+    if built:
+        return built[0], built[1]
+    return figures.loads(payload[0]), figures.loads(payload[1])
+
+def build_graph_figures(data, selected_country, selected_year):
+    partition = data.partitions.get(selected_country)
+    with instrumentation.span('filter'):
+        filtered_df = partition.rows(selected_year)
+    instrumentation.record('rows', filtered_df.shape[0])
+
+    with instrumentation.span('figure'):
+        attack = filtered_df['attacktype1_txt']
+        map_fig = figures.scatter_mapbox(
+            filtered_df['latitude'].to_numpy(),
+            filtered_df['longitude'].to_numpy(),
+            attack.cat.codes.to_numpy(),
+            list(attack.cat.categories),
+            'attacktype1_txt',
+            hover=[('nkill', filtered_df['nkill'].to_numpy()),
+                   ('nwound', filtered_df['nwound'].to_numpy())],
+            hover_name=figures.category_labels(filtered_df['city']),
+            zoom=3,
+            height=500,
+            style="carto-positron",
+            margin={"r":0,"t":0,"l":0,"b":0}
+        )
+
+        trend_df = partition.year_totals()
+        trend_fig = figures.line(trend_df['iyear'], trend_df['attacks'], 'iyear', 'attacks',
+                                 title=f'Attacks Over Time in {selected_country}')
+        #trend_fig = px.line(trend_df, x='iyear', y='attacks')
     return map_fig, trend_fig
 
+# The view the page opens with
+def prewarm(data):
+    try:
+        graph_figures(data, 'India', 2015)
+    except Exception:
+        logging.getLogger('gtd.prewarm').exception('prewarming the figures of version %s failed', data.version)
+
+# Figure cache hit/miss/eviction counters, and the builds shared by identical requests
+@server.route('/cache-stats')
+def cache_stats():
+    return dict(figure_cache.stats(), coalesced=coalescer.stats())
+
+# Callback timings and figure cache counters for Prometheus
+instrumentation.install(server, [instrumentation.figure_cache_collector(figure_cache)])
+
+# Liveness at /health, and /ready once the data has loaded
+reloader.install(server)
+
 if __name__ == '__main__':
     app.run_server()
@@ -1,5 +1,7 @@
-# Import pandas for data manipulation
-import pandas as pd
+import calendar  # Days in each month for the day dropdown
+import logging
+import threading  # Builds the figures of the default views in the background
+import numpy as np  # Arrays of the map points sent to the browser
 
 # Import Dash and its components for web app creation
 import dash
@@ -7,27 +9,124 @@ import dash_html_components as html  # HTML components for Dash (deprecated in n
 import webbrowser  # To open the app in a web browser
 import dash_core_components as dcc  # Core components for Dash (deprecated in newer Dash)
 
-from dash.dependencies import Input, Output  # For callbacks (interactivity)
+from dash.dependencies import Input, Output, State  # For callbacks (interactivity)
+from dash import Patch  # Partial updates of a component property
 
 # Import plotting libraries
 import plotly.graph_objects as go
-import plotly.express as px
 
 from dash.exceptions import PreventUpdate  # For preventing unnecessary updates in callbacks
 
+import datastore  # Typed column cache of the dataset
+from filter_index import FilterIndex, date_intervals, map_dates, map_filters  # Row index for the Map tool filters
+from figure_cache import FigureCache, cache_key  # LRU cache of serialized figures
+import coalesce  # Identical requests in flight at once share one figure build
+import export  # Streams the rows of a Map tool selection as csv or Parquet
+import aggregate  # Grid aggregation of map points
+import figures  # Builds figure dicts straight from NumPy arrays
+from spatial_index import TileIndex, uncovered_tiles, view_tiles, viewport  # Map tiles of the points in view
+from cube import YearCube  # Per year counts for the Chart tool
+from search_index import build_search_indexes  # Substring search over the Chart tool options
+from debounce import Debouncer  # Drops search keystrokes superseded by newer ones
+import instrumentation  # Per callback timings, logged and served at /metrics
+import jobs  # Background execution of the figure callbacks
+from reloader import Reloader, LAZY_STARTUP  # Swaps in a new snapshot of the data when the dataset changes
+
+# Zoom level the map figures open at
+MAP_ZOOM = 1
+
+# Most points and tiles a single point map collects while panning before it is redrawn for just the view
+MAP_MAX_LOADED_POINTS = 4 * aggregate.MAX_RAW_POINTS
+MAP_MAX_LOADED_TILES = 256
+
+# Runs the figure callbacks in the background when GTD_BACKGROUND_CALLBACKS is set
+background_manager = jobs.JobManager() if jobs.ENABLED else None
+
 # Initialize the Dash app
-app = dash.Dash()
+app = dash.Dash(background_callback_manager=background_manager)
+
+# Cache of figures for repeated selections, emptied when the dataset changes
+figure_cache = FigureCache()
+
+# Figure builds shared by identical requests arriving together, in this worker or another
+coalescer = coalesce.Coalescer()
+
+# Drops Chart tool searches a newer keystroke has superseded
+search_debouncer = Debouncer()
 
 # Set up global color scheme for the app
 global colors
 colors = {'background': '#D3D3D3', 'text': '#111111'}
 
-# Function to load data and initialize global variables
-def load_data():
-    dataset_name = "global_terror.csv.gz"  # Name of the CSV file containing data
-    
-    global df
-    df = pd.read_csv(dataset_name)  # Read CSV data into DataFrame
+# Dropdown options and year marks of one version of the dataset, read from
+# the cache metadata alone: the page can be served with them while the data
+# itself is still loading
+class DatasetOptions:
+    def __init__(self, cache):
+        self.version = cache.version
+
+        # Region -> country -> state -> city tree for the cascading dropdowns, resolved in the browser
+        self.hierarchy_tree = cache.hierarchy()  # Collected while the cache was built
+
+        # Vocabularies of the dropdowns, also stored in the cache
+        categories = cache.categories()
+
+        # Create region list for dropdown options
+        self.region_list = [{"label": i, "value": i} for i in categories["region_txt"]]
+
+        # Create attack type list for dropdown
+        self.attack_type_list = [{"label": i, "value": i} for i in categories["attacktype1_txt"]]
+
+        # List of years available in the dataset
+        self.year_list = cache.meta["years"]
+
+        # Dictionary for year slider marks
+        self.year_dict = {str(year): str(year) for year in self.year_list}
+
+# Everything the callbacks use from one version of the dataset. The reloader
+# builds a new one when the dataset changes and swaps it in as a whole, so a
+# callback takes the current snapshot once and uses only that.
+class DataSnapshot(DatasetOptions):
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.cache = cache  # Keeps this version of the cache from being removed while in use
+        self.df = cache.frame()  # Read the typed column cache (built from the CSV on first use)
+
+        # Posting lists for the Map tool filters, stored in the cache
+        self.filter_index = FilterIndex(self.df, cache=cache)
+
+        # Map tiles of every point, so that the Map tool can query just the visible part of the map
+        self.tile_index = TileIndex(self.df, cache=cache)
+        self.filter_index.add("tile", self.tile_index)
+
+        # Per year counts of every Chart tool option, for the world and for India only
+        self.chart_cube = YearCube(self.df)
+        self.india_cube = YearCube(self.df, rows=self.filter_index.query(
+            date_intervals([self.df["iyear"].min(), self.df["iyear"].max()]),
+            {"region_txt": ["South Asia"], "country_txt": ["India"]}))
+
+        # Search index over the options of every Chart tool dimension
+        self.search_indexes = build_search_indexes(self.chart_cube)
+
+# When a new snapshot is swapped in the figures cached from the previous data
+# are dropped, and those of the views every page opens with get built in the
+# background (GTD_PREWARM)
+def swap_data(data):
+    figure_cache.set_version(data.version)
+    if coalesce.PREWARM:
+        threading.Thread(target=prewarm, args=(data,), name="gtd-prewarm", daemon=True).start()
+
+# Current snapshot of the data, reloaded when the CSV or its delta files change (GTD_RELOAD_SECONDS).
+dataset_name = "global_terror.csv.gz"  # Name of the CSV file containing data
+reloader = Reloader(dataset_name, DataSnapshot, on_swap=swap_data)
+
+# Function to load data and initialize global variables. In the background the
+# server can start at once, the callbacks waiting for the data until it is in.
+def load_data(background=False):
+    if background:
+        reloader.start()
+    else:
+        reloader.load()
     
     # Month mapping for dropdowns
     month = {
@@ -40,34 +139,6 @@ def load_data():
     global date_list
     date_list = [x for x in range(1, 32)]  # List of dates for date dropdown
 
-    # Create mapping of region to countries for filtering
-    global country_list
-    country_list = df.groupby("region_txt")["country_txt"].unique().apply(list).to_dict()
-
-    # Create mapping of country to states for filtering
-    global state_list
-    state_list = df.groupby("country_txt")["provstate"].unique().apply(list).to_dict()
-
-    # Create mapping of state to cities for filtering
-    global city_list
-    city_list = df.groupby("provstate")["city"].unique().apply(list).to_dict()
-
-    # Create region list for dropdown options
-    global region_list
-    region_list = [{"label": str(i), "value": str(i)} for i in sorted(df["region_txt"].unique().tolist())]
-
-    # Create attack type list for dropdown
-    global attack_type_list
-    attack_type_list = [{"label": str(i), "value": str(i)} for i in df["attacktype1_txt"].unique().tolist()]
-
-    # List of years available in the dataset
-    global year_list
-    year_list = sorted(df['iyear'].unique().tolist())
-
-    # Dictionary for year slider marks
-    global year_dict
-    year_dict = {str(year): str(year) for year in year_list}
-
     # Dropdown options for chart filters
     global chart_dropdown_values
     chart_dropdown_values = {
@@ -81,8 +152,10 @@ def load_data():
     }
     chart_dropdown_values = [{'label': key, 'value': value} for key, value in chart_dropdown_values.items()]
 
-# Function to create the UI layout for the app
+# Function to create the UI layout for the app, with the options of the current
+# data snapshot, or of the cache metadata while the first one is loading
 def create_app_ui():
+    data = reloader.current() or DatasetOptions(datastore.open_cache(dataset_name))
     main_layout = html.Div(
         style={'backgroundColor': colors['background']},
         children=[
@@ -113,7 +186,7 @@ def create_app_ui():
                             # Dropdowns for all filter options
                             dcc.Dropdown(
                                 id='region-dropdown',
-                                options=region_list,
+                                options=data.region_list,
                                 placeholder="Select Region",
                                 style={'textAlign': 'center'},
                                 multi=True
@@ -141,11 +214,20 @@ def create_app_ui():
                             ),
                             dcc.Dropdown(
                                 id="attacktype-dropdown",
-                                options=attack_type_list,
+                                options=data.attack_type_list,
                                 placeholder='Select Attack Type',
                                 style={'textAlign': 'center'},
                                 multi=True
                             ),
+                            # Dates picked as months and days of the selected years, or as a range of dates
+                            dcc.RadioItems(
+                                id='date-mode',
+                                options=[{'label': 'Months and days', 'value': 'days'},
+                                         {'label': 'Date range', 'value': 'range'}],
+                                value='days',
+                                inline=True,
+                                style={'textAlign': 'center', 'color': '#FF0000'}
+                            ),
                             dcc.Dropdown(
                                 id='month',
                                 options=month_list,
@@ -159,18 +241,38 @@ def create_app_ui():
                                 style={'textAlign': 'center'},
                                 multi=True
                             ),
+                            html.Div(
+                                id='date-range-container',
+                                children=dcc.DatePickerRange(
+                                    id='date-range',
+                                    min_date_allowed=f"{min(data.year_list)}-01-01",
+                                    max_date_allowed=f"{max(data.year_list)}-12-31",
+                                    initial_visible_month=f"{max(data.year_list)}-01-01",
+                                    clearable=True
+                                ),
+                                style={'textAlign': 'center', 'display': 'none'}
+                            ),
                             html.H5(
                                 'Select the Year', id='year_title',
                                 style={'textAlign': 'center', 'color': '#FF0000'}
                             ),
                             dcc.RangeSlider(
                                 id='year-slider',
-                                min=min(year_list),
-                                max=max(year_list),
-                                value=[min(year_list), max(year_list)],
-                                marks=year_dict,
+                                min=min(data.year_list),
+                                max=max(data.year_list),
+                                value=[min(data.year_list), max(data.year_list)],
+                                marks=data.year_dict,
                                 step=None
                             ),
+                            html.Div(
+                                [
+                                    'Download the selected attacks: ',
+                                    html.A('CSV', id='export-csv', download='gtd-export.csv'),
+                                    ' | ',
+                                    html.A('Parquet', id='export-parquet', download='gtd-export.parquet')
+                                ],
+                                style={'textAlign': 'center'}
+                            ),
                             html.Br()
                         ]
                     ),
@@ -199,15 +301,15 @@ def create_app_ui():
                             html.Br(),
                             html.Br(),
                             html.Hr(),
-                            dcc.Input(id="search", placeholder="Search Filter"),
+                            dcc.Input(id="search", placeholder="Search Filter", debounce=0.3),
                             html.Hr(),
                             html.Br(),
                             dcc.RangeSlider(
                                 id='cyear_slider',
-                                min=min(year_list),
-                                max=max(year_list),
-                                value=[min(year_list), max(year_list)],
-                                marks=year_dict,
+                                min=min(data.year_list),
+                                max=max(data.year_list),
+                                value=[min(data.year_list), max(data.year_list)],
+                                marks=data.year_dict,
                                 step=None
                             ),
                             html.Br()
@@ -215,153 +317,436 @@ def create_app_ui():
                     ),
                 ]
             ),
-            # Div to display graphs
+            # Div to display graphs, the graph stays in place and only its figure gets updated
             html.Div(
                 id="graph-object",
-                children=":::::Graph will be shown here:::::",
+                children=dcc.Graph(id="graph"),
                 style={'textAlign': 'center', 'color': '#FF0000'}
-            )
+            ),
+            # Random id of this browser tab, used to debounce its search requests
+            dcc.Store(id="session-id"),
+            # Number of the latest value sent by the search box, counted in the browser
+            dcc.Store(id="search-seq", data=0),
+            # Location hierarchy, sent once with the page for the clientside dropdown callbacks
+            dcc.Store(id="hierarchy", data=data.hierarchy_tree),
+            # Selections, viewport and loaded tiles of the map the browser shows
+            dcc.Store(id="map-view")
         ]
     )
     return main_layout
 
-# Callback to update the graph based on user selections
+# Give every browser tab a random session id when the page loads
+app.clientside_callback(
+    "function(id) { return Math.random().toString(36).slice(2) + Date.now().toString(36); }",
+    Output("session-id", "data"),
+    [Input("session-id", "id")]
+)
+
+# Number every value of the search box, so the server can drop the ones a newer one has superseded
+app.clientside_callback(
+    "function(search, seq) { return (seq || 0) + 1; }",
+    Output("search-seq", "data"),
+    [Input("search", "value")],
+    [State("search-seq", "data")],
+    prevent_initial_call=True
+)
+
+# Figure for a cache key and its cached value (the serialized figure followed
+# by the flags build returned with it). Repeated selections are served from
+# the figure cache; otherwise build() returns (figure, flags), and identical
+# requests in flight at the same time wait for a single build.
+def shared_figure(key, build):
+    with instrumentation.span("cache"):
+        cached = figure_cache.get(key)
+        if cached is not None:
+            return figures.loads(cached[0]), cached
+
+    built = []
+    def serialized():
+        figure, flags = build()
+        built.append(figure)
+        with instrumentation.span("serialize"):
+            payload = figures.dumps(figure)
+        instrumentation.record("bytes", len(payload))
+        return (payload,) + flags
+
+    cached = coalescer.run(key, serialized)
+    figure_cache.put(key, cached)
+    return (built[0] if built else figures.loads(cached[0])), cached
+
+# Build the figures of the views every page opens with, the Map and Chart
+# tools for the world and for India over all the years
+def prewarm(data):
+    years = [min(data.year_list), max(data.year_list)]
+    try:
+        for region, country in [(None, None), (["South Asia"], ["India"])]:
+            map_figure(data, *map_selections(None, None, region, country, None, None, None, years, "days", None,
+                                             None))
+        for subtab in ["WorldChart", "IndiaChart"]:
+            chart_figure(data, years, "region_txt", None, subtab)
+    except Exception:
+        logging.getLogger("gtd.prewarm").exception("prewarming the figures of version %s failed", data.version)
+
+# Partial update sending only the given figure paths (e.g. the traces), so the
+# rest of the layout and the user's pan and zoom stay as they are
+def patch_figure(figure, paths):
+    patch = Patch()
+    for path in paths:
+        value, target = figure, patch
+        for part in path[:-1]:
+            value, target = value[part], target[part]
+        target[path[-1]] = value[path[-1]]
+    return patch
+
+# Map figure of single points, one trace per attack type so that the points of
+# newly exposed tiles can be appended to their trace
+def raw_map_figure(new_df, zoom):
+    attack = new_df["attacktype1_txt"]
+    return figures.scatter_mapbox(
+        new_df["latitude"].to_numpy(),
+        new_df["longitude"].to_numpy(),
+        attack.cat.codes.to_numpy(),
+        list(attack.cat.categories),
+        "attacktype1_txt",
+        hover=[(col, figures.category_labels(new_df[col]))
+               for col in ["region_txt", "country_txt", "provstate", "city"]] +
+              [("nkill", new_df["nkill"].to_numpy()), ("iyear", new_df["iyear"].to_numpy())],
+        hover_name=figures.category_labels(new_df["city"]),
+        zoom=zoom,
+        style="carto-darkmatter",
+        margin=dict(l=0, r=0, t=25, b=20),
+        all_codes=True
+    )
+
+# Build the Map tool figure for the user selections, limited to the tiles of
+# the visible map when a viewport is given. Returns the figure and whether it
+# shows single points (rather than aggregated grid cells).
+@instrumentation.traced("map")
+def map_figure(data, month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+               year_value, date_range=None, view=None):
+    filters = map_filters(region_value, country_value, state_value, city_value, attack_value)
+    zoom = MAP_ZOOM
+    if view is not None:
+        filters["tile"] = view_tiles(view)
+        zoom = int(view["zoom"])
+
+    key = cache_key("Map", version=data.version, year=year_value, months=month_value, days=date_value,
+                    date_range=date_range, filters=filters, zoom=zoom)
+    figure, cached = shared_figure(key, lambda: build_map_figure(data, year_value, month_value, date_value,
+                                                                 date_range, filters, zoom))
+    return figure, bool(cached[1])
+
+# Map figure of the rows matching the selections and whether it shows single points
+def build_map_figure(data, year_value, month_value, date_value, date_range, filters, zoom):
+    # Look up the rows matching the user selections in the filter index,
+    # only the final rows get copied out of the main DataFrame
+    with instrumentation.span("filter"):
+        dates = map_dates(year_value, month_value, date_value, date_range)
+        new_df = data.filter_index.take(data.df, data.filter_index.query(dates, filters))
+    instrumentation.record("rows", new_df.shape[0])
+    jobs.checkpoint()
+
+    # Create the map figure straight from the column arrays, one trace per attack type
+    raw = not aggregate.should_aggregate(new_df.shape[0])
+    if not raw:
+        # Too many points to draw one by one, show one marker per grid cell and attack type instead
+        with instrumentation.span("aggregate"):
+            points_df = aggregate.aggregate_points(new_df, zoom)
+        with instrumentation.span("figure"):
+            mapFigure = figures.scatter_mapbox(
+                points_df["latitude"].to_numpy(),
+                points_df["longitude"].to_numpy(),
+                points_df["attacktype1_txt"].cat.codes.to_numpy(),
+                list(points_df["attacktype1_txt"].cat.categories),
+                "attacktype1_txt",
+                hover=[("attacks", points_df["attacks"].to_numpy()), ("nkill", points_df["nkill"].to_numpy())],
+                size=points_df["size"].to_numpy(),
+                zoom=zoom,
+                style="carto-darkmatter",
+                margin=dict(l=0, r=0, t=25, b=20),
+                all_codes=True
+            )
+    else:
+        with instrumentation.span("figure"):
+            mapFigure = raw_map_figure(new_df, zoom)
+    mapFigure["layout"]["autosize"] = True
+    return mapFigure, ("1" if raw else "",)
+
+# Points of the visible tiles that the browser does not have yet, as a Patch
+# appending them to the traces of the current single point map. Returns None
+# when the view needs a new figure instead: too many points in view to draw
+# them one by one, or too much loaded already.
+@instrumentation.traced("map_tiles")
+def map_tiles_patch(data, month_value, date_value, region_value, country_value, state_value, city_value,
+                    attack_value, year_value, date_range, view, loaded_tiles, loaded_points):
+    filters = map_filters(region_value, country_value, state_value, city_value, attack_value)
+    tiles = view_tiles(view)
+    filters["tile"] = tiles
+    with instrumentation.span("filter"):
+        rows = data.filter_index.query(map_dates(year_value, month_value, date_value, date_range), filters)
+        if aggregate.should_aggregate(len(rows)):
+            return None
+        loaded_ranges = data.tile_index.lookup_codes(loaded_tiles)
+        rows = rows[~data.tile_index.mask_for(loaded_ranges, rows)]
+    instrumentation.record("rows", len(rows))
+    jobs.checkpoint()
+
+    new_tiles = uncovered_tiles(tiles, loaded_ranges)
+    if loaded_points + len(rows) > MAP_MAX_LOADED_POINTS or len(loaded_tiles) + len(new_tiles) > MAP_MAX_LOADED_TILES:
+        return None
+
+    with instrumentation.span("figure"):
+        extension = raw_map_figure(data.filter_index.take(data.df, rows), int(view["zoom"]))
+        patch = Patch()
+        for i, trace in enumerate(extension["data"]):
+            if not trace["showlegend"]:
+                continue
+            patch["data"][i]["showlegend"] = True
+            for field in ("lat", "lon", "customdata", "hovertext"):
+                patch["data"][i][field].extend(np.asarray(trace[field]).tolist())
+    return patch, loaded_tiles + new_tiles, loaded_points + len(rows)
+
+# Build the Chart tool figure for the user selections
+@instrumentation.traced("chart")
+def chart_figure(data, chart_year_selector, chart_dp_value, search, subtabs2):
+    key = cache_key("chart", version=data.version, year=chart_year_selector, column=chart_dp_value, search=search,
+                    subtab=subtabs2)
+    return shared_figure(key, lambda: build_chart_figure(data, chart_year_selector, chart_dp_value, search,
+                                                         subtabs2))[0]
+
+def build_chart_figure(data, chart_year_selector, chart_dp_value, search, subtabs2):
+    years, codes, counts = [], [], []
+
+    # Use the India only counts for the India chart if selected
+    cube = data.india_cube if subtabs2 == "IndiaChart" else data.chart_cube
+
+    # Slice the per year counts of the selected option out of the precomputed cube,
+    # searching only over the option names (the search text is taken literally)
+    if chart_dp_value is not None:
+        with instrumentation.span("filter"):
+            search_codes = None
+            if search:
+                search_codes = data.search_indexes[chart_dp_value].matching_codes(search)
+        with instrumentation.span("aggregate"):
+            years, codes, counts = cube.year_count_arrays(chart_dp_value, chart_year_selector, search_codes)
+        names = cube.values[chart_dp_value]
+    instrumentation.record("rows", len(years))
+    jobs.checkpoint()
+
+    # If no data for chart, create placeholder row
+    if not len(years):
+        years, codes, counts, names = [0], [0], [0], ["No data"]
+
+    # Create the area chart straight from the count arrays
+    with instrumentation.span("figure"):
+        fig = figures.area(years, counts, codes, names, "iyear", "count", chart_dp_value)
+    return fig, ()
+
+# Callback to draw the selected tool's figure when switching tabs. Only the tab
+# switch triggers it, the inputs of both tools are read as State.
 @app.callback(
-    dash.dependencies.Output('graph-object', 'children'),
+    [Output('graph', 'figure', allow_duplicate=True),
+     Output('map-view', 'data', allow_duplicate=True)],
+    [Input('Tabs', 'value')],
     [
-        dash.dependencies.Input('Tabs', 'value'),
-        dash.dependencies.Input('month', 'value'),
-        dash.dependencies.Input('date', 'value'),
-        dash.dependencies.Input('region-dropdown', 'value'),
-        dash.dependencies.Input('country-dropdown', 'value'),
-        dash.dependencies.Input('state-dropdown', 'value'),
-        dash.dependencies.Input('city-dropdown', 'value'),
-        dash.dependencies.Input('attacktype-dropdown', 'value'),
-        dash.dependencies.Input('year-slider', 'value'),
-        dash.dependencies.Input('cyear_slider', 'value'),
-        dash.dependencies.Input('Chart_Dropdown', 'value'),
-        dash.dependencies.Input('search', 'value'),
-        dash.dependencies.Input('subtabs2', 'value')
-    ]
+        State('month', 'value'),
+        State('date', 'value'),
+        State('region-dropdown', 'value'),
+        State('country-dropdown', 'value'),
+        State('state-dropdown', 'value'),
+        State('city-dropdown', 'value'),
+        State('attacktype-dropdown', 'value'),
+        State('year-slider', 'value'),
+        State('date-mode', 'value'),
+        State('date-range', 'start_date'),
+        State('date-range', 'end_date'),
+        State('cyear_slider', 'value'),
+        State('Chart_Dropdown', 'value'),
+        State('search', 'value'),
+        State('subtabs2', 'value'),
+        State('session-id', 'data')
+    ],
+    prevent_initial_call='initial_duplicate',
+    background=jobs.ENABLED,
+    interval=jobs.POLL_INTERVAL
 )
-def update_app_ui(Tabs, month_value, date_value, region_value, country_value, state_value, city_value,
-                  attack_value, year_value, chart_year_selector, chart_dp_value, search, subtabs2):
-    fig = None  # Initialize figure variable
-    
-    # If Map tab is selected
+def update_tab(Tabs, month_value, date_value, region_value, country_value, state_value, city_value,
+               attack_value, year_value, date_mode, start_date, end_date, chart_year_selector, chart_dp_value,
+               search, subtabs2, session_id=None):
+    data = reloader.snapshot()
     if Tabs == "Map":
-        # Print statements for debugging (can be removed)
-        print("Data Type of month value = ", str(type(month_value)))
-        print("Data of month value = ", month_value)
-        print("Data Type of Day value = ", str(type(date_value)))
-        print("Data of Day value = ", date_value)
-        print("Data Type of region value = ", str(type(region_value)))
-        print("Data of region value = ", region_value)
-        print("Data Type of country value = ", str(type(country_value)))
-        print("Data of country value = ", country_value)
-        print("Data Type of state value = ", str(type(state_value)))
-        print("Data of state value = ", state_value)
-        print("Data Type of city value = ", str(type(city_value)))
-        print("Data of city value = ", city_value)
-        print("Data Type of Attack value = ", str(type(attack_value)))
-        print("Data of Attack value = ", attack_value)
-        print("Data Type of year value = ", str(type(year_value)))
-        print("Data of year value = ", year_value)
-
-        # Filter the main DataFrame according to user selections
-        year_range = range(year_value[0], year_value[1] + 1)
-        new_df = df[df["iyear"].isin(year_range)]
-
-        # Filter by month and date if selected
-        if month_value == [] or month_value is None:
-            pass
-        else:
-            if date_value == [] or date_value is None:
-                new_df = new_df[new_df["imonth"].isin(month_value)]
-            else:
-                new_df = new_df[(new_df["imonth"].isin(month_value)) & (new_df["iday"].isin(date_value))]
-        
-        # Filter by region, country, state, city if selected
-        if region_value == [] or region_value is None:
-            pass
-        else:
-            if country_value == [] or country_value is None:
-                new_df = new_df[(new_df["region_txt"].isin(region_value))]
-            else:
-                if state_value == [] or state_value is None:
-                    new_df = new_df[(new_df["region_txt"].isin(region_value)) &
-                                    (new_df["country_txt"].isin(country_value))]
-                else:
-                    if city_value == [] or city_value is None:
-                        new_df = new_df[(new_df["region_txt"].isin(region_value)) &
-                                        (new_df["country_txt"].isin(country_value)) &
-                                        (new_df["provstate"].isin(state_value))]
-                    else:
-                        new_df = new_df[(new_df["region_txt"].isin(region_value)) &
-                                        (new_df["country_txt"].isin(country_value)) &
-                                        (new_df["provstate"].isin(state_value)) &
-                                        (new_df["city"].isin(city_value))]
-        
-        # Filter by attack type if selected
-        if attack_value == [] or attack_value is None:
-            pass
-        else:
-            new_df = new_df[new_df["attacktype1_txt"].isin(attack_value)]
-
-        # If no data after filtering, create an empty DataFrame with required columns
-        if not new_df.shape[0]:
-            new_df = pd.DataFrame(
-                columns=['iyear', 'imonth', 'iday', 'country_txt', 'region_txt', 'provstate',
-                         'city', 'latitude', 'longitude', 'attacktype1_txt', 'nkill'])
-            new_df.loc[0] = [0, 0, 0, None, None, None, None, None, None, None, None]
-        
-        # Create the map figure using Plotly
-        mapFigure = px.scatter_mapbox(
-            new_df,
-            lat="latitude",
-            lon="longitude",
-            color="attacktype1_txt",
-            hover_name="city",
-            hover_data=["region_txt", "country_txt", "provstate", "city", "attacktype1_txt", "nkill", "iyear"],
-            zoom=1
-        )
-        # Update mapbox style and layout
-        mapFigure.update_layout(
-            mapbox_style="carto-darkmatter",
-            autosize=True,
-            margin=dict(l=0, r=0, t=25, b=20)
-        )
-
-        fig = mapFigure
-
-    # If Chart tab is selected
-    elif Tabs == "chart":
-        fig = None
-        year_range_c = range(chart_year_selector[0], chart_year_selector[1] + 1)
-        chart_df = df[df["iyear"].isin(year_range_c)]
-
-        # Filter for India chart if selected
-        if subtabs2 == "IndiaChart":
-            chart_df = chart_df[(chart_df["region_txt"] == "South Asia") & (chart_df["country_txt"] == "India")]
-
-        # Filter and group data for charting
-        if chart_dp_value is not None and chart_df.shape[0]:
-            if search is not None:
-                chart_df = chart_df.groupby("iyear")[chart_dp_value].value_counts().reset_index(name="count")
-                chart_df = chart_df[chart_df[chart_dp_value].str.contains(search, case=False)]
-            else:
-                chart_df = chart_df.groupby("iyear")[chart_dp_value].value_counts().reset_index(name="count")
-
-        # If no data for chart, create placeholder row
-        if not chart_df.shape[0]:
-            chart_df = pd.DataFrame(columns=['iyear', 'count', chart_dp_value])
-            chart_df.loc[0] = [0, 0, "No data"]
-
-        # Create area chart using Plotly
-        fig = px.area(chart_df, x="iyear", y="count", color=chart_dp_value)
-
-    # Return the figure to the graph component
-    return dcc.Graph(figure=fig)
+        selections = map_selections(month_value, date_value, region_value, country_value, state_value, city_value,
+                                    attack_value, year_value, date_mode, start_date, end_date)
+        figure, raw = map_figure(data, *selections)
+        return figure, map_view_state(data, selections, None, raw, figure)
+    if Tabs == "chart":
+        return chart_figure(data, chart_year_selector, chart_dp_value, search, subtabs2), dash.no_update
+    raise PreventUpdate
+
+# Map tool inputs as the arguments of map_figure after data. The month and day
+# dropdowns apply in the months and days mode, the date range picker in the
+# date range mode once both its ends are picked.
+def map_selections(month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+                   year_value, date_mode, start_date, end_date):
+    date_range = None
+    if date_mode == "range":
+        month_value = date_value = None
+        if start_date and end_date:
+            date_range = [start_date, end_date]
+    return [month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+            year_value, date_range]
+
+# What the browser's map holds, kept in the map-view store: the data version
+# and selections it was drawn for, the viewport, and for a single point map the
+# tiles loaded so far (all of them, as the zoom 0 tile, for a map drawn without
+# a viewport)
+def map_view_state(data, selections, view, raw, figure):
+    return {
+        "version": data.version,
+        "selections": selections,
+        "view": view,
+        "tiles": ([list(tile) for tile in view_tiles(view)] if view is not None else [[0, 0, 0]]) if raw else None,
+        "points": sum(len(trace["lat"]) for trace in figure["data"]),
+    }
+
+# Callback to update the Map tool figure when its inputs change or the map is
+# panned or zoomed. A pan or zoom over a single point map only sends the points
+# of the newly exposed tiles.
+@app.callback(
+    [Output('graph', 'figure', allow_duplicate=True),
+     Output('map-view', 'data', allow_duplicate=True)],
+    [
+        Input('month', 'value'),
+        Input('date', 'value'),
+        Input('region-dropdown', 'value'),
+        Input('country-dropdown', 'value'),
+        Input('state-dropdown', 'value'),
+        Input('city-dropdown', 'value'),
+        Input('attacktype-dropdown', 'value'),
+        Input('year-slider', 'value'),
+        Input('date-mode', 'value'),
+        Input('date-range', 'start_date'),
+        Input('date-range', 'end_date'),
+        Input('graph', 'relayoutData')
+    ],
+    [State('Tabs', 'value'), State('map-view', 'data'), State('session-id', 'data')],
+    prevent_initial_call=True,
+    background=jobs.ENABLED,
+    interval=jobs.POLL_INTERVAL,
+    cancel=[Input('Tabs', 'value')]
+)
+def update_map(month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+               year_value, date_mode, start_date, end_date, relayout, Tabs, map_view, session_id=None):
+    if Tabs != "Map":
+        raise PreventUpdate
+    data = reloader.snapshot()
+    map_view = map_view or {}
+    selections = map_selections(month_value, date_value, region_value, country_value, state_value, city_value,
+                                attack_value, year_value, date_mode, start_date, end_date)
+
+    view = map_view.get("view")
+    if dash.callback_context.triggered_id == "graph":
+        view = viewport(relayout)
+        if view is None:
+            raise PreventUpdate
+
+        # Same data and selections on a single point map: only add the points of the new tiles
+        if (map_view.get("version") == data.version and map_view.get("selections") == selections
+                and map_view.get("tiles") is not None):
+            loaded_tiles = [tuple(tile) for tile in map_view["tiles"]]
+            result = map_tiles_patch(data, *selections, view, loaded_tiles, map_view["points"])
+            if result is not None:
+                patch, tiles, points = result
+                return patch, dict(map_view, view=view, tiles=[list(tile) for tile in tiles], points=points)
+
+    figure, raw = map_figure(data, *selections, view=view)
+    return patch_figure(figure, [("data",)]), map_view_state(data, selections, view, raw, figure)
+
+# Callback to update the Chart tool figure, only the Chart tool inputs trigger it
+@app.callback(
+    Output('graph', 'figure', allow_duplicate=True),
+    [
+        Input('cyear_slider', 'value'),
+        Input('Chart_Dropdown', 'value'),
+        Input('search-seq', 'data'),
+        Input('subtabs2', 'value')
+    ],
+    [State('search', 'value'), State('Tabs', 'value'), State('session-id', 'data')],
+    prevent_initial_call=True,
+    background=jobs.ENABLED,
+    interval=jobs.POLL_INTERVAL,
+    cancel=[Input('Tabs', 'value')]
+)
+def update_chart(chart_year_selector, chart_dp_value, search_seq, subtabs2, search, Tabs, session_id=None):
+    if Tabs != "chart":
+        raise PreventUpdate
+
+    # While typing in the search box, skip every keystroke that a newer one has already replaced
+    typing = dash.callback_context.triggered_id == "search-seq"
+    if typing and not search_debouncer.is_latest(session_id, "search", search_seq):
+        raise PreventUpdate
+
+    figure = chart_figure(reloader.snapshot(), chart_year_selector, chart_dp_value, search, subtabs2)
+    if typing and not search_debouncer.is_newest(session_id, "search", search_seq):
+        raise PreventUpdate
+    return patch_figure(figure, [("data",), ("layout", "legend")])
+
+# Figure cache hit/miss/eviction counters, and the builds shared by identical requests
+@app.server.route("/cache-stats")
+def cache_stats():
+    return dict(figure_cache.stats(), coalesced=coalescer.stats())
+
+# Callback timings and figure cache counters for Prometheus
+instrumentation.install(app.server, [instrumentation.figure_cache_collector(figure_cache)])
+
+# Liveness at /health, and /ready once the data has loaded
+reloader.install(app.server)
+
+# Map tool inputs in an export request, named as map_selections names them
+EXPORT_SELECTIONS = ["month_value", "date_value", "region_value", "country_value", "state_value", "city_value",
+                     "attack_value", "year_value", "date_mode", "start_date", "end_date"]
+
+# What each of them may hold besides null, as the Map tool inputs send it:
+# month and day numbers, a year range, the date mode and ISO dates, names
+EXPORT_CHECKS = {
+    "month_value": lambda value: isinstance(value, list) and all(type(v) is int and 1 <= v <= 12 for v in value),
+    "date_value": lambda value: isinstance(value, list) and all(type(v) is int and 1 <= v <= 31 for v in value),
+    "year_value": lambda value: isinstance(value, list) and (
+        not value or len(value) == 2 and all(type(v) is int for v in value) and value[0] <= value[1]),
+    "date_mode": lambda value: value in ("days", "range"),
+    "start_date": lambda value: isinstance(value, str),
+    "end_date": lambda value: isinstance(value, str),
+}
+
+# The selections of an export request, ValueError if they are not what the Map tool sends
+def check_export_selections(selections):
+    if not isinstance(selections, dict):
+        raise ValueError("not an object")
+    for name, value in selections.items():
+        if name not in EXPORT_SELECTIONS:
+            raise ValueError("unknown selection %s" % name)
+        check = EXPORT_CHECKS.get(name, lambda value: isinstance(value, list) and all(
+            isinstance(v, str) for v in value))
+        if value is not None and not check(value):
+            raise ValueError("%s=%r" % (name, value))
+    return selections
+
+# Rows of an export of the Map tool selections. All of the export reads the
+# one snapshot current when it started, even if the data reloads meanwhile.
+def export_rows(selections):
+    data = reloader.snapshot()
+    selections = dict(dict.fromkeys(EXPORT_SELECTIONS), **check_export_selections(selections))
+    if not selections["year_value"]:
+        selections["year_value"] = [min(data.year_list), max(data.year_list)]
+    (month_value, date_value, region_value, country_value, state_value, city_value, attack_value, year_value,
+     date_range) = map_selections(**selections)
+    dates = map_dates(year_value, month_value, date_value, date_range)
+    filters = map_filters(region_value, country_value, state_value, city_value, attack_value)
+    chunks = data.filter_index.query_chunks(dates, filters, export.CHUNK_ROWS)
+    return "gtd-export", data.df, chunks, list(datastore.COLUMNS)
+
+# Downloads at /export/csv and /export/parquet
+export.install(app.server, export_rows)
 
 # Callback to update date dropdown options based on selected months
 @app.callback(
@@ -369,12 +754,54 @@ def update_app_ui(Tabs, month_value, date_value, region_value, country_value, st
     [Input("month", "value")]
 )
 def update_date(month_value):
-    date_list = [x for x in range(1, 32)]  # List of days in a month
     option = []
     if month_value:
-        option = [{'label': m, 'value': m} for m in date_list]
+        # Days of the longest selected month, February with its leap day
+        days = max(calendar.monthrange(2000, month)[1] for month in month_value)
+        option = [{'label': m, 'value': m} for m in range(1, days + 1)]
     return option
 
+# Show the month and day dropdowns or the date range picker, as the date mode selects
+app.clientside_callback(
+    """
+    function(mode) {
+        var dropdown = {textAlign: 'center', display: mode === 'range' ? 'none' : 'block'};
+        var picker = {textAlign: 'center', display: mode === 'range' ? 'block' : 'none'};
+        return [dropdown, dropdown, picker];
+    }
+    """,
+    [Output('month', 'style'), Output('date', 'style'), Output('date-range-container', 'style')],
+    [Input('date-mode', 'value')]
+)
+
+# Point the download links at the export of the current Map tool selections
+app.clientside_callback(
+    """
+    function(month, date, region, country, state, city, attack, year, mode, start, end) {
+        var query = '?selections=' + encodeURIComponent(JSON.stringify({
+            month_value: month, date_value: date, region_value: region, country_value: country,
+            state_value: state, city_value: city, attack_value: attack, year_value: year,
+            date_mode: mode, start_date: start, end_date: end
+        }));
+        return ['%scsv' + query, '%sparquet' + query];
+    }
+    """ % (app.get_relative_path("/export/"), app.get_relative_path("/export/")),
+    [Output('export-csv', 'href'), Output('export-parquet', 'href')],
+    [
+        Input('month', 'value'),
+        Input('date', 'value'),
+        Input('region-dropdown', 'value'),
+        Input('country-dropdown', 'value'),
+        Input('state-dropdown', 'value'),
+        Input('city-dropdown', 'value'),
+        Input('attacktype-dropdown', 'value'),
+        Input('year-slider', 'value'),
+        Input('date-mode', 'value'),
+        Input('date-range', 'start_date'),
+        Input('date-range', 'end_date')
+    ]
+)
+
 # Callback to update region and country dropdowns when switching map subtabs
 @app.callback(
     [Output("region-dropdown", "value"),
@@ -395,50 +822,68 @@ def update_r(tab):
         disabled_c = True
     return region, disabled_r, country, disabled_c
 
-# Callback to update country dropdown options based on selected regions
-@app.callback(
+# Options of a cascading dropdown, worked out in the browser from the hierarchy store.
+# Called with the dropdown's parent value, the values of the levels above it
+# (region first) and the tree; the options are the children of every selected
+# node, sorted and without duplicates.
+CASCADE_OPTIONS = """
+function() {
+    var selections = Array.prototype.slice.call(arguments);
+    var tree = selections.pop();
+    var value = selections.shift();
+    if (value == null || tree == null) {
+        return window.dash_clientside.no_update;
+    }
+    selections.push(value);
+    var nodes = [tree];
+    selections.forEach(function(names) {
+        var children = [];
+        nodes.forEach(function(node) {
+            (names || []).forEach(function(name) {
+                if (Object.prototype.hasOwnProperty.call(node, name)) {
+                    children.push(node[name]);
+                }
+            });
+        });
+        nodes = children;
+    });
+    var options = [];
+    nodes.forEach(function(node) {
+        options = options.concat(Array.isArray(node) ? node : Object.keys(node));
+    });
+    if (nodes.length > 1) {
+        options = Array.from(new Set(options)).sort();
+    }
+    return options.map(function(name) { return {label: name, value: name}; });
+}
+"""
+
+# Update country dropdown options based on selected regions
+app.clientside_callback(
+    CASCADE_OPTIONS,
     Output('country-dropdown', 'options'),
-    [Input('region-dropdown', 'value')]
+    [Input('region-dropdown', 'value')],
+    [State('hierarchy', 'data')]
 )
-def set_country_options(region_value):
-    option = []
-    if region_value is None:
-        raise PreventUpdate
-    else:
-        for var in region_value:
-            if var in country_list.keys():
-                option.extend(country_list[var])
-    return [{'label': m, 'value': m} for m in option]
 
-# Callback to update state dropdown options based on selected countries
-@app.callback(
+# Update state dropdown options based on selected countries
+app.clientside_callback(
+    CASCADE_OPTIONS,
     Output('state-dropdown', 'options'),
-    [Input('country-dropdown', 'value')]
+    [Input('country-dropdown', 'value')],
+    [State('region-dropdown', 'value'),
+     State('hierarchy', 'data')]
 )
-def set_state_options(country_value):
-    option = []
-    if country_value is None:
-        raise PreventUpdate
-    else:
-        for var in country_value:
-            if var in state_list.keys():
-                option.extend(state_list[var])
-    return [{'label': m, 'value': m} for m in option]
 
-# Callback to update city dropdown options based on selected states
-@app.callback(
+# Update city dropdown options based on selected states
+app.clientside_callback(
+    CASCADE_OPTIONS,
     Output('city-dropdown', 'options'),
-    [Input('state-dropdown', 'value')]
+    [Input('state-dropdown', 'value')],
+    [State('region-dropdown', 'value'),
+     State('country-dropdown', 'value'),
+     State('hierarchy', 'data')]
 )
-def set_city_options(state_value):
-    option = []
-    if state_value is None:
-        raise PreventUpdate
-    else:
-        for var in state_value:
-            if var in city_list.keys():
-                option.extend(city_list[var])
-    return [{'label': m, 'value': m} for m in option]
 
 # Function to open the app in the default web browser
 def open_webbrowser():
@@ -447,11 +892,11 @@ def open_webbrowser():
 # Main function to start the app
 def main():
     print("Starting the main function.....")
-    load_data()  # Load the dataset and initialize global variables
+    load_data(background=LAZY_STARTUP)  # Load the dataset (in the background by default) and initialize global variables
     open_webbrowser()  # Open browser with app
 
     global app
-    app.layout = create_app_ui()  # Set the app layout
+    app.layout = create_app_ui  # Set the app layout, rebuilt on every page load from the current data
     app.title = "Terrorism Analysis with Insights"  # Set the app title
 
     app.run_server()  # Start the Dash server
@@ -0,0 +1,165 @@
+# Burst load on the Map tool: clients dragging the year slider
+#
+#   python benchmarks/burst_load.py global_terror.csv.gz [--background]
+#
+# Every client sends --updates year-slider changes --gap ms apart, as a
+# dragged slider does, and waits for the figure of the last one. Requests go
+# through /_dash-update-component with Flask's test client, at most --workers
+# at a time like gunicorn sync workers. In the default mode every update runs
+# to completion in a worker. With --background the requests follow the Dash
+# renderer's protocol for background callbacks: a request starting a job,
+# polls for its result, and the superseded job sent along as oldJob.
+#
+# Reports the latency of the last update of every burst, the share of the
+# workers' time spent in requests, and the time spent building map figures.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1e3 if values else float("nan")
+
+
+class Workers:
+    # At most n requests at once, keeping track of the time they are busy
+    def __init__(self, n):
+        self.slots = threading.Semaphore(n)
+        self.lock = threading.Lock()
+        self.busy = 0.0
+
+    def post(self, client, url, body):
+        with self.slots:
+            start = time.perf_counter()
+            try:
+                return client.post(url, json=body)
+            finally:
+                with self.lock:
+                    self.busy += time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="dataset, read through the app from the working directory")
+    parser.add_argument("--background", action="store_true")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--bursts", type=int, default=3)
+    parser.add_argument("--updates", type=int, default=10)
+    parser.add_argument("--gap", type=float, default=30, help="ms between the updates of a burst")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    # Every request computes its figure, and jobs go to a fresh directory
+    os.environ["GTD_FIGURE_CACHE_MB"] = "0"
+    os.environ["GTD_PREWARM"] = "0"
+    os.environ["GTD_SHARED_RESULT_SECONDS"] = "0"
+    os.environ["GTD_BACKGROUND_CALLBACKS"] = "1" if args.background else "0"
+    os.environ.setdefault("GTD_INSTRUMENTATION_LOG_LEVEL", "NOTSET")
+    job_dir = tempfile.mkdtemp(prefix="gtd-jobs-")
+    os.environ["TMPDIR"] = job_dir
+    tempfile.tempdir = None
+
+    import app2
+    import instrumentation
+
+    app2.load_data()
+    app2.app.layout = app2.create_app_ui()
+    poll = app2.jobs.POLL_INTERVAL / 1000.0
+
+    key, callback = next((k, cb) for k, cb in app2.app.callback_map.items()
+                         if any(i["id"] == "year-slider" for i in cb["inputs"]))
+    outputs = []
+    for output in key.strip(".").split("..."):
+        component, prop = output.rsplit(".", 1)
+        outputs.append({"id": component, "property": prop})
+
+    def request_body(values):
+        return {
+            "output": key,
+            "outputs": outputs,
+            "inputs": [{"id": i["id"], "property": i["property"], "value": values.get(i["id"])}
+                       for i in callback["inputs"]],
+            "state": [{"id": s["id"], "property": s["property"], "value": values.get(s["id"])}
+                      for s in callback.get("state", [])],
+            "changedPropIds": ["year-slider.value"],
+        }
+
+    workers = Workers(args.workers)
+    latencies = []
+    lock = threading.Lock()
+    first_year = 1970
+
+    def run_client(n):
+        client = app2.app.server.test_client()
+        pending = ThreadPoolExecutor(max_workers=args.updates)
+        for burst in range(args.bursts):
+            job = None
+            futures = []
+            for i in range(args.updates):
+                values = {"Tabs": "Map", "session-id": "client-%d" % n,
+                          "year-slider": [first_year + n, first_year + 20 + burst * args.updates + i]}
+                body = request_body(values)
+                sent = time.perf_counter()
+                if not args.background:
+                    futures.append(pending.submit(workers.post, client, "/_dash-update-component", body))
+                else:
+                    url = "/_dash-update-component" + ("?oldJob=%s" % job if job else "")
+                    started = json.loads(workers.post(client, url, body).data)
+                    job, cache_key = started["job"], started["cacheKey"]
+                if i < args.updates - 1:
+                    time.sleep(args.gap / 1000.0)
+
+            # Wait for the figure of the last update
+            if not args.background:
+                futures[-1].result()
+            else:
+                url = "/_dash-update-component?cacheKey=%s&job=%s" % (cache_key, job)
+                while True:
+                    response = workers.post(client, url, body)
+                    if response.status_code != 200 or "response" in json.loads(response.data):
+                        break
+                    time.sleep(poll)
+            with lock:
+                latencies.append(time.perf_counter() - sent)
+            for future in futures:
+                future.result()
+        pending.shutdown()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        list(clients.map(run_client, range(args.clients)))
+    wall = time.perf_counter() - start
+    if args.background:
+        app2.background_manager.pool().shutdown(wait=True)
+
+    figure_seconds = 0.0
+    figures = 0
+    for (metric, labels), histogram in instrumentation.registry._histograms.items():
+        labels = dict(labels)
+        if metric == "seconds" and labels.get("stage") == "total" and labels["callback"].startswith("map"):
+            figure_seconds += histogram.sum
+            figures += histogram.count
+
+    print("mode=%s clients=%d bursts=%d updates=%d gap=%gms workers=%d" % (
+        "background" if args.background else "sync", args.clients, args.bursts, args.updates, args.gap,
+        args.workers))
+    print("last update latency: p50 %.0f ms, p99 %.0f ms" % (percentile(latencies, 50), percentile(latencies, 99)))
+    print("worker occupancy: %.0f%% of %d workers over %.1f s" % (100 * workers.busy / (args.workers * wall),
+                                                                 args.workers, wall))
+    print("map figures built: %d, %.1f s" % (figures, figure_seconds))
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# Identical requests arriving at once: the default Map view opened by many users
+#
+#   python benchmarks/coalescing.py global_terror.csv.gz [--workers 4] [--clients 8]
+#
+# Loads app2, then forks --workers processes like gunicorn's workers, each
+# with --clients threads. In every round all the clients of all the workers
+# open the Map tab at the same moment (a barrier across the processes), with
+# the same selections: the full year range cut by one more year every round,
+# so that each round asks for a figure nobody has built yet. The figure cache
+# is off, and the run is repeated with GTD_COALESCE=0 and =1.
+#
+# Reports the latency of the requests, the wall time of a round and the
+# number of figures actually built.
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_worker(args, barrier, results):
+    import app2
+    import load_test
+
+    driver = load_test.Driver(app2.app)
+    years = app2.reloader.snapshot().year_list
+    latencies = []
+    rounds = []
+    lock = threading.Lock()
+
+    def client():
+        for r in range(args.rounds):
+            values = dict(load_test.APP2_DEFAULTS, Tabs="Map", **{"year-slider": [years[0], years[-1 - r]]})
+            body = driver.body("Tabs", values)
+            barrier.wait()
+            start = time.perf_counter()
+            response = driver.client.post("/_dash-update-component", json=body)
+            elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                raise RuntimeError("HTTP %d" % response.status_code)
+            with lock:
+                latencies.append(elapsed)
+            barrier.wait()
+            with lock:
+                rounds.append((r, start, start + elapsed))
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put({"latencies": latencies, "rounds": rounds, "coalescer": app2.coalescer.stats()})
+
+
+def run_mode(args):
+    import app2
+
+    app2.load_data()
+    app2.app.layout = app2.create_app_ui
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(args.workers * args.clients)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=run_worker, args=(args, barrier, results)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    latencies = np.concatenate([report["latencies"] for report in reports])
+    walls = []
+    for r in range(args.rounds):
+        spans = [(start, end) for report in reports for n, start, end in report["rounds"] if n == r]
+        walls.append(max(end for _, end in spans) - min(start for start, _ in spans))
+    stats = [report["coalescer"] for report in reports]
+    return {
+        "requests": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "round_s": float(np.mean(walls)),
+        "builds": sum(s["builds"] for s in stats),
+        "joined": sum(s["joined"] for s in stats),
+        "shared": sum(s["shared"] for s in stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default="global_terror.csv.gz",
+                        help="dataset, read through the app from the working directory")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--mode", choices=["on", "off"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+        return
+
+    print("%d workers x %d clients, %d rounds of the default Map view" % (args.workers, args.clients, args.rounds))
+    print("%-10s %8s %9s %9s %9s %7s %7s %7s" % ("coalesce", "requests", "p50 ms", "p99 ms", "round s", "builds",
+                                                  "joined", "shared"))
+    for mode in ("off", "on"):
+        shared_dir = tempfile.mkdtemp(prefix="gtd-coalesce-")
+        env = dict(os.environ, GTD_COALESCE="1" if mode == "on" else "0", GTD_FIGURE_CACHE_MB="0",
+                   GTD_PREWARM="0", GTD_BACKGROUND_CALLBACKS="0", GTD_INSTRUMENTATION_LOG_LEVEL="NOTSET",
+                   TMPDIR=shared_dir)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), args.source, "--mode", mode,
+                                 "--workers", str(args.workers), "--clients", str(args.clients),
+                                 "--rounds", str(args.rounds)],
+                                env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+        shutil.rmtree(shared_dir, ignore_errors=True)
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-10s %8d %9.0f %9.0f %9.2f %7d %7d %7d" % (
+            mode, result["requests"], result["p50_ms"], result["p99_ms"], result["round_s"], result["builds"],
+            result["joined"], result["shared"]))
+
+
+if __name__ == "__main__":
+    main()
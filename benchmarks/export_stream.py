@@ -0,0 +1,198 @@
+# Memory and speed of the streamed export of a Map tool selection
+#
+#   python benchmarks/export_stream.py global_terror.csv.gz [--format csv]
+#
+# Every selection is exported in a fresh process through app2's /export
+# route, reading the streamed body chunk by chunk as a client would, and
+# the same rows are written the old way, copied out of the frame and turned
+# into one csv text or Parquet file. Reports the size and time of each, and
+# the growth of the peak RSS of the process over the loaded dataset.
+#
+# Every export is also read back, csv with pandas and Parquet with pyarrow
+# (pip install -r requirements-parquet.txt), and compared with the rows the
+# filter index selects.
+#
+# Then the Map tab is opened repeatedly, alone and while --downloads exports
+# of the whole dataset stream in other threads, to show the dashboard's
+# latency with downloads running.
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SELECTIONS = {
+    "one country": {"region_value": ["South Asia"], "country_value": ["India"]},
+    "one decade": {"year_value": [2000, 2009]},
+    "everything": {},
+}
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load():
+    import app2
+
+    app2.load_data()
+    app2.app.layout = app2.create_app_ui
+    return app2
+
+
+def export_url(kind, selections):
+    return "/export/%s?selections=%s" % (kind, urllib.parse.quote(json.dumps(selections)))
+
+
+# Rows of the frame a selection exports, copied out of it
+def selected_frame(app2, selections):
+    data = app2.reloader.snapshot()
+    selections = dict(dict.fromkeys(app2.EXPORT_SELECTIONS), **selections)
+    selections["year_value"] = selections["year_value"] or [min(data.year_list), max(data.year_list)]
+    (month, date, region, country, state, city, attack, year, date_range) = app2.map_selections(**selections)
+    rows = data.filter_index.query(app2.map_dates(year, month, date, date_range),
+                                   app2.map_filters(region, country, state, city, attack))
+    return data.filter_index.take(data.df, rows)[list(app2.datastore.COLUMNS)]
+
+
+def run_export(args):
+    app2 = load()
+    client = app2.app.server.test_client()
+    before = peak_mb()
+    start = time.perf_counter()
+    if args.way == "streamed":
+        response = client.get(export_url(args.format, SELECTIONS[args.selection]), buffered=False)
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+    elif args.format == "csv":
+        size = len(selected_frame(app2, SELECTIONS[args.selection]).to_csv(index=False).encode())
+    else:
+        out = io.BytesIO()
+        selected_frame(app2, SELECTIONS[args.selection]).to_parquet(out, index=False)
+        size = len(out.getvalue())
+    return {"seconds": time.perf_counter() - start, "bytes": size, "peak_mb": peak_mb() - before}
+
+
+# Whether the export of every selection reads back as the rows it selects
+def run_check(args):
+    import pandas as pd
+
+    app2 = load()
+    client = app2.app.server.test_client()
+    results = {}
+    for name, selections in SELECTIONS.items():
+        response = client.get(export_url(args.format, selections), buffered=False)
+        body = b"".join(response.response)
+        response.close()
+        if args.format == "csv":
+            got = pd.read_csv(io.BytesIO(body))
+        else:
+            import pyarrow.parquet
+
+            got = pyarrow.parquet.read_table(io.BytesIO(body)).to_pandas()
+        expected = selected_frame(app2, selections)
+        results[name] = bool(
+            response.status_code == 200 and list(got.columns) == list(expected.columns) and len(got) == len(expected)
+            and all(np.allclose(got[col].to_numpy(np.float64), expected[col].to_numpy(np.float64), equal_nan=True,
+                                atol=1e-5) if expected[col].dtype != "category"
+                    else (got[col].astype(str).to_numpy() == expected[col].astype(str).to_numpy()).all()
+                    for col in expected.columns))
+    return results
+
+
+def run_latency(args):
+    import load_test
+
+    app2 = load()
+    driver = load_test.Driver(app2.app)
+    years = app2.reloader.snapshot().year_list
+
+    def open_map(n):
+        latencies = []
+        for i in range(n):
+            values = dict(load_test.APP2_DEFAULTS, Tabs="Map", **{"year-slider": [years[i % 10], years[-1]]})
+            start = time.perf_counter()
+            response = driver.client.post("/_dash-update-component", json=driver.body("Tabs", values))
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError("HTTP %d" % response.status_code)
+        return latencies
+
+    def download():
+        client = app2.app.server.test_client()
+        response = client.get(export_url("csv", {}), buffered=False)
+        for chunk in response.response:
+            if stop.is_set():
+                break
+        response.close()
+
+    alone = open_map(args.requests)
+    stop = threading.Event()
+    threads = [threading.Thread(target=download) for _ in range(args.downloads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    busy = open_map(args.requests)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {"alone": float(np.percentile(alone, 50) * 1e3), "busy": float(np.percentile(busy, 50) * 1e3)}
+
+
+def child(args, *extra):
+    env = dict(os.environ, PYTHONWARNINGS="ignore", GTD_LAZY_STARTUP="0", GTD_PREWARM="0", GTD_FIGURE_CACHE_MB="0",
+               GTD_SHARED_RESULT_SECONDS="0", GTD_BACKGROUND_CALLBACKS="0", GTD_INSTRUMENTATION_LOG_LEVEL="NOTSET")
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), args.source, "--format", args.format,
+                             "--downloads", str(args.downloads), "--requests", str(args.requests)] + list(extra),
+                            env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default="global_terror.csv.gz",
+                        help="dataset, read through the app from the working directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--downloads", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--selection", choices=list(SELECTIONS), help=argparse.SUPPRESS)
+    parser.add_argument("--way", choices=["streamed", "copied", "latency", "check"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.way == "latency":
+        print(json.dumps(run_latency(args)))
+        return
+    if args.way == "check":
+        print(json.dumps(run_check(args)))
+        return
+    if args.way:
+        print(json.dumps(run_export(args)))
+        return
+
+    print("%-12s %-9s %9s %9s %8s %13s" % ("selection", "export", "MB", "seconds", "MB/s", "peak RSS +MB"))
+    for selection in SELECTIONS:
+        for way in ("copied", "streamed"):
+            result = child(args, "--selection", selection, "--way", way)
+            mb = result["bytes"] / 1e6
+            print("%-12s %-9s %9.1f %9.2f %8.1f %13.0f" % (selection, way, mb, result["seconds"],
+                                                          mb / result["seconds"], result["peak_mb"]))
+    for selection, same in child(args, "--way", "check").items():
+        print("%-12s read back as the selected rows: %s" % (selection, "yes" if same else "NO"))
+    result = child(args, "--way", "latency")
+    print("Map tab p50: %.0f ms alone, %.0f ms with %d exports streaming" % (result["alone"], result["busy"],
+                                                                           args.downloads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Figure build + serialize time and payload size: plotly.express against figures.py
+#
+#   python benchmarks/figure_build.py global_terror.csv.gz
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import plotly.express as px
+
+import aggregate
+import datastore
+import figures
+from cube import YearCube
+from filter_index import FilterIndex, date_intervals, map_filters
+
+
+# Raw map points as map_figure draws them when a selection is small enough
+def px_map(frame):
+    frame = frame.assign(attacktype1_txt=frame["attacktype1_txt"].cat.remove_unused_categories())
+    fig = px.scatter_mapbox(frame, lat="latitude", lon="longitude", color="attacktype1_txt",
+                            hover_name="city", hover_data=["region_txt", "country_txt", "provstate", "city",
+                                                           "nkill", "iyear"], zoom=1)
+    fig.update_layout(mapbox_style="carto-darkmatter", autosize=True, margin=dict(l=0, r=0, t=25, b=20))
+    return fig.to_json()
+
+
+def fast_map(frame):
+    attack = frame["attacktype1_txt"]
+    fig = figures.scatter_mapbox(
+        frame["latitude"].to_numpy(), frame["longitude"].to_numpy(), attack.cat.codes.to_numpy(),
+        list(attack.cat.categories), "attacktype1_txt",
+        hover=[(col, figures.category_labels(frame[col])) for col in ["region_txt", "country_txt", "provstate", "city"]]
+        + [("nkill", frame["nkill"].to_numpy()), ("iyear", frame["iyear"].to_numpy())],
+        hover_name=figures.category_labels(frame["city"]), zoom=1, style="carto-darkmatter",
+        margin=dict(l=0, r=0, t=25, b=20))
+    fig["layout"]["autosize"] = True
+    return figures.dumps(fig)
+
+
+# Aggregated grid cells, as drawn for selections over aggregate.MAX_RAW_POINTS
+def px_grid(frame):
+    points = aggregate.aggregate_points(frame, 1)
+    points = points.assign(attacktype1_txt=points["attacktype1_txt"].cat.remove_unused_categories())
+    fig = px.scatter_mapbox(points, lat="latitude", lon="longitude", color="attacktype1_txt", size="size",
+                            hover_data=["attacks", "nkill"], zoom=1)
+    fig.update_layout(mapbox_style="carto-darkmatter", autosize=True, margin=dict(l=0, r=0, t=25, b=20))
+    return fig.to_json()
+
+
+def fast_grid(frame):
+    points = aggregate.aggregate_points(frame, 1)
+    fig = figures.scatter_mapbox(
+        points["latitude"].to_numpy(), points["longitude"].to_numpy(),
+        points["attacktype1_txt"].cat.codes.to_numpy(), list(points["attacktype1_txt"].cat.categories),
+        "attacktype1_txt", hover=[("attacks", points["attacks"].to_numpy()), ("nkill", points["nkill"].to_numpy())],
+        size=points["size"].to_numpy(), zoom=1, style="carto-darkmatter", margin=dict(l=0, r=0, t=25, b=20))
+    return figures.dumps(fig)
+
+
+def px_chart(cube, column, years):
+    fig = px.area(cube.year_counts(column, years), x="iyear", y="count", color=column)
+    return fig.to_json()
+
+
+def fast_chart(cube, column, years):
+    year, codes, counts = cube.year_count_arrays(column, years)
+    return figures.dumps(figures.area(year, counts, codes, cube.values[column], "iyear", "count", column))
+
+
+# Same traces (names, point counts) in both figures
+def check(reference, payload, name):
+    expected = [(t.get("name"), len(t.get("lat", t.get("x", [])))) for t in json.loads(reference)["data"]]
+    actual = [(t.get("name"), len(t.get("lat", t.get("x", [])))) for t in figures.loads(payload)["data"]]
+    assert expected == actual, name
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cache = datastore.open_cache(args.source)
+    df = cache.frame()
+    index = FilterIndex(df, cache=cache)
+    cube = YearCube(df)
+    years = [int(df["iyear"].min()), int(df["iyear"].max())]
+    region = df["region_txt"].value_counts().index[0]
+    raw = index.take(df, index.query(date_intervals([2010, 2014]), map_filters([region], None, None, None, None)))
+    raw = raw.iloc[:aggregate.MAX_RAW_POINTS]
+    cases = {
+        "map, %d raw points" % len(raw): (lambda: px_map(raw), lambda: fast_map(raw)),
+        "map, grid of %d rows" % len(df): (lambda: px_grid(df), lambda: fast_grid(df)),
+        "chart, attacktype1_txt": (lambda: px_chart(cube, "attacktype1_txt", years),
+                                   lambda: fast_chart(cube, "attacktype1_txt", years)),
+        "chart, gname": (lambda: px_chart(cube, "gname", years), lambda: fast_chart(cube, "gname", years)),
+    }
+
+    print("%-28s %10s %10s %8s %10s %10s" % ("figure", "px (ms)", "fast (ms)", "speedup", "px (KB)", "fast (KB)"))
+    for name, (slow, fast) in cases.items():
+        reference, payload = slow(), fast()
+        check(reference, payload, name)
+        slow_time = min(timeit.repeat(slow, number=1, repeat=args.repeat))
+        fast_time = min(timeit.repeat(fast, number=1, repeat=args.repeat))
+        print("%-28s %10.1f %10.1f %7.1fx %10.1f %10.1f" % (name, slow_time * 1e3, fast_time * 1e3,
+                                                            slow_time / fast_time, len(reference) / 1024,
+                                                            len(payload) / 1024))
+
+
+if __name__ == "__main__":
+    main()
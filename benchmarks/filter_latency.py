@@ -0,0 +1,109 @@
+# Map tool filter latency: the original isin() chain against the filter index
+#
+#   python benchmarks/filter_latency.py global_terror.csv.gz
+#
+# Date ranges, which the isin() chain could not express, are checked against
+# a reference computing the earliest and latest date every row could be.
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pandas as pd
+
+import datastore
+from filter_index import FilterIndex, map_dates, map_filters
+
+
+# Rows of df dated within the date range, an unknown month or day counting as the whole year or month
+def legacy_date_range(df, date_range):
+    start, end = (pd.Timestamp(value) for value in date_range)
+    year, month, day = df["iyear"].astype(int), df["imonth"].astype(int), df["iday"].astype(int)
+    earliest = pd.to_datetime(pd.DataFrame({"year": year, "month": month.where(month > 0, 1),
+                                            "day": day.where(day > 0, 1)}))
+    last_month = month.where(month > 0, 12)
+    days_in_month = pd.to_datetime(pd.DataFrame({"year": year, "month": last_month, "day": 1})).dt.days_in_month
+    latest = pd.to_datetime(pd.DataFrame({"year": year, "month": last_month,
+                                          "day": day.where(day > 0, days_in_month)}))
+    return df[(earliest >= start) & (latest <= end)]
+
+
+# The filter chain update_app_ui used before the index, kept as the reference
+def legacy_filter(df, month_value, date_value, region_value, country_value, state_value, city_value,
+                  attack_value, year_value, date_range=None):
+    new_df = df[df["iyear"].isin(range(year_value[0], year_value[1] + 1))]
+    if date_range:
+        new_df = legacy_date_range(new_df, date_range)
+    elif month_value:
+        if date_value:
+            new_df = new_df[(new_df["imonth"].isin(month_value)) & (new_df["iday"].isin(date_value))]
+        else:
+            new_df = new_df[new_df["imonth"].isin(month_value)]
+    if region_value:
+        mask = new_df["region_txt"].isin(region_value)
+        if country_value:
+            mask &= new_df["country_txt"].isin(country_value)
+            if state_value:
+                mask &= new_df["provstate"].isin(state_value)
+                if city_value:
+                    mask &= new_df["city"].isin(city_value)
+        new_df = new_df[mask]
+    if attack_value:
+        new_df = new_df[new_df["attacktype1_txt"].isin(attack_value)]
+    return new_df
+
+
+# Realistic selections built from the most common values in the data
+def selections(df):
+    years = [int(df["iyear"].min()), int(df["iyear"].max())]
+    top = lambda col, frame=df: frame[col].value_counts().index[0]
+    region = top("region_txt")
+    country = top("country_txt", df[df["region_txt"] == region])
+    state = top("provstate", df[df["country_txt"] == country])
+    city = top("city", df[df["provstate"] == state])
+    attack = top("attacktype1_txt")
+    none = [None] * 7
+    return {
+        "full range": (none, years),
+        "one region": ([None, None, [region], None, None, None, None], years),
+        "region+country, 10 years": ([None, None, [region], [country], None, None, None], [2000, 2009]),
+        "down to a city": ([None, None, [region], [country], [state], [city], None], years),
+        "two months, three days": ([[1, 6], [1, 15, 28], None, None, None, None, None], years),
+        "attack type, 5 years": ([None, None, None, None, None, None, [attack]], [2010, 2014]),
+        "india sub-tab": ([None, None, ["South Asia"], ["India"], None, None, None], years),
+        "date range, 14 months": (none + [["2014-11-15", "2016-01-10"]], years),
+        "date range, whole years": (none + [["2001-01-01", "2003-12-31"]], years),
+        "date range + region": ([None, None, [region], None, None, None, None, ["2012-02-01", "2012-02-29"]],
+                                years),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    cache = datastore.open_cache(args.source)
+    df = cache.frame()
+    index = FilterIndex(df, cache=cache)
+    print("%-28s %8s %12s %12s %8s" % ("selection", "rows", "isin (ms)", "index (ms)", "speedup"))
+    for name, (values, years) in selections(df).items():
+        date_range = values[7] if len(values) > 7 else None
+        expected = legacy_filter(df, *values[:7], years, date_range)
+        query = lambda: index.query(map_dates(years, values[0], values[1], date_range), map_filters(*values[2:7]))
+        rows = query()
+        assert np.array_equal(rows, expected.index.to_numpy()), name
+
+        legacy = min(timeit.repeat(lambda: legacy_filter(df, *values[:7], years, date_range), number=1,
+                                   repeat=args.repeat))
+        indexed = min(timeit.repeat(lambda: index.take(df, query()), number=1, repeat=args.repeat))
+        print("%-28s %8d %12.2f %12.2f %7.1fx" % (name, len(rows), legacy * 1e3, indexed * 1e3, legacy / indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# Load test of the dashboard callbacks over synthetic datasets of growing size
+#
+#   python benchmarks/load_test.py --rows 10000 190000 1000000 5000000 --json results.json
+#
+# For every size a synthetic extract (benchmarks/synthetic.py) is written once
+# under --data-dir, and a fresh Python process imports app.py and app2.py
+# against it. The scenarios post to /_dash-update-component with Flask's test
+# client, as the browser does, with the figure cache turned off so that every
+# request does its work. Per scenario it reports throughput of one client,
+# p50/p95/p99 latency, payload bytes and the peak RSS of the process so far.
+# The "exp" column is the slope of log p50 latency against log rows from the
+# previous size: about 1 is linear, well above 1 superlinear. --json writes all
+# the numbers so that runs can be compared.
+#
+# The location dropdowns cascade in the browser (clientside callbacks), so
+# they have no server side to measure here.
+
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Inputs of app2 when nothing has been touched yet
+APP2_DEFAULTS = {
+    "Tabs": "Map", "subtabs": "WorldMap", "subtabs2": "WorldChart", "year-slider": [1970, 2017],
+    "cyear_slider": [1970, 2017], "Chart_Dropdown": "region_txt", "session-id": "load-test",
+}
+
+
+class Driver:
+    # Posts callback requests to a Dash app the way the renderer does
+    def __init__(self, app):
+        self.client = app.server.test_client()
+        self.client.get("/")
+        self.callbacks = app.callback_map
+
+    # The server side callback triggered by an input (and writing to output
+    # when several are), and its output key
+    def find(self, input_id, output=None):
+        for key, callback in self.callbacks.items():
+            if (callback.get("callback") and any(i["id"] == input_id for i in callback["inputs"])
+                    and (output is None or output in key)):
+                return key, callback
+        raise KeyError(input_id)
+
+    def body(self, input_id, values, output=None):
+        key, callback = self.find(input_id, output)
+        outputs = []
+        for output in key.strip(".").split("..."):
+            component, prop = output.rsplit(".", 1)
+            outputs.append({"id": component, "property": prop})
+        # Values by component id, or by "id.property" for a component with several inputs
+        value = lambda d: values.get("%s.%s" % (d["id"], d["property"]), values.get(d["id"]))
+        dependency = lambda d: {"id": d["id"], "property": d["property"], "value": value(d)}
+        changed = next(i for i in callback["inputs"] if i["id"] == input_id)
+        return {
+            "output": key,
+            "outputs": outputs if key.startswith("..") else outputs[0],
+            "inputs": [dependency(i) for i in callback["inputs"]],
+            "state": [dependency(s) for s in callback.get("state", [])],
+            "changedPropIds": ["%s.%s" % (input_id, changed["property"])],
+        }
+
+    def post(self, input_id, values, output=None):
+        return self.client.post("/_dash-update-component", json=self.body(input_id, values, output))
+
+
+def _viewport(lon, lat, zoom, width=1200, height=600):
+    half_width = width / 2.0 * 360 / (512 * 2 ** zoom)
+    half_height = height / 2.0 * 360 / (512 * 2 ** zoom)
+    return {"mapbox.center": {"lon": lon, "lat": lat}, "mapbox.zoom": zoom,
+            "mapbox._derived": {"coordinates": [[lon - half_width, lat + half_height],
+                                                [lon + half_width, lat + half_height],
+                                                [lon + half_width, lat - half_height],
+                                                [lon - half_width, lat - half_height]]}}
+
+
+# (app, triggering input, input values[, output]) of every request of every scenario
+def scenarios(df, n):
+    top = lambda col: [str(v) for v in df[col].value_counts().index[:10]]
+    countries = top("country_txt")
+    years = sorted(int(y) for y in df["iyear"].unique())
+    cities = df.dropna(subset=["latitude"]).groupby("city", observed=True)[["latitude", "longitude"]].mean()
+    cities = cities.loc[[c for c in df["city"].value_counts().index[:10] if c in cities.index]]
+    region_of = df.groupby("country_txt", observed=True)["region_txt"].first().astype(str).to_dict()
+
+    cycle = lambda values: [values[i % len(values)] for i in range(n)]
+    app2 = lambda **values: dict(APP2_DEFAULTS, **values)
+    return {
+        "app: country + year": [
+            ("app", "country-dropdown", {"country-dropdown": c, "year-slider": y})
+            for c, y in zip(cycle(countries), cycle(years[::-3]))],
+        "app2: Map tab, world": [
+            ("app2", "Tabs", app2(Tabs="Map", **{"year-slider": [years[0], y]})) for y in cycle(years[::-3])],
+        "app2: year slider drag": [
+            ("app2", "year-slider", app2(**{"year-slider": [years[0], y]})) for y in cycle(years[5:])],
+        "app2: region + country": [
+            ("app2", "country-dropdown", app2(**{"region-dropdown": [region_of[c]], "country-dropdown": [c]}))
+            for c in cycle(countries)],
+        "app2: pan at city zoom": [
+            ("app2", "graph", app2(graph=_viewport(float(row.longitude) + step * 0.3, float(row.latitude), 7)))
+            for (_, row), step in zip(cycle(list(cities.iterrows())), range(n))],
+        "app2: Chart tab, gname": [
+            ("app2", "Tabs", app2(Tabs="chart", Chart_Dropdown="gname", cyear_slider=[years[0], y]))
+            for y in cycle(years[::-3])],
+        "app2: chart dimensions": [
+            ("app2", "Chart_Dropdown", app2(Tabs="chart", Chart_Dropdown=col))
+            for col in cycle(["gname", "natlty1_txt", "targtype1_txt", "attacktype1_txt", "weaptype1_txt",
+                              "region_txt", "country_txt"])],
+        "app2: chart search": [
+            ("app2", "search-seq", app2(Tabs="chart", Chart_Dropdown="gname", search=text, **{"search-seq": seq}))
+            for seq, text in enumerate(cycle(["g", "gr", "gro", "group", "group 1", "group 12", "unk", "1"]), 1)],
+        "app2: date range": [
+            ("app2", "date-range", app2(**{"date-mode": "range", "date-range.start_date": "%d-%02d-01" % (y, m),
+                                           "date-range.end_date": "%d-%02d-28" % (y + 1, m)}))
+            for y, m in zip(cycle(years[-12:-1]), cycle([1, 3, 6, 9, 11]))],
+        "app2: month -> days": [
+            ("app2", "month", app2(month=months), "date.options") for months in cycle([[1], [1, 6], None, [12]])],
+        "app2: India subtab": [
+            ("app2", "subtabs", app2(subtabs=tab)) for tab in cycle(["IndiaMap", "WorldMap"])],
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Runs in the child process, from the dataset's directory
+def run_child(rows, requests):
+    os.environ["GTD_FIGURE_CACHE_MB"] = "0"
+    os.environ["GTD_BACKGROUND_CALLBACKS"] = "0"
+    os.environ["GTD_LAZY_STARTUP"] = "0"  # Time the whole load, not just the server start
+    os.environ["GTD_PREWARM"] = "0"
+    os.environ["GTD_SHARED_RESULT_SECONDS"] = "0"
+    import datastore
+
+    start = time.perf_counter()
+    for source in ("global_terror.csv", "global_terror.csv.gz"):
+        datastore.ensure_cache(source)
+    cache_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import app
+    import app2
+    app2.load_data()
+    app2.app.layout = app2.create_app_ui()
+    startup_seconds = time.perf_counter() - start
+    result = {"rows": rows, "cache_build_s": cache_seconds, "startup_s": startup_seconds,
+              "startup_rss_mb": peak_rss_mb(), "scenarios": {}}
+
+    drivers = {"app": Driver(app.app), "app2": Driver(app2.app)}
+    for name, calls in scenarios(app2.reloader.snapshot().df, requests).items():
+        latencies, sizes = [], []
+        map_view = None
+        for call in calls:
+            app_name, input_id, values = call[:3]
+            if app_name == "app2":
+                values = dict(values, **{"map-view": map_view})
+            start = time.perf_counter()
+            response = drivers[app_name].post(input_id, values, *call[3:])
+            latencies.append(time.perf_counter() - start)
+            sizes.append(len(response.data))
+            if response.status_code not in (200, 204):
+                raise RuntimeError("%s: HTTP %d" % (name, response.status_code))
+            if response.status_code == 200:
+                map_view = json.loads(response.data)["response"].get("map-view", {}).get("data", map_view)
+        latencies = np.asarray(latencies)
+        result["scenarios"][name] = {
+            "requests": len(latencies),
+            "throughput_rps": len(latencies) / latencies.sum(),
+            "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+            "p95_ms": float(np.percentile(latencies, 95) * 1e3),
+            "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+            "bytes_mean": float(np.mean(sizes)),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    return result
+
+
+# Synthetic dataset of a size, written on first use
+def dataset_dir(data_dir, rows):
+    import synthetic
+
+    directory = os.path.join(data_dir, "rows-%d" % rows)
+    os.makedirs(directory, exist_ok=True)
+    for name in ("global_terror.csv", "global_terror.csv.gz"):
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            synthetic.write(rows, path + ".tmp" + (".gz" if name.endswith(".gz") else ""))
+            os.replace(path + ".tmp" + (".gz" if name.endswith(".gz") else ""), path)
+    return directory
+
+
+def report(runs):
+    names = list(runs[0]["scenarios"])
+    print("%-26s %9s %9s %9s %9s %9s %10s %9s %6s" % (
+        "scenario", "rows", "req/s", "p50 ms", "p95 ms", "p99 ms", "bytes", "rss MB", "exp"))
+    for run in runs:
+        print("%-26s %9d %9s %9s %9s %9s %10s %9.0f" % (
+            "cache %.1f s, load %.1f s" % (run["cache_build_s"], run["startup_s"]), run["rows"], "", "", "", "", "",
+            run["startup_rss_mb"]))
+    for name in names:
+        previous = None
+        for run in runs:
+            s = run["scenarios"][name]
+            exponent = ""
+            if previous is not None:
+                exponent = "%.2f" % (math.log(s["p50_ms"] / previous[1]) / math.log(run["rows"] / previous[0]))
+            print("%-26s %9d %9.1f %9.1f %9.1f %9.1f %10.0f %9.0f %6s" % (
+                name, run["rows"], s["throughput_rps"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["bytes_mean"],
+                s["peak_rss_mb"], exponent))
+            previous = (run["rows"], s["p50_ms"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 50000, 190000, 1000000, 5000000])
+    parser.add_argument("--requests", type=int, default=40, help="requests per scenario")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, ".benchmark-data"))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.rows[0], args.requests)))
+        return
+
+    runs = []
+    for rows in args.rows:
+        directory = dataset_dir(args.data_dir, rows)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--rows", str(rows),
+             "--requests", str(args.requests)],
+            cwd=directory, check=True, stdout=subprocess.PIPE, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+        print("%d rows done" % rows, file=sys.stderr)
+
+    report(runs)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
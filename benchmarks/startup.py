@@ -0,0 +1,167 @@
+# Startup time of the dashboards: imports, first response and data ready
+#
+#   python benchmarks/startup.py global_terror.csv.gz [--app app2] [--runs 3]
+#
+# Run from the dataset's directory, with the column cache already built (a
+# first run builds it). Prints the -X importtime breakdown of importing the
+# app by top level package, then starts the server in a fresh process with
+# GTD_LAZY_STARTUP=1 and =0 and reports, from the process start: the first
+# 200 from / and from /_dash-layout, /ready answering 200, and the first
+# figure callback (the Map tab, or the country dropdown of app.py) coming back.
+
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Inputs of the figure callback timed, per app
+FIGURE_CALLBACK = {
+    "app": ("country-dropdown", {"country-dropdown": "India", "year-slider": 2015}),
+    "app2": ("Tabs", {"Tabs": "Map", "subtabs": "WorldMap", "year-slider": [1970, 2017],
+                      "session-id": "startup"}),
+}
+
+
+# Import time spent in the modules of every top level package, slowest first
+def import_breakdown(name):
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % name],
+                            cwd=os.getcwd(), env=dict(os.environ, PYTHONPATH=ROOT),
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True).stderr
+    modules = {}
+    for line in output.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)", line)
+        if match:
+            package = match.group(2).split(".")[0]
+            modules[package] = modules.get(package, 0) + int(match.group(1))
+    return sorted(modules.items(), key=lambda item: -item[1])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Runs in the server process, from the dataset's directory
+def serve(name, port):
+    sys.path.insert(0, ROOT)
+    if name == "app2":
+        import app2
+        from reloader import LAZY_STARTUP
+
+        app2.load_data(background=LAZY_STARTUP)
+        app2.app.layout = app2.create_app_ui
+        app2.app.run_server(port=port)
+    else:
+        import app
+
+        app.app.run_server(port=port)
+
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data, headers), timeout=600) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as err:
+        return err.code, err.read()
+    except (urllib.error.URLError, ConnectionError):
+        return None, b""
+
+
+# Seconds from start until url answers 200
+def wait_for(url, start, body=None):
+    while True:
+        status, data = request(url, body)
+        if status == 200:
+            return time.perf_counter() - start, data
+        time.sleep(0.01)
+
+
+# Request body of the server side callback triggered by input_id, from /_dash-dependencies
+def callback_body(dependencies, input_id, values):
+    callback = next(c for c in dependencies if not c.get("clientside_function")
+                    and any(i["id"] == input_id for i in c["inputs"]))
+    key = callback["output"]
+    outputs = []
+    for output in key.strip(".").split("..."):
+        component, prop = output.rsplit(".", 1)
+        outputs.append({"id": component, "property": prop.split("@")[0]})
+    dependency = lambda d: {"id": d["id"], "property": d["property"], "value": values.get(d["id"])}
+    changed = next(i for i in callback["inputs"] if i["id"] == input_id)
+    return {
+        "output": key,
+        "outputs": outputs if key.startswith("..") else outputs[0],
+        "inputs": [dependency(i) for i in callback["inputs"]],
+        "state": [dependency(s) for s in callback.get("state", [])],
+        "changedPropIds": ["%s.%s" % (input_id, changed["property"])],
+    }
+
+
+def measure(name, lazy):
+    port = free_port()
+    base = "http://127.0.0.1:%d" % port
+    env = dict(os.environ, GTD_LAZY_STARTUP="1" if lazy else "0", GTD_FIGURE_CACHE_MB="0",
+               GTD_SHARED_RESULT_SECONDS="0", GTD_PREWARM="0", GTD_BACKGROUND_CALLBACKS="0")
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--app", name,
+                               "--port", str(port)], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        result = {"page_s": wait_for(base + "/", start)[0], "layout_s": wait_for(base + "/_dash-layout", start)[0]}
+        dependencies = json.loads(wait_for(base + "/_dash-dependencies", start)[1])
+        input_id, values = FIGURE_CALLBACK[name]
+        result["figure_s"] = wait_for(base + "/_dash-update-component", start,
+                                      callback_body(dependencies, input_id, values))[0]
+        result["ready_s"] = wait_for(base + "/ready", start)[0]
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default="global_terror.csv.gz",
+                        help="dataset, read through the app from the working directory")
+    parser.add_argument("--app", choices=["app", "app2"], default="app2")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.app, args.port)
+        return
+
+    sys.path.insert(0, ROOT)
+    import datastore
+
+    datastore.ensure_cache(args.source)
+
+    breakdown = import_breakdown(args.app)
+    total = sum(us for _, us in breakdown)
+    print("import %s: %.0f ms" % (args.app, total / 1e3))
+    for package, us in breakdown[:12]:
+        print("  %-20s %7.0f ms" % (package, us / 1e3))
+
+    print("%-6s %9s %9s %9s %9s  (seconds from process start, median of %d)" % (
+        "mode", "/", "layout", "figure", "/ready", args.runs))
+    for lazy in (True, False):
+        runs = [measure(args.app, lazy) for _ in range(args.runs)]
+        median = lambda key: sorted(run[key] for run in runs)[len(runs) // 2]
+        print("%-6s %9.2f %9.2f %9.2f %9.2f" % ("lazy" if lazy else "eager", median("page_s"),
+                                                median("layout_s"), median("figure_s"), median("ready_s")))
+
+
+if __name__ == "__main__":
+    main()
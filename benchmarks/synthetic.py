@@ -0,0 +1,150 @@
+# Deterministic synthetic GTD extract for the benchmarks
+#
+#   python benchmarks/synthetic.py 190000 global_terror.csv.gz
+#
+# Same columns and dtypes as the ones datastore.COLUMNS reads, with the
+# cardinalities of the 181,691 row GTD release the dashboards were built on
+# (12 regions, 205 countries, ~2,850 states, ~36,700 cities, ~3,540 groups)
+# and its skew: a few countries, cities and groups account for most attacks,
+# and attacks grow towards the recent years. Every city lies in one state,
+# every state in one country and every country in one region, with the
+# attacks of a city scattered around its location. As in the GTD some rows
+# have no state or city recorded, and the last few countries no state at all.
+# The same row count and seed always give the same file.
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+REGIONS = [
+    "Middle East & North Africa", "South Asia", "South America", "Sub-Saharan Africa", "Western Europe",
+    "Southeast Asia", "Central America & Caribbean", "Eastern Europe", "North America", "East Asia",
+    "Central Asia", "Australasia & Oceania",
+]
+ATTACK_TYPES = [
+    "Bombing/Explosion", "Armed Assault", "Assassination", "Hostage Taking (Kidnapping)",
+    "Facility/Infrastructure Attack", "Unknown", "Unarmed Assault", "Hostage Taking (Barricade Incident)",
+    "Hijacking",
+]
+YEARS = [year for year in range(1970, 2018) if year != 1993]  # 1993 is missing from the GTD
+
+N_COUNTRIES = 205
+INDIA = 2  # The India tools' country, third by attacks as in the GTD
+N_STATES = 2855
+N_CITIES = 36674
+N_GROUPS = 3537
+N_TARGET_TYPES = 22
+N_WEAPON_TYPES = 12
+
+# Share of rows without coordinates, kill count and wound count
+MISSING_COORDINATES = 0.025
+MISSING_NKILL = 0.057
+MISSING_NWOUND = 0.09
+
+# Share of rows without a state and without a city, and countries without any state
+MISSING_STATE = 0.003
+MISSING_CITY = 0.003
+STATELESS_COUNTRIES = 3
+
+
+# Zipf-like weights over n items, the first ones the most frequent
+def _zipf(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+# Pick a parent for each of n children, giving every parent at least one when there are enough
+def _parents(rng, n, n_parents, weights):
+    parents = rng.choice(n_parents, n, p=weights)
+    parents[:min(n, n_parents)] = np.arange(min(n, n_parents))
+    return parents
+
+
+def generate(n, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # The location hierarchy and where every city is
+    country_region = _parents(rng, N_COUNTRIES, len(REGIONS), _zipf(len(REGIONS), 0.5))
+    country_region[INDIA] = REGIONS.index("South Asia")
+    state_country = _parents(rng, N_STATES, N_COUNTRIES, _zipf(N_COUNTRIES, 0.8))
+    city_state = _parents(rng, N_CITIES, N_STATES, _zipf(N_STATES, 0.8))
+    country_lat = rng.uniform(-45, 60, N_COUNTRIES)
+    country_lon = rng.uniform(-170, 170, N_COUNTRIES)
+    city_lat = np.clip(country_lat[state_country[city_state]] + rng.normal(0, 3, N_CITIES), -85, 85)
+    city_lon = (country_lon[state_country[city_state]] + rng.normal(0, 3, N_CITIES) + 180) % 360 - 180
+
+    # Attacks per year growing towards the 2010s
+    year_weights = np.exp(np.linspace(0, 2.5, len(YEARS)))
+    year_weights /= year_weights.sum()
+
+    city = rng.choice(N_CITIES, n, p=_zipf(N_CITIES, 0.8))
+    state = city_state[city]
+    country = state_country[state]
+    region = country_region[country]
+
+    country_names = np.asarray(["Country %d" % i for i in range(N_COUNTRIES)], dtype=object)
+    country_names[INDIA] = "India"
+    lat = city_lat[city] + rng.normal(0, 0.05, n)
+    lon = city_lon[city] + rng.normal(0, 0.05, n)
+    no_coordinates = rng.random(n) < MISSING_COORDINATES
+    lat[no_coordinates] = np.nan
+    lon[no_coordinates] = np.nan
+    nkill = np.floor(rng.pareto(1.5, n)).astype(np.float64)
+    nkill[rng.random(n) < MISSING_NKILL] = np.nan
+    nwound = np.floor(rng.pareto(1.2, n)).astype(np.float64)
+    nwound[rng.random(n) < MISSING_NWOUND] = np.nan
+
+    # Unknown states and cities, drawn from a generator of their own so that
+    # the other columns stay what they were before these were added
+    missing = np.random.default_rng([seed, 1])
+    state_names = np.asarray(["State %d" % i for i in range(N_STATES)], dtype=object)[state]
+    city_names = np.asarray(["City %d" % i for i in range(N_CITIES)], dtype=object)[city]
+    stateless = country >= N_COUNTRIES - STATELESS_COUNTRIES
+    state_names[stateless | (missing.random(n) < MISSING_STATE)] = None
+    city_names[stateless | (missing.random(n) < MISSING_CITY)] = None
+
+    return pd.DataFrame({
+        "eventid": np.arange(n, dtype=np.int64),
+        "iyear": np.asarray(YEARS)[rng.choice(len(YEARS), n, p=year_weights)],
+        "imonth": np.where(rng.random(n) < 0.001, 0, rng.integers(1, 13, n)),
+        "iday": np.where(rng.random(n) < 0.005, 0, rng.integers(1, 29, n)),
+        "region_txt": np.asarray(REGIONS, dtype=object)[region],
+        "country_txt": country_names[country],
+        "provstate": state_names,
+        "city": city_names,
+        "latitude": lat,
+        "longitude": lon,
+        "attacktype1_txt": np.asarray(ATTACK_TYPES, dtype=object)[
+            rng.choice(len(ATTACK_TYPES), n, p=_zipf(len(ATTACK_TYPES), 1.5))],
+        "targtype1_txt": np.asarray(["Target %d" % i for i in range(N_TARGET_TYPES)], dtype=object)[
+            rng.choice(N_TARGET_TYPES, n, p=_zipf(N_TARGET_TYPES))],
+        "weaptype1_txt": np.asarray(["Weapon %d" % i for i in range(N_WEAPON_TYPES)], dtype=object)[
+            rng.choice(N_WEAPON_TYPES, n, p=_zipf(N_WEAPON_TYPES, 1.5))],
+        # Victims are mostly of the country attacked
+        "natlty1_txt": np.where(rng.random(n) < 0.85, country_names[country],
+                                country_names[rng.choice(N_COUNTRIES, n)]),
+        "gname": np.asarray(["Unknown"] + ["Group %d" % i for i in range(1, N_GROUPS)], dtype=object)[
+            rng.choice(N_GROUPS, n, p=_zipf(N_GROUPS))],
+        "nkill": nkill,
+        "nwound": nwound,
+    })
+
+
+# Write a synthetic extract as csv (gzipped if the name ends in .gz)
+def write(n, path, seed=0):
+    compression = {"method": "gzip", "compresslevel": 1} if path.endswith(".gz") else None
+    generate(n, seed).to_csv(path, index=False, compression=compression)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rows", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write(args.rows, args.path, args.seed)
+
+
+if __name__ == "__main__":
+    main()
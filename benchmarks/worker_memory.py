@@ -0,0 +1,166 @@
+# Checks that the dataset memory of N worker processes grows sub-linearly with N
+# when the column cache is memory-mapped (GTD_MMAP=1), and shows the private-copy
+# behaviour next to it for comparison.
+#
+#   python benchmarks/worker_memory.py global_terror.csv.gz --workers 1 2 4 8 [--app app app2]
+#
+# Every worker holds what a gunicorn worker of the app holds: it builds the
+# app's DataSnapshot from the cache (the frame, the indexes, partitions and
+# aggregates derived from it) and reads every page of the arrays the snapshot
+# keeps. The apps load a dataset as they are imported, so the workers import
+# them from a scratch directory holding a tiny synthetic one, and build a
+# snapshot of that before the baseline, so that the modules and code paths a
+# snapshot needs are loaded: only the snapshot of the dataset measured comes
+# after it.
+#
+# What can't be mapped stays private to each worker: the category vocabularies,
+# which are Python strings, and the interpreter's heap around them. That cost
+# depends on the vocabularies rather than on the rows, so on small datasets it
+# outweighs the mapped columns and the growth stays close to linear; the
+# estimate of it is printed next to the growth.
+#
+# Memory is measured as PSS (proportional set size), which splits every shared
+# page between the processes mapping it; plain RSS counts shared pages once per
+# process and so can't show the saving.
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import datastore
+
+
+def _pss_kb(pid):
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    return 0
+
+
+# True once a process' PSS has stopped moving, i.e. it has finished importing
+def _settled(pid, samples=5):
+    last = _pss_kb(pid)
+    for _ in range(samples):
+        time.sleep(0.1)
+        if _pss_kb(pid) != last:
+            return False
+    return True
+
+
+# Read every page of the arrays an object of the apps holds, through its
+# attributes, dicts, lists and DataFrames
+def _touch(obj, seen):
+    import pandas as pd
+
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        if obj.dtype != object and obj.size:
+            obj.sum()
+    elif isinstance(obj, pd.DataFrame):
+        # Columns by position, which unlike df[col] does not keep a Series of each in the frame
+        for i in range(obj.shape[1]):
+            values = obj.iloc[:, i]
+            _touch(np.asarray(values.cat.codes if values.dtype == "category" else values), seen)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _touch(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _touch(value, seen)
+    elif getattr(sys.modules.get(type(obj).__module__), "__file__", "").startswith(ROOT):
+        for value in vars(obj).values():
+            _touch(value, seen)
+
+
+# Worker body: import the app, wait, build its snapshot of the dataset, touch every page, wait to be measured
+def _worker(app, source, scratch, loaded, go, done):
+    os.chdir(scratch)
+    module = importlib.import_module(app)
+    warm = module.DataSnapshot(datastore.open_cache("global_terror.csv.gz"))
+    go.wait()
+    snapshot = module.DataSnapshot(datastore.open_cache(source))
+    _touch(snapshot, set())
+    loaded.release()
+    done.wait()
+
+
+# Dataset memory (in MB) across n workers: total PSS after loading minus before
+def measure(app, source, scratch, n):
+    ctx = multiprocessing.get_context("spawn")
+    loaded, go, done = ctx.Semaphore(0), ctx.Event(), ctx.Event()
+    procs = [ctx.Process(target=_worker, args=(app, source, scratch, loaded, go, done)) for _ in range(n)]
+    for p in procs:
+        p.start()
+    # Give the interpreters time to finish importing before taking the baseline
+    for p in procs:
+        while not _settled(p.pid):
+            pass
+    before = sum(_pss_kb(p.pid) for p in procs)
+    go.set()
+    for _ in procs:
+        loaded.acquire()
+    after = sum(_pss_kb(p.pid) for p in procs)
+    done.set()
+    for p in procs:
+        p.join()
+    return (after - before) / 1024.0
+
+
+def main():
+    import synthetic
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--app", choices=["app", "app2"], nargs="+", default=["app", "app2"])
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.source)
+    datastore.ensure_cache(source)
+    scratch = tempfile.mkdtemp(prefix="gtd-worker-memory-")
+    for name in ("global_terror.csv", "global_terror.csv.gz"):
+        synthetic.write(200, os.path.join(scratch, name))
+        datastore.ensure_cache(os.path.join(scratch, name))
+    os.environ.update(GTD_LAZY_STARTUP="0", GTD_PREWARM="0", GTD_RELOAD_SECONDS="0")
+
+    failed = []
+    try:
+        for app in args.app:
+            results = {}
+            for mmap in (False, True):
+                os.environ["GTD_MMAP"] = "1" if mmap else "0"
+                for n in args.workers:
+                    results[mmap, n] = measure(app, source, scratch, n)
+                    print("%-4s mmap=%-5s workers=%-2d dataset PSS %7.1f MB" % (app, mmap, n, results[mmap, n]))
+
+            first, last = args.workers[0], args.workers[-1]
+            growth = results[True, last] / max(results[True, first], 1e-6)
+            print("%s mmap growth %d -> %d workers: x%.2f (linear would be x%.2f)" % (app, first, last, growth,
+                                                                                    last / first))
+            private = (results[True, last] - results[True, first]) / max(last - first, 1)
+            print("%s mmap per extra worker %.1f MB, shared by all %.1f MB" % (app, private,
+                                                                          results[True, first] - private))
+            if growth >= 0.5 * last / first:
+                failed.append(app)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    if failed:
+        sys.exit("dataset memory did not grow sub-linearly with workers: %s" % ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
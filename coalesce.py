@@ -0,0 +1,198 @@
+# Single-flight coalescing of identical figure requests, within and across workers
+#
+# At peak many users open the same default view at once, and every request
+# would build the same figure in parallel. A Coalescer lets the first request
+# for a key (the figure cache key: callback, data version and normalized
+# inputs) build it, while identical requests arriving meanwhile wait for that
+# build and share its serialized result.
+#
+# Within a worker the waiters block on an event of the in-flight build. Across
+# gunicorn workers the build holds an flock on a lock file named after the
+# key in a directory shared by the workers: a worker asking for the same key
+# blocks on that lock and then reads the result the builder wrote next to it.
+# Results are kept for GTD_SHARED_RESULT_SECONDS, so a worker asking shortly
+# after the build also reads it rather than building it again. If a build
+# fails or is cancelled its waiters build the figure themselves, and a builder
+# that dies releases its lock with it.
+#
+# The results end up in the browsers, so the directory is one private to the
+# user running the server (see private_dir): if it exists but belongs to
+# someone else (or is not a directory), nothing is shared across workers and
+# every worker builds its own figures. Old results and locks are pruned, a
+# lock only while holding it, and a worker that locked a lock file pruned
+# meanwhile locks the new one again.
+#
+# GTD_COALESCE=0 turns coalescing off, every request then builds its own
+# figure. With GTD_PREWARM on (the default) the dashboards build the figures
+# of the views every page opens with as soon as a new snapshot of the data is
+# in, through the coalescer, so that the first users share those builds.
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl  # Locks shared by the worker processes
+except ImportError:  # Windows: coalescing within the worker only
+    fcntl = None
+
+import private_dir
+
+ENABLED = os.environ.get("GTD_COALESCE", "1").lower() in ("1", "true", "yes")
+PREWARM = os.environ.get("GTD_PREWARM", "1").lower() in ("1", "true", "yes")
+
+# Seconds a result stays readable by the other workers
+RESULT_SECONDS = float(os.environ.get("GTD_SHARED_RESULT_SECONDS", "300"))
+
+logger = logging.getLogger("gtd.coalesce")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+
+
+class Coalescer:
+    def __init__(self, path=None, result_seconds=RESULT_SECONDS, enabled=ENABLED):
+        self.path = path or private_dir.path("coalesce")
+        self.enabled = enabled
+        self.result_seconds = result_seconds
+        self.builds = 0
+        self.joined = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._pruned = time.time()
+        self._private = None
+
+    # The value of compute() for key: built here, or by an identical request
+    # in progress in this or another worker. Values are strings or tuples of
+    # them without newlines, such as compact JSON.
+    def run(self, key, compute):
+        if not self.enabled:
+            return self._build(compute)
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        while True:
+            with self._lock:
+                flight = self._flights.get(name)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[name] = _Flight()
+            if leader:
+                break
+            flight.done.wait()
+            if flight.ok:
+                with self._lock:
+                    self.joined += 1
+                return flight.value
+
+        try:
+            flight.value = self._run_shared(name, compute)
+            flight.ok = True
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[name]
+            flight.done.set()
+
+    def _run_shared(self, name, compute):
+        if fcntl is None or self.result_seconds <= 0 or not self._is_private():
+            return self._build(compute)
+        result = os.path.join(self.path, name + ".result")
+        value = self._read(result)
+        if value is None:
+            # Waits while another worker builds the same key
+            with self._lock_file(os.path.join(self.path, name + ".lock")) as lock:
+                os.utime(lock.fileno())
+                try:
+                    value = self._read(result)
+                    if value is None:
+                        value = self._build(compute)
+                        self._write(result, value)
+                        return value
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        with self._lock:
+            self.shared += 1
+        return value
+
+    # Whether the directory is this user's alone, creating it if needed
+    def _is_private(self):
+        if self._private is None:
+            self._private = private_dir.is_private(self.path)
+            if not self._private:
+                logger.warning("%s is not a directory of this user, figures are not shared across workers",
+                               self.path)
+        return self._private
+
+    # The lock file at path, open and locked. Pruning may remove the file
+    # while this waits for it, then it locks the file now at path.
+    def _lock_file(self, path):
+        while True:
+            lock = open(path, "a")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _build(self, compute):
+        value = compute()
+        with self._lock:
+            self.builds += 1
+        return value
+
+    # A result still fresh, or None. Results are stored as a line saying
+    # whether they are a tuple, then their strings one per line.
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > self.result_seconds:
+                    return None
+                kind, _, text = f.read().partition("\n")
+        except OSError:
+            return None
+        if kind == "tuple":
+            return tuple(text.split("\n"))
+        return text if kind == "str" else None
+
+    def _write(self, path, value):
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            if isinstance(value, tuple):
+                f.write("tuple\n" + "\n".join(value))
+            else:
+                f.write("str\n" + value)
+        os.replace(tmp, path)
+        self._prune()
+
+    # Remove the results and locks not used for a while, at most every tenth
+    # of their lifetime; a lock only if no worker holds it
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned < self.result_seconds / 10:
+            return
+        self._pruned = now
+        for entry in os.scandir(self.path):
+            try:
+                if now - entry.stat().st_mtime <= self.result_seconds:
+                    continue
+                if not entry.name.endswith(".lock"):
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"builds": self.builds, "joined": self.joined, "shared": self.shared,
+                    "in_flight": len(self._flights)}
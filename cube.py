@@ -0,0 +1,65 @@
+# Precomputed (year x value) attack counts for the Chart tool dimensions
+#
+# Every chart request used to group the raw rows by year and count the values
+# of the selected dimension. The counts are instead computed once at load time
+# into one small 2-D array per dimension, so a chart request only slices the
+# selected years out of it.
+
+import numpy as np
+
+# Dimensions offered by the Chart tool dropdown
+CHART_COLUMNS = ["gname", "natlty1_txt", "targtype1_txt", "attacktype1_txt", "weaptype1_txt", "region_txt",
+                 "country_txt"]
+
+
+class YearCube:
+    # Count the rows of df (or only the given row ids) per year and value of each column
+    def __init__(self, df, columns=CHART_COLUMNS, rows=None):
+        years = np.asarray(df["iyear"])
+        self.first_year = int(years.min()) if len(years) else 0
+        self.n_years = int(years.max()) - self.first_year + 1 if len(years) else 0
+        if rows is not None:
+            years = years[rows]
+        year_idx = years.astype(np.int64) - self.first_year
+
+        self.values = {}
+        self.counts = {}
+        for col in columns:
+            codes = np.asarray(df[col].cat.codes)
+            if rows is not None:
+                codes = codes[rows]
+            n_values = len(df[col].cat.categories)
+            valid = codes >= 0
+            flat = year_idx[valid] * n_values + codes[valid]
+            counts = np.bincount(flat, minlength=self.n_years * n_values)
+            self.counts[col] = counts.reshape(self.n_years, n_values).astype(np.int32)
+            self.values[col] = np.asarray(df[col].cat.categories, dtype=object)
+
+    # Index range into the year axis for an inclusive year range
+    def _year_slice(self, year_range):
+        start = min(max(year_range[0] - self.first_year, 0), self.n_years)
+        stop = min(max(year_range[1] - self.first_year + 1, start), self.n_years)
+        return start, stop
+
+    # Non-zero counts for one column as arrays (years, value codes, counts),
+    # ordered by year and biggest count first within a year
+    def year_count_arrays(self, column, year_range, codes=None):
+        start, stop = self._year_slice(year_range)
+        counts = self.counts[column][start:stop]
+        if codes is not None:
+            counts = counts[:, codes]
+        year_idx, value_idx = np.nonzero(counts)
+        count = counts[year_idx, value_idx]
+        order = np.lexsort((-count, year_idx))
+        year_idx, value_idx, count = year_idx[order], value_idx[order], count[order]
+        if codes is not None:
+            value_idx = np.asarray(codes)[value_idx]
+        return year_idx + start + self.first_year, value_idx, count
+
+    # Long-form counts for one column, as groupby("iyear")[column].value_counts() used to give:
+    # columns iyear, <column>, count; only non-zero counts, biggest first within a year
+    def year_counts(self, column, year_range, codes=None):
+        import pandas as pd
+
+        years, value_idx, count = self.year_count_arrays(column, year_range, codes)
+        return pd.DataFrame({"iyear": years, column: self.values[column][value_idx], "count": count})
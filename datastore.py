@@ -0,0 +1,744 @@
+# Typed, column-pruned cache of the GTD dataset
+#
+# Parsing the full csv with pandas' default dtype inference takes seconds and
+# hundreds of MB per worker. The first load converts the csv once into one .npy
+# file per column (text columns as category codes, small ints, float32
+# coordinates) and every later load just reads those arrays back. The rows
+# are stored in date order, with a packed YYYYMMDD key of every row's date
+# (date_key) so that any date selection is a few slices of them.
+#
+# The conversion streams the (possibly compressed) csv in blocks of whole
+# records and merges them in file order: text values get ids in a vocabulary
+# growing block by block, the typed columns and the date key are spooled to
+# disk, and the distinct years and location paths are collected on the way.
+# The rows are then put in date order by a stable counting sort on the date
+# key, a block at a time: the spooled destination of every row is worked out
+# from the counts of each date, and every column is scattered block by block
+# into its .npy file through a memory map. The indexes the dashboards query
+# are written next to the columns by the same counting sort, block by block:
+# the posting list of every Map tool filter column (the row ids by value, see
+# filter_index), the map tile of every point and the row ids by tile (see
+# spatial_index). The columns of the per-country views (COUNTRY_COLUMNS) are
+# stored a second time, in the order of the country posting list, so that
+# every country is one slice of them (see partitions). Workers then map the
+# indexes like the columns instead of each building its own. The memory of
+# the build stays bounded by a few blocks plus the vocabularies and the
+# per-date and per-tile counts, however many rows there are.
+#
+# Blocks are parsed in this thread, or by GTD_INGEST_WORKERS forked processes
+# (default: one per core) when ensure_cache is asked for them, as gunicorn's
+# on_starting does: that runs in the master before any thread is started or
+# worker forked. A build anywhere else (at import, or in the reloader's
+# thread of a running server) never forks, and a platform without fork
+# parses in this thread too. The location tree (hierarchy.json) and the
+# years and vocabularies (meta.json, categories.json) are therefore stored in
+# the cache, and loading never has to scan the rows for them. Reading that
+# metadata needs neither pandas nor the columns, so the modules of the data
+# path import pandas where they use it: a server can start and serve its page
+# before pandas has even been imported.
+#
+# New incidents can be added without touching the source file: csv files
+# (compressed or not) dropped into a "<source>.d" directory next to it are
+# appended to the dataset in name order. Write them under another name (e.g.
+# with a .tmp suffix) and rename them into place once complete. When the
+# files the cache was built from are all unchanged and only deltas were
+# added, the new cache starts from the cached columns and parses just the
+# new files.
+#
+# Every version of the cache is written once into a directory of its own,
+# named after the version, and never changed afterwards (but for the file
+# stamps in its meta.json). A CURRENT file next to them names the current
+# one and is replaced atomically once a new version is complete. Readers open
+# a version with open_cache(), which holds a shared flock on the version's
+# .lock file for as long as the Cache object lives, and read everything from
+# that one directory. Versions other than the current one are removed once no
+# process holds them open (without fcntl, on Windows, they are kept).
+
+import bz2
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import multiprocessing
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from hierarchy import LEVELS, hierarchy_from_codes
+from spatial_index import tile_keys
+
+try:
+    import fcntl  # Used to stop two workers rebuilding the cache at the same time
+except ImportError:  # Windows
+    fcntl = None
+
+# Bump whenever the on-disk layout changes so that old caches get rebuilt
+CACHE_FORMAT = 8
+
+# Columns the callbacks use and the dtype each one is stored as
+COLUMNS = {
+    "iyear": "int16",
+    "imonth": "int8",
+    "iday": "int8",
+    "region_txt": "category",
+    "country_txt": "category",
+    "provstate": "category",
+    "city": "category",
+    "latitude": "float32",
+    "longitude": "float32",
+    "attacktype1_txt": "category",
+    "targtype1_txt": "category",
+    "weaptype1_txt": "category",
+    "natlty1_txt": "category",
+    "gname": "category",
+    "nkill": "float32",
+    "nwound": "float32",
+}
+
+# Rows are stored sorted on these so that a year range is one contiguous slice
+SORT_COLUMNS = ["iyear", "imonth", "iday"]
+
+# Column of the packed date of every row, stored next to the parsed ones
+DATE_KEY = "date_key"
+
+# Columns with a posting list stored as postings-<column>-rows.npy and -offsets.npy, the Map tool filters
+POSTING_COLUMNS = ["region_txt", "country_txt", "provstate", "city", "attacktype1_txt"]
+
+# Columns also stored in country order, as country-<column>.npy, for the per-country views
+COUNTRY_COLUMNS = ["iyear", "latitude", "longitude", "attacktype1_txt", "city", "nkill", "nwound"]
+
+# Bytes of csv text parsed at a time, and processes parsing them where a build may fork
+BLOCK_BYTES = 16 << 20
+INGEST_WORKERS = int(os.environ.get("GTD_INGEST_WORKERS", "0")) or os.cpu_count() or 1
+
+# Decompressing readers by file extension, as pandas infers them
+_OPENERS = {".gz": gzip.GzipFile, ".bz2": bz2.BZ2File, ".xz": lzma.LZMAFile}
+
+# Rows of an existing cache handled at a time when building on it
+CACHED_BLOCK_ROWS = 1 << 20
+
+# Rows of a spooled column handled at a time when putting the rows in date order
+SORT_BLOCK_ROWS = 1 << 20
+
+
+# Directory holding the versions of the cache of a given source file
+def cache_dir_for(source):
+    root = os.environ.get("GTD_CACHE_DIR")
+    if not root:
+        root = os.path.join(os.path.dirname(os.path.abspath(source)), ".gtd_cache")
+    return os.path.join(root, os.path.basename(source))
+
+
+# Hash of the source file contents, read in blocks so a big file isn't held in memory
+def _file_hash(source):
+    digest = hashlib.sha1()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_stamp(source):
+    st = os.stat(source)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+# Whether a file name is a csv, compressed or not
+def _is_csv(name):
+    base, ext = os.path.splitext(name.lower())
+    return ext == ".csv" or (ext in _OPENERS and base.endswith(".csv"))
+
+
+# Delta files appended to a source, in the order they are applied
+def delta_files(source):
+    directory = source + ".d"
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if _is_csv(name)]
+
+
+# The source and its deltas
+def source_files(source):
+    return [source] + delta_files(source)
+
+
+# Name of a source file in the cache metadata, relative to the source's directory
+def _file_name(source, path):
+    return os.path.relpath(path, os.path.dirname(os.path.abspath(source)))
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(json.dumps(data))
+    os.replace(tmp, path)
+
+
+# Version hash of a dataset made of the given files, the source's own hash when there are no deltas
+def _dataset_sha1(entries):
+    if len(entries) == 1:
+        return entries[0]["sha1"]
+    return hashlib.sha1("\n".join(entry["sha1"] for entry in entries).encode()).hexdigest()
+
+
+# Whether a file still has the contents recorded in its metadata entry, refreshing the entry's stamp
+def _unchanged(source, entry, path):
+    if entry["name"] != _file_name(source, path):
+        return False
+    stamp = _source_stamp(path)
+    if entry["size"] == stamp["size"] and entry["mtime"] == stamp["mtime"]:
+        return True
+    # The mtime moved (a fresh checkout or copy) - only rebuild if the contents changed
+    if entry["size"] == stamp["size"] and entry["sha1"] == _file_hash(path):
+        entry.update(stamp)
+        return True
+    return False
+
+
+def _read_meta(cache_dir):
+    meta = _read_json(os.path.join(cache_dir, "meta.json"))
+    if meta is None or meta.get("format") != CACHE_FORMAT:
+        return None
+    return meta
+
+
+# Version string of the cache described by meta
+def _version(meta):
+    return "%d-%s" % (meta["format"], meta["sha1"][:12])
+
+
+# Directory of the current version in cache_dir, or None
+def _current_path(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "CURRENT")) as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    return os.path.join(cache_dir, name) if name else None
+
+
+def _set_current(cache_dir, name):
+    tmp = os.path.join(cache_dir, "CURRENT.tmp")
+    with open(tmp, "w") as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(cache_dir, "CURRENT"))
+
+
+# Returns the cache metadata if the cache matches the current source files, else None
+def _fresh_meta(source, cache_dir):
+    meta = _read_meta(cache_dir)
+    files = source_files(source)
+    if meta is None or len(meta["files"]) != len(files):
+        return None
+    stamps = [dict(entry) for entry in meta["files"]]
+    if not all(_unchanged(source, entry, path) for entry, path in zip(meta["files"], files)):
+        return None
+    if meta["files"] != stamps:
+        _write_json(os.path.join(cache_dir, "meta.json"), meta)
+    return meta
+
+
+class _HashingReader:
+    # File wrapper hashing the raw bytes as they are read, so that the source
+    # is only read once while building
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+# Blocks of whole csv records of the decompressed source, after its header line
+#
+# A block ends at the last newline outside quotes: with quotes escaped by
+# doubling, that is a newline preceded by an even number of quote characters
+# since the start of the block.
+def _record_blocks(f, header):
+    carry = b""
+    first = True
+    while True:
+        data = f.read(BLOCK_BYTES)
+        block = carry + data
+        if first:
+            end = block.index(b"\n") + 1 if b"\n" in block else len(block)
+            header.extend(next(csv.reader([block[:end].decode("utf-8-sig")])))
+            block = block[end:]
+            first = False
+        if not data:
+            if block.strip():
+                yield block
+            return
+        end = block.rfind(b"\n")
+        while end >= 0 and block.count(b'"', 0, end) % 2:
+            end = block.rfind(b"\n", 0, end)
+        if end < 0:
+            carry = block
+            continue
+        carry = block[end + 1:]
+        yield block[:end + 1]
+
+
+# Parse one block into its typed columns, text columns as (codes, values)
+def _parse_block(block, names):
+    import pandas as pd
+
+    dtypes = {col: ("category" if kind == "category" else "float64") for col, kind in COLUMNS.items()}
+    frame = pd.read_csv(io.BytesIO(block), header=None, names=names, usecols=list(COLUMNS), dtype=dtypes)
+    columns = {}
+    for col, kind in COLUMNS.items():
+        if kind == "category":
+            columns[col] = (frame[col].cat.codes.to_numpy(), frame[col].cat.categories.astype(str).tolist())
+        else:
+            columns[col] = frame[col].to_numpy().astype(kind)
+    return columns
+
+
+# Parsed blocks in file order, at most a few blocks per worker in flight
+def _parsed_blocks(blocks, names, workers):
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for block in blocks:
+            yield _parse_block(block, names)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.submit(_parse_block, block, names))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Parsed blocks of one source file, adding its name, stamp and hash to entries once read
+def _file_blocks(source, path, workers, entries):
+    entry = {"name": _file_name(source, path)}
+    entry.update(_source_stamp(path))
+    header = []
+    with open(path, "rb") as raw:
+        reader = _HashingReader(raw)
+        opener = _OPENERS.get(os.path.splitext(path)[1].lower())
+        f = opener(fileobj=reader) if opener else reader
+        yield from _parsed_blocks(_record_blocks(f, header), header, workers)
+    entry["sha1"] = reader.digest.hexdigest()
+    entries.append(entry)
+
+
+# The rows of an existing cache as parsed blocks, to build on them
+def _cached_blocks(cache_dir):
+    categories = _read_json(os.path.join(cache_dir, "categories.json"))
+    arrays = {col: np.load(os.path.join(cache_dir, col + ".npy"), mmap_mode="r") for col in COLUMNS}
+    for start in range(0, len(arrays["iyear"]), CACHED_BLOCK_ROWS):
+        columns = {}
+        for col, kind in COLUMNS.items():
+            values = np.asarray(arrays[col][start:start + CACHED_BLOCK_ROWS])
+            columns[col] = (values, categories[col]) if kind == "category" else values
+        yield columns
+
+
+# Date as one YYYYMMDD integer, sorting like SORT_COLUMNS
+#
+# The GTD records an unknown month or day as 0, which packs as is: YYYY0000
+# is a date somewhere in the year, before any of its known months, and
+# YYYYMM00 a day somewhere in the month, before its first day.
+def date_key(year, month, day):
+    return (np.asarray(year, dtype=np.int32) * 10000 + np.asarray(month, dtype=np.int32) * 100
+            + np.asarray(day, dtype=np.int32))
+
+
+# Blocks of SORT_BLOCK_ROWS values of a spool file
+def _spool_blocks(path, dtype):
+    with open(path, "rb") as f:
+        while True:
+            block = np.fromfile(f, dtype=dtype, count=SORT_BLOCK_ROWS)
+            if not len(block):
+                return
+            yield block
+
+
+# Blocks of SORT_BLOCK_ROWS values of a .npy file
+def _npy_blocks(path):
+    values = np.load(path, mmap_mode="r")
+    for start in range(0, len(values), SORT_BLOCK_ROWS):
+        yield np.array(values[start:start + SORT_BLOCK_ROWS])
+
+
+# Distinct values of the blocks, sorted, and the rows holding each
+def _value_counts(blocks):
+    keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    for block in blocks:
+        block_keys, block_counts = np.unique(block, return_counts=True)
+        keys, slot = np.unique(np.concatenate((keys, block_keys)), return_inverse=True)
+        counts = np.bincount(slot, weights=np.concatenate((counts, block_counts))).astype(np.int64)
+    return keys, counts
+
+
+# Position in key order of every row of the key blocks, written to out a
+# block at a time: rows of a key go to the key's range, in file order. keys
+# are the distinct keys, sorted, and counts the rows of each.
+def _sort_positions(blocks, keys, counts, out):
+    cursor = np.zeros(len(keys), dtype=np.int64)
+    cursor[1:] = np.cumsum(counts)[:-1]
+    for block in blocks:
+        slot = np.searchsorted(keys, block)
+        order = np.argsort(slot, kind="stable")
+        block_counts = np.bincount(slot, minlength=len(keys))
+        block_starts = np.cumsum(block_counts) - block_counts
+        positions = np.empty(len(block), dtype=np.int64)
+        positions[order] = cursor[slot[order]] + np.arange(len(block)) - block_starts[slot[order]]
+        cursor += block_counts
+        positions.tofile(out)
+
+
+# Write the values of the blocks (mapped through lookup when given) to a
+# .npy file of dtype in the order of the spooled positions, a block at a time
+def _write_sorted(path, blocks, dtype, positions, rows, lookup=None):
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(rows,))
+    for values, where in zip(blocks, _spool_blocks(positions, np.int64)):
+        out[where] = lookup[values] if lookup is not None else values
+    out.flush()
+    del out
+
+
+# Row ids 0..rows in blocks
+def _row_blocks(rows):
+    for start in range(0, rows, SORT_BLOCK_ROWS):
+        yield np.arange(start, min(start + SORT_BLOCK_ROWS, rows), dtype=np.int32)
+
+
+# Sort the rows of the version in directory on a key, stably, blocks() giving
+# the key of every row a block at a time: writes the row ids in that order to
+# <name>-rows.npy and returns the distinct keys, the rows of each and the
+# spooled positions of the rows in that order (for the caller to remove)
+def _write_order(directory, name, blocks, rows):
+    keys, counts = _value_counts(blocks())
+    positions = os.path.join(directory, name + ".positions")
+    with open(positions, "wb") as out:
+        _sort_positions(blocks(), keys, counts, out)
+    _write_sorted(os.path.join(directory, name + "-rows.npy"), _row_blocks(rows), np.int32, positions, rows)
+    return keys, counts, positions
+
+
+# Write the indexes of the version in directory: the posting lists of
+# POSTING_COLUMNS (row ids by code, where code c starts at offsets[c + 1] and
+# rows without a value come first), COUNTRY_COLUMNS in the order of the
+# country posting list, and the map tile of every row with the row ids and
+# keys in tile order
+def _write_indexes(directory, rows, categories):
+    column = lambda col: os.path.join(directory, col + ".npy")
+    for col in POSTING_COLUMNS:
+        name = "postings-" + col
+        codes, counts, positions = _write_order(directory, name, lambda: _npy_blocks(column(col)), rows)
+        offsets = np.zeros(len(categories[col]) + 2, dtype=np.int64)
+        offsets[codes + 2] = counts
+        np.save(os.path.join(directory, name + "-offsets.npy"), np.cumsum(offsets))
+        if col == "country_txt":
+            for country_col in COUNTRY_COLUMNS:
+                _write_sorted(os.path.join(directory, "country-%s.npy" % country_col),
+                              _npy_blocks(column(country_col)), np.load(column(country_col), mmap_mode="r").dtype,
+                              positions, rows)
+        os.remove(positions)
+
+    keys = np.lib.format.open_memmap(os.path.join(directory, "tiles-keys.npy"), mode="w+", dtype=np.int64,
+                                     shape=(rows,))
+    for start, (lat, lon) in enumerate(zip(_npy_blocks(column("latitude")), _npy_blocks(column("longitude")))):
+        keys[start * SORT_BLOCK_ROWS:start * SORT_BLOCK_ROWS + len(lat)] = tile_keys(lat, lon)
+    keys.flush()
+    del keys
+    key_blocks = lambda: _npy_blocks(os.path.join(directory, "tiles-keys.npy"))
+    _, _, positions = _write_order(directory, "tiles", key_blocks, rows)
+    _write_sorted(os.path.join(directory, "tiles-sorted.npy"), key_blocks(), np.int64, positions, rows)
+    os.remove(positions)
+
+
+# Smallest code dtype for a number of categories, as pandas picks it
+def _code_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+# Parse the csv (and its deltas) once and write one array per column into a
+# new version in cache_dir, parsing in workers processes (see INGEST_WORKERS)
+def build_cache(source, cache_dir=None, workers=1):
+    import pandas as pd
+
+    cache_dir = cache_dir or cache_dir_for(source)
+    files = source_files(source)
+
+    # Start from the current cache if it was built from a prefix of the files,
+    # all unchanged, so that only the delta files added since get parsed
+    entries = []
+    previous = _open_current(cache_dir)
+    if (previous is not None and len(previous.meta["files"]) < len(files)
+            and all(_unchanged(source, entry, path) for entry, path in zip(previous.meta["files"], files))):
+        entries = previous.meta["files"]
+    blocks = itertools.chain(_cached_blocks(previous.path) if entries else [],
+                             *[_file_blocks(source, path, workers, entries) for path in files[len(entries):]])
+
+    tmp_dir = os.path.join(cache_dir, "tmp-%d" % os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    spool = lambda col: os.path.join(tmp_dir, col + ".spool")
+
+    # Stream the blocks: text values to ids of a growing vocabulary, and every
+    # column and the date key appended to its spool file
+    vocabularies = {col: {} for col, kind in COLUMNS.items() if kind == "category"}
+    date_counts = {}
+    years = set()
+    paths = set()
+    rows = 0
+    for columns in blocks:
+        for col, values in columns.items():
+            if col in vocabularies:
+                codes, names = values
+                vocabulary = vocabularies[col]
+                ids = np.asarray([vocabulary.setdefault(name, len(vocabulary)) for name in names] + [-1],
+                                 dtype=np.int32)
+                values = columns[col] = ids[codes]
+            with open(spool(col), "ab") as out:
+                values.tofile(out)
+        keys = date_key(*[columns[col] for col in SORT_COLUMNS])
+        with open(spool(DATE_KEY), "ab") as out:
+            keys.tofile(out)
+        for key, count in zip(*[values.tolist() for values in np.unique(keys, return_counts=True)]):
+            date_counts[key] = date_counts.get(key, 0) + count
+        years.update(np.unique(columns["iyear"]).tolist())
+        located = np.column_stack([columns[col] for col in LEVELS])
+        paths.update(map(tuple, pd.DataFrame(located).drop_duplicates().to_numpy().tolist()))
+        rows += len(columns["iyear"])
+
+    # Rows in date order, and text values renumbered in name order as pandas has them
+    with open(spool("positions"), "wb") as out:
+        keys = np.asarray(sorted(date_counts), dtype=np.int32)
+        _sort_positions(_spool_blocks(spool(DATE_KEY), np.int32), keys,
+                        np.asarray([date_counts[key] for key in keys.tolist()], dtype=np.int64), out)
+    categories = {}
+    for col, kind in list(COLUMNS.items()) + [(DATE_KEY, "int32")]:
+        rank = None
+        if kind == "category":
+            names = list(vocabularies[col])
+            rank = np.empty(len(names) + 1, dtype=_code_dtype(len(names)))
+            rank[np.argsort(np.asarray(names, dtype=object), kind="stable")] = np.arange(len(names))
+            rank[-1] = -1
+            categories[col] = sorted(names)
+        _write_sorted(os.path.join(tmp_dir, col + ".npy"),
+                      _spool_blocks(spool(col), np.int32 if rank is not None else kind),
+                      rank.dtype if rank is not None else kind, spool("positions"), rows, rank)
+        os.remove(spool(col))
+    os.remove(spool("positions"))
+    _write_indexes(tmp_dir, rows, categories)
+
+    # Location tree of the distinct paths seen
+    paths = np.asarray(list(paths), dtype=np.int64).reshape(-1, len(LEVELS))
+    tree = hierarchy_from_codes(paths.T, [list(vocabularies[col]) for col in LEVELS])
+    _write_json(os.path.join(tmp_dir, "hierarchy.json"), tree)
+    _write_json(os.path.join(tmp_dir, "categories.json"), categories)
+    years = sorted(int(year) for year in years)
+    meta = {
+        "format": CACHE_FORMAT,
+        "sha1": _dataset_sha1(entries),
+        "rows": rows,
+        "year_min": years[0],
+        "year_max": years[-1],
+        "years": years,
+        "files": entries,
+    }
+    _write_json(os.path.join(tmp_dir, "meta.json"), meta)
+    open(os.path.join(tmp_dir, ".lock"), "w").close()
+
+    # Move the finished version in next to the others and point CURRENT at it.
+    # A version of the same contents already there is complete, and may be in use.
+    name = _version(meta)
+    if os.path.isdir(os.path.join(cache_dir, name)):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, os.path.join(cache_dir, name))
+    _set_current(cache_dir, name)
+    if previous is not None:
+        previous.close()
+    _prune(cache_dir)
+    return meta
+
+
+# Make sure an up to date cache exists for source and return its metadata,
+# building it with workers processes (see INGEST_WORKERS) if needed
+def ensure_cache(source, cache_dir=None, workers=1):
+    cache_dir = cache_dir or cache_dir_for(source)
+    current = _current_path(cache_dir)
+    meta = _fresh_meta(source, current) if current else None
+    if meta is not None:
+        return meta
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_dir + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another worker may have finished the build while we waited for the lock
+        current = _current_path(cache_dir)
+        meta = _fresh_meta(source, current) if current else None
+        if meta is None:
+            meta = build_cache(source, cache_dir, workers)
+    return meta
+
+
+# Remove what a build left behind in cache_dir: the versions other than the
+# current one no process holds open, unfinished builds and files of older
+# cache layouts. Only called holding the build lock.
+def _prune(cache_dir):
+    current = _current_path(cache_dir)
+    for entry in os.scandir(cache_dir):
+        if entry.path == current or entry.name == "CURRENT":
+            continue
+        if not entry.is_dir():
+            os.remove(entry.path)
+        elif entry.name.startswith("tmp-"):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        elif fcntl is not None:
+            try:
+                lock = open(os.path.join(entry.path, ".lock"))
+            except OSError:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Still open in some process
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# Remove the versions of a source's cache no longer in use, unless a build is running
+def prune_caches(source, cache_dir=None):
+    cache_dir = cache_dir or cache_dir_for(source)
+    if fcntl is None or not os.path.isdir(cache_dir):
+        return
+    with open(cache_dir + ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        _prune(cache_dir)
+
+
+# Whether columns are memory-mapped by default (set GTD_MMAP=1, as gunicorn.conf.py does)
+def mmap_enabled():
+    return os.environ.get("GTD_MMAP", "0").lower() in ("1", "true", "yes")
+
+
+class Cache:
+    # One version of the cache, held open: its directory is not removed while
+    # the object lives (or until close()), so everything read through it comes
+    # from that version
+    def __init__(self, path, meta, lock):
+        self.path = path
+        self.meta = meta
+        self.version = _version(meta)
+        self._lock = lock
+
+    # Region -> country -> state -> city tree of the dataset (see hierarchy)
+    def hierarchy(self):
+        return _read_json(os.path.join(self.path, "hierarchy.json"))
+
+    # Distinct values of every text column, in name order
+    def categories(self):
+        return _read_json(os.path.join(self.path, "categories.json"))
+
+    # The dataset as a DataFrame
+    #
+    # With mmap the columns are read-only views of the cache files, so every
+    # worker process shares the same page cache pages instead of holding its
+    # own copy. The DataFrame is assembled with copy=False and category codes
+    # are stored in the dtype pandas expects, so no column gets copied on the
+    # way in.
+    def frame(self, mmap=None):
+        return self._frame(list(COLUMNS) + [DATE_KEY], "", mmap)
+
+    # COUNTRY_COLUMNS in country order, and where every country starts in
+    # them: the rows of country code c are offsets[c + 1]:offsets[c + 2]
+    def country_frame(self, mmap=None):
+        return self._frame(COUNTRY_COLUMNS, "country-", mmap), self.array("postings-country_txt-offsets", mmap)
+
+    # Posting list of a column of POSTING_COLUMNS: the row ids by code, and
+    # where every code starts in them (see country_frame)
+    def postings(self, col, mmap=None):
+        return self.array("postings-%s-rows" % col, mmap), self.array("postings-%s-offsets" % col, mmap)
+
+    # Map tile key of every row, the row ids by key and the keys in that order
+    def tiles(self, mmap=None):
+        return tuple(self.array("tiles-" + name, mmap) for name in ("keys", "rows", "sorted"))
+
+    # A stored array (see frame() for mmap)
+    def array(self, name, mmap=None):
+        if mmap is None:
+            mmap = mmap_enabled()
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r" if mmap else None)
+
+    def _frame(self, columns, prefix, mmap):
+        import pandas as pd
+
+        categories = self.categories()
+        data = {}
+        for col in columns:
+            values = self.array(prefix + col, mmap)
+            if COLUMNS.get(col) == "category":
+                values = pd.Categorical.from_codes(values, categories[col], validate=False)
+            data[col] = values
+        return pd.DataFrame(data, copy=False)
+
+    def close(self):
+        self._lock.close()
+
+    def __del__(self):
+        self.close()
+
+
+# The current version in cache_dir, opened, or None when there is none or it
+# was removed before it could be opened
+def _open_current(cache_dir):
+    path = _current_path(cache_dir)
+    if path is None:
+        return None
+    try:
+        lock = open(os.path.join(path, ".lock"))
+    except OSError:
+        return None
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+    meta = _read_meta(path)
+    if meta is None:
+        lock.close()
+        return None
+    return Cache(path, meta, lock)
+
+
+# Open the current version of the cache of source, building or refreshing it if needed
+def open_cache(source):
+    cache_dir = cache_dir_for(source)
+    while True:
+        ensure_cache(source, cache_dir)
+        cache = _open_current(cache_dir)
+        if cache is not None:
+            return cache
+
+
+# Load the dataset as a DataFrame, building or refreshing the cache if needed (see Cache.frame)
+def load_frame(source, mmap=None):
+    return open_cache(source).frame(mmap)
@@ -0,0 +1,100 @@
+# Dropping superseded requests of fast-changing inputs, such as typing in a search box
+#
+# The waiting happens in the browser: the search box only sends its value
+# once typing pauses (dcc.Input's debounce), and every value it sends gets
+# the next number of a counter kept in the page. Keystrokes can still arrive
+# out of order or pile up behind a slow request, so the server remembers the
+# highest number seen for each (client, input) pair in a slot of a small
+# table and drops a request whose number is lower, before doing any work,
+# and again before sending a result a newer request has made useless.
+# Nothing ever sleeps.
+#
+# The table is a memory-mapped file in the directory private to the user
+# running the server (see private_dir), so it is shared by all worker
+# processes on the box and no one else can write to it. If it cannot be
+# opened there every worker keeps a table of its own, which only lets a
+# stale request through when it lands on another worker. Two requests
+# checking the same slot at the same instant may both go ahead, which only
+# costs the work. claim() and is_current() use the same slots without
+# numbers: the latest claim of a pair wins (see jobs).
+
+import logging
+import os
+import secrets
+import zlib
+
+import numpy as np
+
+import private_dir
+
+# Bits of a slot holding the request number, the bits above them tell apart the pairs sharing the slot
+SEQ_BITS = 31
+
+logger = logging.getLogger("gtd.debounce")
+
+
+class Debouncer:
+    def __init__(self, path=None, slots=1 << 20):
+        self.path = path or private_dir.path("debounce.bin")
+        self.slots = slots
+        self._pid = None
+        self._table = None
+
+    # The shared table, (re)opened after a fork so every worker maps it itself
+    def table(self):
+        if self._pid != os.getpid():
+            try:
+                self._table = self._open()
+            except OSError as err:
+                logger.warning("Cannot open %s (%s), requests are only debounced within each worker",
+                               self.path, err)
+                self._table = np.zeros(self.slots, dtype=np.int64)
+            self._pid = os.getpid()
+        return self._table
+
+    def _open(self):
+        if not private_dir.is_private(os.path.dirname(os.path.abspath(self.path))):
+            raise PermissionError("not a directory of this user alone")
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            if os.fstat(fd).st_size < self.slots * 8:
+                os.ftruncate(fd, self.slots * 8)
+        finally:
+            os.close(fd)
+        return np.memmap(self.path, dtype=np.int64, mode="r+", shape=(self.slots,))
+
+    def _slot(self, client, name):
+        key = ("%s/%s" % (client, name)).encode()
+        return zlib.crc32(key) % self.slots, zlib.adler32(key)
+
+    # Mark a new request for a (client, input) pair, superseding the older ones;
+    # returns the (slot, token) to check it with is_current()
+    def claim(self, client, name):
+        slot, _ = self._slot(client, name)
+        token = secrets.randbits(63)
+        self.table()[slot] = token
+        return slot, token
+
+    # Whether no newer request has claimed the slot since
+    def is_current(self, claim):
+        slot, token = claim
+        return self.table()[slot] == token
+
+    # Record request number seq of a (client, input) pair; False when a higher one was already seen
+    def is_latest(self, client, name, seq):
+        if not client or seq is None:
+            return True
+        slot, tag = self._slot(client, name)
+        table = self.table()
+        if not self.is_newest(client, name, seq):
+            return False
+        table[slot] = (tag << SEQ_BITS) | (int(seq) & ((1 << SEQ_BITS) - 1))
+        return True
+
+    # Whether no request of the pair with a higher number than seq has been seen
+    def is_newest(self, client, name, seq):
+        if not client or seq is None:
+            return True
+        slot, tag = self._slot(client, name)
+        value = int(self.table()[slot])
+        return value >> SEQ_BITS != tag or value & ((1 << SEQ_BITS) - 1) <= int(seq)
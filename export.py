@@ -0,0 +1,144 @@
+# Streaming export of the rows behind a dashboard selection, as csv or Parquet
+#
+# Analysts want the rows behind the map, not a screenshot of it. Writing the
+# selection out with new_df.to_csv() would hold the whole selection, and its
+# text, in memory. The export instead walks the selection in chunks of
+# GTD_EXPORT_CHUNK_ROWS rows of the typed column store (as the filter index
+# yields them), gathers the matches into batches of at least that many rows,
+# turns each batch into csv text or a Parquet row group and sends it before
+# reading on, so its memory stays bounded by a batch or two whatever the size
+# of the selection.
+#
+# Every download holds one request thread while it streams, so at most
+# GTD_EXPORT_CONCURRENCY run at once in a process; more get a 503 asking
+# them to retry. Parquet needs pyarrow, which is optional: pip install -r
+# requirements-parquet.txt.
+
+import json
+import os
+import threading
+
+import numpy as np
+from flask import Response, abort, request
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Rows of the store read, and rows written, per chunk
+CHUNK_ROWS = int(os.environ.get("GTD_EXPORT_CHUNK_ROWS", "65536"))
+
+# Downloads streaming at once in each process
+CONCURRENCY = int(os.environ.get("GTD_EXPORT_CONCURRENCY", "2"))
+
+
+# Row ids of the chunks joined into batches of at least rows ids (but the
+# last), so that the few matches of many chunks make one Parquet row group
+def _batches(chunks, rows):
+    pending, count = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        count += len(chunk)
+        if count >= rows:
+            yield np.concatenate(pending)
+            pending, count = [], 0
+    if pending:
+        yield np.concatenate(pending)
+
+
+# Csv text of the frames, the header with the first one
+def csv_chunks(frames, columns):
+    header = True
+    for frame in frames:
+        yield frame.to_csv(columns=columns, index=False, header=header).encode()
+        header = False
+    if header:
+        yield (",".join(columns) + "\n").encode()
+
+
+class _Sink:
+    # Write-only file keeping the bytes written since the last drain(), and
+    # the position in the whole file that the Parquet writer asks for
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+# Parquet file of the frames, one row group per frame; empty gives the schema of the columns
+def parquet_chunks(frames, columns, empty):
+    sink = _Sink()
+    writer = None
+    for frame in frames:
+        table = pyarrow.Table.from_pandas(frame[columns], preserve_index=False)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode="w"), table.schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        table = pyarrow.Table.from_pandas(empty[columns], preserve_index=False)
+        writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode="w"), table.schema)
+        writer.write_table(table)
+    writer.close()
+    yield sink.drain()
+
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+# Serve /export/csv and /export/parquet on a Flask server. select(selections)
+# gets the selections decoded from the JSON of the request's "selections"
+# parameter and returns (file name, frame, chunks of row ids of the frame,
+# columns); it should raise ValueError (or KeyError, TypeError) for bad ones.
+def install(server, select, path="/export"):
+    slots = threading.BoundedSemaphore(CONCURRENCY)
+
+    @server.route(path + "/<kind>")
+    def export(kind):
+        if kind not in FORMATS:
+            abort(404)
+        if kind == "parquet" and pyarrow is None:
+            abort(501, "Parquet export needs pyarrow")
+        try:
+            name, frame, chunks, columns = select(json.loads(request.args.get("selections") or "{}"))
+        except (ValueError, KeyError, TypeError) as err:
+            abort(400, "bad selections: %s" % err)
+        if not slots.acquire(blocking=False):
+            return Response("Too many exports running, try again shortly\n", status=503,
+                            headers={"Retry-After": "5"}, mimetype="text/plain")
+
+        frames = (frame.iloc[rows[0]:rows[-1] + 1] if rows[-1] - rows[0] + 1 == len(rows) else frame.take(rows)
+                  for rows in _batches(chunks, CHUNK_ROWS))
+        if kind == "csv":
+            body = csv_chunks(frames, columns)
+        else:
+            body = parquet_chunks(frames, columns, frame.iloc[:0])
+        mimetype, extension = FORMATS[kind]
+        response = Response(body, mimetype=mimetype,
+                            headers={"Content-Disposition": 'attachment; filename="%s.%s"' % (name, extension)})
+        response.call_on_close(slots.release)
+        return response
@@ -0,0 +1,96 @@
+# Bounded LRU cache of serialized figures, keyed on normalized callback inputs
+#
+# The dashboards get the same handful of selections over and over, so the
+# figure JSON for a selection is kept and reused. Keys are built with
+# cache_key(), which makes equivalent inputs compare equal: None and [] are
+# the same, multi-select lists are order independent. The cache is bounded by
+# both entry count and total bytes of JSON, and is emptied whenever the dataset
+# version it was filled from changes.
+
+import os
+import threading
+from collections import OrderedDict
+
+
+# Canonical, hashable form of a callback input
+def normalize(value):
+    if value is None or value == [] or value == "":
+        return None
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted((normalize(v) for v in value), key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+    return value
+
+
+# Cache key for a figure; pass only the inputs that affect it
+def cache_key(name, **inputs):
+    return (name,) + tuple((k, normalize(v)) for k, v in sorted(inputs.items()))
+
+
+def _size(value):
+    if isinstance(value, (list, tuple)):
+        return sum(len(v) for v in value)
+    return len(value)
+
+
+class FigureCache:
+    def __init__(self, max_bytes=None, max_entries=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("GTD_FIGURE_CACHE_MB", "64")) * (1 << 20))
+        if max_entries is None:
+            max_entries = int(os.environ.get("GTD_FIGURE_CACHE_ENTRIES", "256"))
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Drop everything if the dataset the figures were built from has changed
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self._bytes = 0
+                self.version = version
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Store a serialized figure (a JSON string, or a tuple of them)
+    def put(self, key, value):
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _size(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _size(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self.version,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,235 @@
+# Figure builder working straight from NumPy arrays
+#
+# plotly.express builds a DataFrame, groups it by colour, validates every
+# property of the resulting graph_objects figure and then serializes it with
+# Plotly's JSON encoder, turning every hover value into a Python object on the
+# way. The builders here write the trace dicts directly: one trace per colour
+# code, numeric columns kept as arrays, no validation. The figures come out as
+# plain dicts that look like the px ones (same template, colours and hover
+# text), and dumps() encodes them with orjson when it is installed.
+#
+# Plotly.js 2.28 and later also accept numeric arrays as base64 typed arrays
+# ({"dtype": "f4", "bdata": ...}); encode_array() uses that when the plotly.js
+# the browser renders with is new enough, and plain arrays otherwise. That is
+# the copy dash ships in its dcc package for dcc.Graph, not the one bundled
+# with plotly.py (plotly.offline), which is upgraded separately.
+# GTD_TYPED_ARRAYS=1 or 0 overrides the check, e.g. for a page loading
+# another plotly.js.
+
+import base64
+import json
+import os
+import re
+
+import dash
+import numpy as np
+import plotly.io as pio
+from plotly.utils import PlotlyJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# (major, minor) version of the plotly.js dcc.Graph loads in the browser, from
+# the banner of dash's copy; (0, 0) if it cannot be read
+def dcc_plotlyjs_version():
+    try:
+        with open(os.path.join(os.path.dirname(dash.__file__), "dcc", "plotly.min.js"), "rb") as f:
+            match = re.search(rb"plotly\.js v(\d+)\.(\d+)", f.read(512))
+    except OSError:
+        match = None
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+
+_typed_arrays = os.environ.get("GTD_TYPED_ARRAYS", "").lower()
+TYPED_ARRAYS = _typed_arrays in ("1", "true", "yes") if _typed_arrays else dcc_plotlyjs_version() >= (2, 28)
+
+# Colours px assigns to the traces of a figure, in order: the default template's colorway
+COLORS = list(pio.templates[pio.templates.default].layout.colorway)
+
+# Largest marker size of a sized scatter, as px's default size_max
+SIZE_MAX = 20
+
+_template = None
+
+
+# The default template px puts into every figure, converted once
+def template():
+    global _template
+    if _template is None:
+        _template = pio.templates[pio.templates.default].to_plotly_json()
+    return _template
+
+
+# Numeric array in the most compact form the browser's plotly.js understands
+def encode_array(values):
+    values = np.ascontiguousarray(values)
+    if TYPED_ARRAYS and values.dtype.kind in "fiu" and values.dtype.itemsize <= 4:
+        return {"dtype": values.dtype.str[1:], "bdata": base64.b64encode(values.tobytes()).decode()}
+    return values
+
+
+def dumps(figure):
+    if orjson is not None:
+        return orjson.dumps(figure, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(figure, cls=PlotlyJSONEncoder)
+
+
+def loads(payload):
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+# Row ids of each colour code, [(code, rows), ...] for the codes present, in
+# order of first appearance like px orders its traces
+def _split_by_code(codes):
+    order = np.argsort(codes, kind="stable")
+    present, starts = np.unique(codes[order], return_index=True)
+    bounds = list(starts[1:]) + [len(order)]
+    groups = [(int(code), order[start:stop]) for code, start, stop in zip(present, starts, bounds) if code >= 0]
+    groups.sort(key=lambda group: group[1][0])
+    return groups
+
+
+# Values of a categorical pandas Series as an object array, None where missing
+def category_labels(series):
+    names = np.asarray(list(series.cat.categories) + [None], dtype=object)
+    return names[np.asarray(series.cat.codes, dtype=np.int64)]
+
+
+# Per point hover values as one object array, a column per hover field
+def _customdata(columns, n):
+    data = np.empty((n, len(columns)), dtype=object)
+    for i, values in enumerate(columns):
+        data[:, i] = values
+    return data
+
+
+# Mapbox scatter coloured by a category, like px.scatter_mapbox(color=...)
+#
+# codes/names: category code of every point and the category names.
+# hover: [(label, values)] shown on hover; hover_name: values shown in bold.
+# size: marker area per point, scaled like px with size_max=SIZE_MAX.
+# all_codes: one trace for every name, in code order and coloured by code, with
+# plain arrays, so that points can later be appended to their code's trace.
+def scatter_mapbox(lat, lon, codes, names, legend_title, hover=(), hover_name=None, size=None, zoom=1,
+                   center=None, style=None, margin=None, height=None, all_codes=False):
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    customdata = _customdata([values for _, values in hover], len(lat)) if hover else None
+
+    template_text = "<b>%{hovertext}</b><br><br>" if hover_name is not None else ""
+    groups = _split_by_code(np.asarray(codes))
+    encode = encode_array
+    if all_codes:
+        present = dict(groups)
+        groups = [(code, present.get(code, np.empty(0, np.int64))) for code in range(len(names))]
+        encode = np.asarray
+    traces = []
+    for i, (code, rows) in enumerate(groups):
+        parts = ["%s=%s" % (legend_title, names[code]), "latitude=%{lat}", "longitude=%{lon}"]
+        parts += ["%s=%%{customdata[%d]}" % (label, j) for j, (label, _) in enumerate(hover)]
+        trace = {
+            "type": "scattermapbox",
+            "subplot": "mapbox",
+            "mode": "markers",
+            "name": names[code],
+            "legendgroup": names[code],
+            "showlegend": bool(len(rows)),
+            "lat": encode(lat[rows]),
+            "lon": encode(lon[rows]),
+            "marker": {"color": COLORS[(code if all_codes else i) % len(COLORS)]},
+            "hovertemplate": template_text + "<br>".join(parts) + "<extra></extra>",
+        }
+        if customdata is not None:
+            trace["customdata"] = customdata[rows].tolist()
+        if hover_name is not None:
+            trace["hovertext"] = np.asarray(hover_name, dtype=object)[rows].tolist()
+        if size is not None:
+            sizes = np.asarray(size)
+            trace["marker"].update({
+                "size": encode(sizes[rows]),
+                "sizemode": "area",
+                "sizeref": float(sizes.max()) / SIZE_MAX ** 2,
+            })
+        traces.append(trace)
+
+    if center is None:
+        center = {"lat": float(np.nanmean(lat)) if len(lat) else 0.0,
+                  "lon": float(np.nanmean(lon)) if len(lon) else 0.0}
+    layout = {
+        "template": template(),
+        "mapbox": {"domain": {"x": [0.0, 1.0], "y": [0.0, 1.0]}, "center": center, "zoom": zoom},
+        "legend": {"title": {"text": legend_title}, "tracegroupgap": 0},
+        "margin": margin or {"t": 60},
+    }
+    if size is not None:
+        layout["legend"]["itemsizing"] = "constant"
+    if style is not None:
+        layout["mapbox"]["style"] = style
+    if height is not None:
+        layout["height"] = height
+    return {"data": traces, "layout": layout}
+
+
+def _xy_layout(x_title, y_title):
+    return {
+        "template": template(),
+        "xaxis": {"anchor": "y", "domain": [0.0, 1.0], "title": {"text": x_title}},
+        "yaxis": {"anchor": "x", "domain": [0.0, 1.0], "title": {"text": y_title}},
+        "legend": {"tracegroupgap": 0},
+        "margin": {"t": 60},
+    }
+
+
+# Stacked area chart with one trace per category, like px.area(color=...)
+def area(x, y, codes, names, x_title, y_title, legend_title):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    traces = []
+    for i, (code, rows) in enumerate(_split_by_code(np.asarray(codes))):
+        traces.append({
+            "type": "scatter",
+            "mode": "lines",
+            "stackgroup": "1",
+            "orientation": "v",
+            "name": names[code],
+            "legendgroup": names[code],
+            "showlegend": True,
+            "x": encode_array(x[rows]),
+            "y": encode_array(y[rows]),
+            "xaxis": "x",
+            "yaxis": "y",
+            "line": {"color": COLORS[i % len(COLORS)]},
+            "marker": {"symbol": "circle"},
+            "fillpattern": {"shape": ""},
+            "hovertemplate": "%s=%s<br>%s=%%{x}<br>%s=%%{y}<extra></extra>" % (legend_title, names[code], x_title,
+                                                                              y_title),
+        })
+    layout = _xy_layout(x_title, y_title)
+    layout["legend"]["title"] = {"text": legend_title}
+    return {"data": traces, "layout": layout}
+
+
+# Single line chart, like px.line(x=..., y=..., title=...)
+def line(x, y, x_title, y_title, title=None):
+    trace = {
+        "type": "scatter",
+        "mode": "lines",
+        "orientation": "v",
+        "name": "",
+        "legendgroup": "",
+        "showlegend": False,
+        "x": encode_array(np.asarray(x)),
+        "y": encode_array(np.asarray(y)),
+        "xaxis": "x",
+        "yaxis": "y",
+        "line": {"color": COLORS[0], "dash": "solid"},
+        "marker": {"symbol": "circle"},
+        "hovertemplate": "%s=%%{x}<br>%s=%%{y}<extra></extra>" % (x_title, y_title),
+    }
+    layout = _xy_layout(x_title, y_title)
+    if title is not None:
+        layout["title"] = {"text": title}
+    return {"data": [trace], "layout": layout}
@@ -0,0 +1,256 @@
+# Inverted index answering the Map tool's filters without scanning the whole frame
+#
+# The cached rows are sorted by their packed date key (datastore.date_key), so
+# any date selection (a year range, months and days of those years, or a
+# range of calendar dates) is a set of intervals of keys, each one a slice of
+# rows found with two binary searches. Every other filter column gets a
+# posting list per value: the row ids holding that value, in ascending order.
+# A query starts from the most selective of the date slices and the posting
+# lists, and checks the remaining filters with a per-column value lookup table
+# on just those candidate rows. Only the final row ids are materialized.
+#
+# The posting lists are stored in the column cache (datastore), so a
+# FilterIndex of an opened cache version maps them like the columns rather
+# than sorting every column again in every worker process.
+
+import calendar
+import datetime
+
+import numpy as np
+
+from datastore import DATE_KEY, POSTING_COLUMNS, date_key
+
+# Columns the Map tool filters on, besides the date
+FILTER_COLUMNS = POSTING_COLUMNS
+
+
+# Codes of a column plus the value for each code (-1 is a missing value)
+def _codes_and_values(series):
+    if series.dtype == "category":
+        return np.asarray(series.cat.codes), np.asarray(series.cat.categories)
+    codes = np.asarray(series)
+    return codes, np.arange(int(codes.max()) + 1 if len(codes) else 0)
+
+
+class _Postings:
+    # rows and offsets as stored in the cache (datastore.Cache.postings), or None to build them
+    def __init__(self, series, rows=None, offsets=None):
+        self.codes, values = _codes_and_values(series)
+        # Values looked up by binary search, already sorted in the cache,
+        # rather than in a dict that every worker would hold
+        self.values, self.value_codes = values, None
+        if len(values) > 1 and not (values[1:] > values[:-1]).all():
+            self.value_codes = np.argsort(values, kind="stable")
+            self.values = values[self.value_codes]
+        if rows is not None:
+            self.rows, self.offsets = rows, offsets
+            return
+        # Row ids grouped by code; the stable sort keeps each group in row order
+        self.rows = np.argsort(self.codes, kind="stable").astype(np.int32)
+        counts = np.bincount(self.codes.astype(np.int64) + 1, minlength=len(values) + 1)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # Codes (shifted by one so that missing values are 0) for a list of values
+    def lookup_codes(self, values):
+        codes = []
+        for value in values:
+            try:
+                i = int(np.searchsorted(self.values, value))
+            except TypeError:  # Not comparable with the column's values
+                continue
+            if i < len(self.values) and self.values[i] == value:
+                codes.append((i if self.value_codes is None else int(self.value_codes[i])) + 1)
+        return codes
+
+    def count(self, codes):
+        return int(sum(self.offsets[c + 1] - self.offsets[c] for c in codes))
+
+    # Sorted row ids in [lo, hi) holding any of the codes
+    def rows_for(self, codes, lo, hi):
+        parts = []
+        for c in codes:
+            posting = self.rows[self.offsets[c]:self.offsets[c + 1]]
+            start, stop = np.searchsorted(posting, [lo, hi])
+            parts.append(posting[start:stop])
+        if len(parts) == 1:
+            return parts[0]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, np.int32)
+
+    # Which of the given rows hold any of the codes
+    def mask_for(self, codes, rows):
+        table = np.zeros(len(self.offsets) - 1, dtype=bool)
+        table[codes] = True
+        return table[self.codes[rows].astype(np.int64) + 1]
+
+
+# Sorted row ids of the slices [starts, stops)
+def _slice_rows(starts, stops):
+    lengths = stops - starts
+    if len(starts) == 1:
+        return np.arange(starts[0], stops[0], dtype=np.int32)
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return (np.arange(int(lengths.sum())) + offsets).astype(np.int32)
+
+
+class FilterIndex:
+    # Index of the rows of df, with the posting lists stored in cache (the
+    # opened version of the column cache df was read from) when given
+    def __init__(self, df, columns=FILTER_COLUMNS, cache=None):
+        self.dates = np.asarray(df[DATE_KEY])
+        self.postings = {col: _Postings(df[col], *(cache.postings(col) if cache is not None else ()))
+                         for col in columns}
+
+    # Filter on another index with the posting list interface (lookup_codes,
+    # count, rows_for, mask_for), e.g. the map tiles of a TileIndex
+    def add(self, name, postings):
+        self.postings[name] = postings
+
+    # Row slices (starts, stops) of the dates in the key intervals (lows, highs),
+    # adjacent slices merged and empty ones dropped
+    def date_slices(self, dates):
+        starts = np.searchsorted(self.dates, dates[0])
+        stops = np.searchsorted(self.dates, dates[1])
+        keep = stops > starts
+        starts, stops = starts[keep], stops[keep]
+        if len(starts) > 1:
+            first = np.concatenate(([True], starts[1:] != stops[:-1]))
+            last = np.concatenate((first[1:], [True]))
+            starts, stops = starts[first], stops[last]
+        return starts, stops
+
+    # Sorted row ids matching a date selection (key intervals, as date_intervals
+    # and range_intervals make them) and {column: allowed values}
+    #
+    # A filter with an empty or None value list is ignored, like in the callbacks.
+    def query(self, dates, filters):
+        starts, stops = self.date_slices(dates)
+        return self._query_slices(starts, stops, self._active(filters))
+
+    # The rows query() returns, as consecutive arrays of the matches within
+    # every `rows` dated rows, so that a selection of any size can be walked
+    # through in bounded memory
+    def query_chunks(self, dates, filters, rows):
+        starts, stops = self.date_slices(dates)
+        active = self._active(filters)
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            for lo in range(start, stop, rows):
+                chunk = self._query_slices(np.asarray([lo]), np.asarray([min(lo + rows, stop)]), active)
+                if len(chunk):
+                    yield chunk
+
+    # (row count, postings, codes) of every filter given values, most selective first
+    def _active(self, filters):
+        active = []
+        for col, values in filters.items():
+            if values:
+                postings = self.postings[col]
+                codes = postings.lookup_codes(values)
+                active.append((postings.count(codes), postings, codes))
+        active.sort(key=lambda item: item[0])
+        return active
+
+    def _query_slices(self, starts, stops, active):
+        if not len(starts):
+            return np.empty(0, np.int32)
+        lo, hi = int(starts[0]), int(stops[-1])
+        dated = int((stops - starts).sum())
+
+        if not active or active[0][0] >= dated:
+            rows = _slice_rows(starts, stops)
+        else:
+            count, postings, codes = active[0]
+            active = active[1:]
+            rows = postings.rows_for(codes, lo, hi)
+            if len(starts) > 1:
+                slot = np.searchsorted(starts, rows, side="right") - 1
+                rows = rows[rows < stops[slot]]
+        for count, postings, codes in active:
+            if not len(rows):
+                break
+            rows = rows[postings.mask_for(codes, rows)]
+        return rows
+
+    # Rows of df for the ids returned by query(), sliced rather than gathered when contiguous
+    @staticmethod
+    def take(df, rows):
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            return df.iloc[rows[0]:rows[-1] + 1]
+        return df.take(rows)
+
+
+# Key intervals [lows, highs) of the dates in the years start..end inclusive,
+# limited to some months of those years and some days of those months
+#
+# Without months every row of the years matches, unknown months and days
+# included. Months match the rows of those months, whatever their day,
+# unknown or not. Days match only the rows known to fall on them.
+def date_intervals(year_range, months=None, days=None):
+    years = np.arange(int(year_range[0]), int(year_range[1]) + 1)
+    if not months:
+        return date_key(years[:1], 0, 0), date_key(years[-1:] + 1, 0, 0)
+    months = np.unique(np.asarray(months, dtype=np.int32))
+    if not days:
+        lows = date_key(years[:, None], months[None, :], 0).ravel()
+        return lows, lows + 100
+    days = np.unique(np.asarray(days, dtype=np.int32))
+    lows = date_key(years[:, None, None], months[None, :, None], days[None, None, :]).ravel()
+    return lows, lows + 1
+
+
+# Key intervals of the calendar dates start..end inclusive (datetime.date)
+#
+# A row with an unknown day could be any day of its month, and one with an
+# unknown month any day of its year: they match only when the range covers
+# the whole month or year.
+def range_intervals(start, end):
+    low = date_key(start.year, start.month, start.day)
+    if start.day == 1:
+        low = date_key(start.year, start.month, 0)
+        if start.month == 1:
+            low = date_key(start.year, 0, 0)
+    high = date_key(end.year, end.month, end.day) + 1
+
+    # Cut out the unknown month of the last year and the unknown day of the
+    # last month when the range stops before their end
+    excluded = []
+    if (end.month, end.day) != (12, 31):
+        excluded.append((date_key(end.year, 0, 0), date_key(end.year, 1, 0)))
+    if end.day != calendar.monthrange(end.year, end.month)[1]:
+        excluded.append((date_key(end.year, end.month, 0), date_key(end.year, end.month, 1)))
+    lows, highs = [], []
+    for cut_low, cut_high in excluded:
+        if low < cut_low:
+            lows.append(low)
+            highs.append(min(high, cut_low))
+        low = max(low, cut_high)
+    lows.append(low)
+    highs.append(max(low, high))
+    return np.asarray(lows, dtype=np.int32), np.asarray(highs, dtype=np.int32)
+
+
+# Date selection of the Map tool: a range of calendar dates ("YYYY-MM-DD"
+# strings from the date range picker) within the year range when one is
+# picked, else the year range with its months and days
+def map_dates(year_value, month_value, date_value, date_range=None):
+    if not date_range:
+        return date_intervals(year_value, month_value, date_value)
+    start, end = (datetime.date.fromisoformat(value[:10]) for value in date_range)
+    lows, highs = range_intervals(min(start, end), max(start, end))
+    years = date_intervals(year_value)
+    return np.maximum(lows, years[0]), np.minimum(highs, years[1])
+
+
+# Map tool selections as {column: values}. As in the dropdown cascade, each
+# location level only applies once the level above it is chosen.
+def map_filters(region_value, country_value, state_value, city_value, attack_value):
+    filters = {}
+    if region_value:
+        filters["region_txt"] = region_value
+        if country_value:
+            filters["country_txt"] = country_value
+            if state_value:
+                filters["provstate"] = state_value
+                if city_value:
+                    filters["city"] = city_value
+    filters["attacktype1_txt"] = attack_value
+    return filters
@@ -0,0 +1,21 @@
+# Gunicorn settings for serving the dashboard, e.g. `gunicorn app:server`
+import os
+
+import datastore
+
+# Workers map the cached columns read-only instead of each holding a private copy
+os.environ.setdefault("GTD_MMAP", "1")
+
+# Threads per worker: a download streaming for a while then holds one thread
+# rather than a whole worker the dashboard's callbacks are waiting for
+threads = int(os.environ.get("GTD_THREADS", "4"))
+
+# Datasets whose cache is built once in the master, before any worker is forked
+# and with no other thread running, so the build may fork its parsing processes
+DATASETS = ["global_terror.csv", "global_terror.csv.gz"]
+
+
+def on_starting(server):
+    for source in DATASETS:
+        if os.path.exists(source):
+            datastore.ensure_cache(source, workers=datastore.INGEST_WORKERS)
@@ -0,0 +1,61 @@
+# Region -> country -> state -> city hierarchy for the Map tool's cascading dropdowns
+#
+# The options of each dropdown used to come from a server callback looking the
+# selection up in per-level dicts, one round-trip per change. The whole tree is
+# instead built once with the dataset cache (see datastore), shipped to the
+# browser in a dcc.Store and resolved there by clientside callbacks. States are keyed under their country
+# (and cities under their state) so that identically named states of different
+# countries no longer share their cities.
+#
+# The tree is nested dicts, {region: {country: {state: [city, ...]}}}, with
+# the keys of every level and the city lists deduplicated and sorted. A path
+# ends at its first unknown level: a country whose attacks have no state
+# recorded is still in the tree, with no states, and only rows without a
+# region are left out.
+
+import numpy as np
+
+LEVELS = ["region_txt", "country_txt", "provstate", "city"]
+
+
+# Tree of the distinct (region, country, state, city) combinations, from the
+# codes of every level (-1 for missing) and the names they index
+def hierarchy_from_codes(codes, categories):
+    # Every row's path as one integer made of the name ranks of its levels,
+    # plus one, and 0 from its first unknown level on, so that the distinct
+    # paths come out of np.unique already ordered by name, each shorter path
+    # before the longer ones it starts
+    names = []
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    known = np.ones(len(codes[0]), dtype=bool)
+    for level_codes, level_categories in zip(codes, categories):
+        level_categories = np.asarray(level_categories, dtype=object)
+        order = np.argsort(level_categories)
+        rank = np.empty(len(level_categories) + 1, dtype=np.int64)
+        rank[order] = np.arange(1, len(level_categories) + 1)
+        rank[-1] = 0
+        level_codes = np.asarray(level_codes, dtype=np.int64)
+        known &= level_codes >= 0
+        key = key * (len(level_categories) + 1) + np.where(known, rank[level_codes], 0)
+        names.append([None] + level_categories[order].tolist())
+    key = np.unique(key)
+
+    # Split the path integers back into the names of each level, city first
+    columns = []
+    for level_names in names[::-1]:
+        columns.append((key % len(level_names)).tolist())
+        key //= len(level_names)
+    regions, countries, states, cities = names
+
+    tree = {}
+    for city, state, country, region in zip(*columns):
+        if not region:
+            continue
+        node = tree.setdefault(regions[region], {})
+        if country:
+            node = node.setdefault(countries[country], {})
+            if state:
+                node = node.setdefault(states[state], [])
+                if city:
+                    node.append(cities[city])
+    return tree
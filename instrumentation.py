@@ -0,0 +1,329 @@
+# Timing instrumentation for the dashboard callbacks
+#
+# A function decorated with @traced("name") opens a trace for each call. Inside
+# it, span("stage") times a stage (filter, aggregate, figure build, serialize)
+# and record() keeps values such as row counts and payload bytes. When the
+# call returns, the numbers go into histograms, served in Prometheus text
+# format at /metrics, and into one log line on the "gtd.instrumentation"
+# logger.
+#
+# Under gunicorn a scrape of /metrics lands on any one of the workers, so the
+# histograms are those of all of them: within a second of each call, every
+# worker writes its own to a file in a directory private to the user running
+# the server (see private_dir) and shared by the processes of one process
+# group, i.e. gunicorn's master and its workers, and /metrics serves their sum. The files
+# of workers that exited stay in, so the counts never go backwards when the
+# workers are recycled; the directories of server runs that are over are
+# removed. Where there are no process groups (Windows), with
+# GTD_SHARED_METRICS=0, or if the directory is not private, each worker
+# serves only its own histograms, with a worker label holding its pid, and
+# the counts of a series jump between those of the workers.
+#
+# GTD_INSTRUMENTATION=0 turns it all off: @traced leaves the function as it
+# is and span() hands out a shared object whose methods do nothing.
+
+import atexit
+import bisect
+import functools
+import json
+import logging
+import os
+import secrets
+import shutil
+import threading
+import time
+
+import private_dir
+
+ENABLED = os.environ.get("GTD_INSTRUMENTATION", "1").lower() not in ("0", "false", "no")
+SHARED = os.environ.get("GTD_SHARED_METRICS", "1").lower() in ("1", "true", "yes")
+
+# Seconds at most between a call and the write of the histograms it changed
+FLUSH_SECONDS = 1.0
+
+# Level of the per-callback log line
+LOG_LEVEL = logging.getLevelName(os.environ.get("GTD_INSTRUMENTATION_LOG_LEVEL", "DEBUG").upper())
+
+logger = logging.getLogger("gtd.instrumentation")
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# Histogram per recorded value name: (metric name, help text, buckets)
+METRICS = {
+    "seconds": ("gtd_callback_stage_seconds", "Time spent in each stage of a dashboard callback", SECONDS_BUCKETS),
+    "rows": ("gtd_callback_rows", "Rows selected by a dashboard callback", SIZE_BUCKETS),
+    "bytes": ("gtd_callback_payload_bytes", "Serialized figure size returned by a dashboard callback",
+              SIZE_BUCKETS),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Directory of the histogram files of the processes of the group this one is
+# in, or None if they can't be shared
+def _group_directory():
+    if not hasattr(os, "getpgrp"):
+        return None
+    directory = private_dir.path("metrics-%d" % os.getpgrp())
+    if not private_dir.is_private(directory):
+        logger.warning("%s is not a directory of this user, /metrics only serves the worker it reaches",
+                       directory)
+        return None
+    return directory
+
+
+# Remove the histogram files of the process groups that are gone
+def _remove_finished(directory):
+    for entry in os.scandir(os.path.dirname(directory)):
+        name, _, group = entry.name.partition("-")
+        if name != "metrics" or not group.isdigit() or entry.path == directory:
+            continue
+        try:
+            os.kill(int(group), 0)
+        except ProcessLookupError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+class Registry:
+    # shared: sum the histograms of the processes of the group at /metrics
+    def __init__(self, shared=SHARED):
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._pid = None
+        self._file = None
+        self._flushed = 0.0
+        self._timer = None
+
+    # The histograms of this process; a forked one starts with none and a file of its own
+    def _own(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._histograms = {}
+            self._timer = None
+            directory = _group_directory() if self.shared else None
+            self._file = directory and os.path.join(directory, "%d-%s.json" % (self._pid, secrets.token_hex(4)))
+        return self._histograms
+
+    def observe(self, metric, labels, value):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histograms = self._own()
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = _Histogram(METRICS[metric][2])
+            histogram.observe(value)
+
+    # Write the histograms of this process to its file, for the other workers' /metrics
+    def flush(self):
+        with self._lock:
+            self._own()
+            self._timer = None
+            self._flushed = time.monotonic()
+            if self._file is None:
+                return
+            items = [[metric, labels, h.counts, h.sum, h.count]
+                     for (metric, labels), h in self._histograms.items()]
+            tmp = "%s.tmp" % self._file
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(items, f)
+                os.replace(tmp, self._file)
+            except OSError:
+                logger.warning("could not write %s", self._file, exc_info=True)
+
+    # flush() now, or by a timer if the last one is less than FLUSH_SECONDS ago
+    def flush_soon(self):
+        with self._lock:
+            self._own()
+            if self._file is None or self._timer is not None:
+                return
+            wait = self._flushed + FLUSH_SECONDS - time.monotonic()
+            if wait > 0:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+    # The histograms of all the processes of the group, or of this one with a worker label
+    def _collect(self):
+        with self._lock:
+            self._own()
+            if self._file is None:
+                worker = (("worker", str(self._pid)),)
+                return {(metric, labels + worker): h for (metric, labels), h in self._histograms.items()}
+            directory = os.path.dirname(self._file)
+        _remove_finished(directory)
+        histograms = {}
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    items = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric, labels, counts, total, count in items:
+                key = (metric, tuple(sorted(tuple(label) for label in labels)))
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = _Histogram(METRICS[metric][2])
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+        return histograms
+
+    # All histograms in Prometheus text exposition format
+    def render(self):
+        self.flush()
+        items = sorted(self._collect().items())
+        lines = []
+        for metric, (name, help_text, buckets) in METRICS.items():
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            for (item_metric, labels), histogram in items:
+                if item_metric != metric:
+                    continue
+                label_text = ",".join('%s="%s"' % (k, v) for k, v in labels)
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_text, le, cumulative))
+                lines.append("%s_sum{%s} %r" % (name, label_text, histogram.sum))
+                lines.append("%s_count{%s} %d" % (name, label_text, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+class _Span:
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.timings.append((self.stage, time.perf_counter() - self.start))
+        return False
+
+
+class Trace:
+    def __init__(self, callback):
+        self.callback = callback
+        self.timings = []
+        self.values = {}
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def record(self, name, value):
+        self.values[name] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.append(("total", time.perf_counter() - self.start))
+        for stage, seconds in self.timings:
+            registry.observe("seconds", {"callback": self.callback, "stage": stage}, seconds)
+        for name, value in self.values.items():
+            registry.observe(name, {"callback": self.callback}, value)
+        registry.flush_soon()
+        if logger.isEnabledFor(LOG_LEVEL):
+            parts = ["%s=%.1fms" % (stage, seconds * 1e3) for stage, seconds in self.timings]
+            parts += ["%s=%s" % item for item in self.values.items()]
+            logger.log(LOG_LEVEL, "%s %s", self.callback, " ".join(parts))
+        return False
+
+
+# Stand-in for a span outside of a trace, or while instrumentation is turned off
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# Trace of the call running in this thread
+_current = threading.local()
+
+
+# Decorator tracing every call of a function under the given name
+def traced(callback):
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_current, "trace", None)
+            with Trace(callback) as _current.trace:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _current.trace = previous
+        return wrapper
+    return decorate
+
+
+# Time a stage of the current trace, used as `with span("filter"):`
+def span(stage):
+    trace = getattr(_current, "trace", None) if ENABLED else None
+    return trace.span(stage) if trace is not None else _NULL_SPAN
+
+
+# Record a value for the current trace, e.g. record("rows", 1234)
+def record(name, value):
+    trace = getattr(_current, "trace", None) if ENABLED else None
+    if trace is not None:
+        trace.record(name, value)
+
+
+# Serve the histograms at /metrics on a Flask server; every collector is a
+# function returning more lines of Prometheus text to append
+def install(server, collectors=()):
+    def metrics():
+        text = registry.render() + "".join(collector() for collector in collectors)
+        return text, 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    server.add_url_rule("/metrics", "metrics", metrics)
+
+
+# Prometheus lines for the figure cache counters
+def figure_cache_collector(figure_cache):
+    def collect():
+        stats = figure_cache.stats()
+        lines = []
+        for name in ("hits", "misses", "evictions"):
+            lines.append("# TYPE gtd_figure_cache_%s_total counter" % name)
+            lines.append("gtd_figure_cache_%s_total %d" % (name, stats[name]))
+        for name in ("entries", "bytes"):
+            lines.append("# TYPE gtd_figure_cache_%s gauge" % name)
+            lines.append("gtd_figure_cache_%s %d" % (name, stats[name]))
+        return "\n".join(lines) + "\n"
+    return collect
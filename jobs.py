@@ -0,0 +1,232 @@
+# Background execution of the figure callbacks, without Redis or diskcache
+#
+# JobManager is a Dash background callback manager (the interface of
+# dash.DiskcacheManager) that runs the jobs on a small thread pool inside the
+# worker process that received them. Job state and results are files in a
+# directory shared by all gunicorn workers, so the browser's polls for a
+# result can be answered by any worker, and a long figure no longer holds a
+# sync worker for its whole duration.
+#
+# The directory is private to the user running the server (see private_dir):
+# the results it holds are sent to the browsers as they are, so the manager
+# refuses to start with one that exists but belongs to someone else.
+#
+# Every job is tagged with a generation per output: starting a job claims
+# the client's slot for each of its outputs in a memory-mapped table shared by
+# the workers (see debounce.Debouncer). A job whose claim was taken over by a
+# newer job writing to the same output is superseded, just like a job that
+# Dash cancels (a newer request of the same callback, or a cancel input). A
+# superseded job is skipped if it has not started yet, stops at its next
+# checkpoint() if it is running, and its result is never returned.
+#
+# GTD_BACKGROUND_CALLBACKS=1 turns it on; otherwise the callbacks run in the
+# request as before and checkpoint() does nothing.
+
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+from dash.exceptions import PreventUpdate
+from dash.long_callback.managers import BaseLongCallbackManager
+from plotly.io.json import to_json_plotly
+
+import private_dir
+from debounce import Debouncer
+
+ENABLED = os.environ.get("GTD_BACKGROUND_CALLBACKS", "0").lower() in ("1", "true", "yes")
+
+# Jobs running at once in each worker process
+THREADS = int(os.environ.get("GTD_JOB_THREADS", "2"))
+
+# Milliseconds between the browser's polls for a job result
+POLL_INTERVAL = int(os.environ.get("GTD_JOB_POLL_MS", "100"))
+
+# Job files older than this belong to pages closed before fetching their result
+STALE_SECONDS = 3600
+
+_NO_UPDATE = {"_dash_no_update": "_dash_no_update"}
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Job running in this thread
+_current = threading.local()
+
+
+# Stop the current job here if it has been superseded or cancelled
+def checkpoint():
+    job = getattr(_current, "job", None)
+    if job is not None and not job.live():
+        raise Cancelled()
+
+
+class _Job:
+    def __init__(self, manager, job_id, claims):
+        self.manager = manager
+        self.job_id = job_id
+        self.claims = claims
+
+    def live(self):
+        if os.path.exists(self.manager._path(self.job_id, ".cancel")):
+            return False
+        return all(self.manager.generations.is_current(claim) for claim in self.claims)
+
+
+# Outputs of a callback as "id.property" names, without the allow_duplicate suffix
+def _output_names(outputs_list):
+    outputs = outputs_list if isinstance(outputs_list, list) else [outputs_list]
+    names = []
+    for output in outputs:
+        for item in output if isinstance(output, list) else [output]:
+            names.append("%s.%s" % (item["id"], item["property"].split("@")[0]))
+    return names
+
+
+class JobManager(BaseLongCallbackManager):
+    # client_prop: the "id.property" of the State holding the browser tab's id,
+    # callbacks without it are only cancelled by Dash itself
+    def __init__(self, directory=None, threads=THREADS, client_prop="session-id.data", cache_by=None):
+        self.directory = directory or private_dir.path("jobs")
+        if not private_dir.is_private(self.directory):
+            raise RuntimeError("%s is not a directory of this user alone, set GTD_RUN_DIR to one"
+                               % self.directory)
+        self.threads = threads
+        self.client_prop = client_prop
+        self.generations = Debouncer(path=os.path.join(self.directory, "generations.bin"))
+        self._pid = None
+        self._pool = None
+        self._last_cleanup = 0.0
+        super().__init__(cache_by)
+
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    # The thread pool of this process, (re)created after a fork
+    def pool(self):
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="gtd-job")
+            self._pid = os.getpid()
+        return self._pool
+
+    def _write(self, path, text):
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _remove_stale(self):
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name != "generations.bin" and now - os.path.getmtime(path) > STALE_SECONDS:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def terminate_job(self, job):
+        if job and os.path.exists(self._path(job, ".running")):
+            self._write(self._path(job, ".cancel"), "")
+
+    def terminate_unhealthy_job(self, job):
+        if job and os.path.exists(self._path(job, ".running")) and not self.job_running(job):
+            self._remove(self._path(job, ".running"))
+            return True
+        return False
+
+    # Whether the job is queued or running in a live worker process
+    def job_running(self, job):
+        try:
+            with open(self._path(job, ".running")) as f:
+                pid = int(f.read())
+        except (TypeError, OSError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def make_job_fn(self, fn, progress, key=None):
+        def job_fn(result_key, job, user_callback_args, context):
+            def run():
+                c = AttributeDict(**context)
+                c.ignore_register_page = False
+                context_value.set(c)
+                _current.job = job
+                try:
+                    if not job.live():
+                        return
+                    if isinstance(user_callback_args, dict):
+                        output = fn(**user_callback_args)
+                    elif isinstance(user_callback_args, (list, tuple)):
+                        output = fn(*user_callback_args)
+                    else:
+                        output = fn(user_callback_args)
+                    result = to_json_plotly(output)
+                except PreventUpdate:
+                    result = json.dumps(_NO_UPDATE)
+                except Cancelled:
+                    return
+                except Exception as err:
+                    result = json.dumps({"long_callback_error": {"msg": str(err), "tb": traceback.format_exc()}})
+                finally:
+                    _current.job = None
+                if job.live():
+                    self._write(self._path(result_key, ".result"), result)
+
+            try:
+                copy_context().run(run)
+            finally:
+                self._remove(self._path(job.job_id, ".running"))
+                self._remove(self._path(job.job_id, ".cancel"))
+
+        return job_fn
+
+    def call_job_fn(self, key, job_fn, args, context):
+        self._remove_stale()
+        job_id = uuid.uuid4().hex
+        claims = []
+        client = (context.state_values or {}).get(self.client_prop)
+        if client:
+            claims = [self.generations.claim(client, name) for name in _output_names(context.outputs_list)]
+        self._write(self._path(job_id, ".running"), str(os.getpid()))
+        self.pool().submit(job_fn, key, _Job(self, job_id, claims), args, context)
+        return job_id
+
+    def get_progress(self, key):
+        return None
+
+    def result_ready(self, key):
+        return os.path.exists(self._path(key, ".result"))
+
+    def get_result(self, key, job):
+        path = self._path(key, ".result")
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            return self.UNDEFINED
+        if self.cache_by is None:
+            self._remove(path)
+        return result
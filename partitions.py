@@ -0,0 +1,52 @@
+# Per-country partitions of the dataset, for the views showing one country
+#
+# app.py's dashboard shows one country at a time, and filtering the global
+# frame for it costs a pass over every row however small the country is. The
+# column cache therefore stores the columns these views read a second time
+# in country order (datastore.COUNTRY_COLUMNS), a stable sort on the country
+# code making every country a contiguous range of them, its rows still in
+# date order. Each country is a range of rows of them, so that one of its
+# years is a slice found by binary search, and its attacks per year are
+# counted once. A request for a country then only touches that country's
+# rows.
+#
+# Nothing is copied at load time, and the countries hold no frames of their
+# own: with GTD_MMAP the slices are views of the cache files, shared by every
+# worker process like the columns themselves.
+
+import numpy as np
+
+
+class CountryPartition:
+    # The rows first..last of frame, its years column years
+    def __init__(self, frame, years, first, last):
+        self.frame = frame
+        self.first = first
+        self.years = years[first:last]
+        self.trend_years, self.trend_counts = np.unique(self.years, return_counts=True)
+
+    # Rows of the years start..end inclusive (just start when no end is given)
+    def rows(self, start, end=None):
+        lo, hi = np.searchsorted(self.years, [start, (start if end is None else end) + 1])
+        return self.frame.iloc[self.first + lo:self.first + hi]
+
+    # Attacks per year, as columns iyear and attacks
+    def year_totals(self):
+        import pandas as pd
+
+        return pd.DataFrame({"iyear": self.trend_years, "attacks": self.trend_counts})
+
+
+class CountryPartitions:
+    # The partitions of an opened version of the column cache (datastore.Cache)
+    def __init__(self, cache, mmap=None):
+        frame, offsets = cache.country_frame(mmap)
+        years = np.asarray(frame["iyear"])
+        names = cache.categories()["country_txt"]
+        self.partitions = {name: CountryPartition(frame, years, int(offsets[code + 1]), int(offsets[code + 2]))
+                           for code, name in enumerate(names) if offsets[code + 2] > offsets[code + 1]}
+        self.empty = CountryPartition(frame, years, 0, 0)
+
+    # Partition of a country, an empty one for a country without attacks
+    def get(self, country):
+        return self.partitions.get(country, self.empty)
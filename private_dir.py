@@ -0,0 +1,48 @@
+# Directories private to the user running the server
+#
+# The workers share state through files in the temporary directory: figure
+# results (coalesce), background job results (jobs), the numbers of the
+# newest search requests (debounce) and the callback histograms
+# (instrumentation). What is read from there ends up in the
+# browsers or decides which requests are answered, and the temporary
+# directory is writable by every local user, who could create those files
+# first. They are therefore kept in GTD_RUN_DIR (default: gtd-<uid> in the
+# temporary directory), created mode 0700, and a directory is only used if
+# it is a real directory owned by this user. Without owners (Windows) any
+# directory is used.
+
+import os
+import stat
+import tempfile
+
+# Owner the directories must have, None where the platform has no owners
+_UID = os.getuid() if hasattr(os, "getuid") else None
+
+BASE = os.environ.get("GTD_RUN_DIR") or os.path.join(
+    tempfile.gettempdir(), "gtd-%s" % ("user" if _UID is None else _UID))
+
+
+# Path of name in the base directory
+def path(name):
+    return os.path.join(BASE, name)
+
+
+# Whether the directory is this user's alone, creating it (and the base
+# directory it is in) if needed
+def is_private(directory):
+    directory = os.path.abspath(directory)
+    if os.path.dirname(directory) == os.path.abspath(BASE) and not is_private(BASE):
+        return False
+    try:
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(directory)
+        private = stat.S_ISDIR(info.st_mode) and (_UID is None or info.st_uid == _UID)
+        if private and _UID is not None and info.st_mode & 0o077:
+            # Ours, made by an older version: no one else could write to it
+            os.chmod(directory, 0o700)
+    except OSError:
+        private = False
+    return private
@@ -0,0 +1,151 @@
+# Hot reload of the dataset while the server keeps running
+#
+# Everything a dashboard derives from the dataset (the frame, its indexes,
+# aggregates and dropdown vocabularies) is built into one snapshot object by
+# the build function it is given, all of it read from one opened version of
+# the column cache, and never changed afterwards. A callback
+# takes the current snapshot once with snapshot() and uses only that, so a
+# reload happening meanwhile cannot mix two versions of the data.
+#
+# With GTD_RELOAD_SECONDS set, a thread in every process checks the dataset
+# that often: the source file or the delta files next to it (see datastore).
+# When they changed, the column cache is brought up to date (by whichever
+# process gets its lock first), a new snapshot is built in the thread and then
+# swapped in with a single assignment, while the callbacks carry on with the
+# old one. The snapshot's version is the dataset's cache version, which the
+# caches depending on the data key on.
+#
+# start() builds the first snapshot in that thread too, so that a server can
+# answer (the page layout, /health) before the data has loaded: callbacks
+# asking for the snapshot wait for it, and /ready answers 503 until it is in.
+
+import logging
+import os
+import threading
+import time
+
+import datastore
+
+# Seconds between checks of the dataset for changes, 0 for no reloading
+RELOAD_SECONDS = float(os.environ.get("GTD_RELOAD_SECONDS", "0"))
+
+# Whether the first snapshot is built in the background (GTD_LAZY_STARTUP=0 builds it before serving)
+LAZY_STARTUP = os.environ.get("GTD_LAZY_STARTUP", "1").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger("gtd.reloader")
+
+
+class Reloader:
+    # build(cache) returns a snapshot of an opened version of the column cache
+    # (datastore.Cache) with its version attribute; on_swap(snapshot) runs
+    # whenever a new snapshot has been swapped in
+    def __init__(self, source, build, on_swap=None, interval=RELOAD_SECONDS):
+        self.source = source
+        self.build = build
+        self.on_swap = on_swap
+        self.interval = interval
+        self.error = None
+        self._snapshot = None
+        self._background = False
+        self._started = time.time()
+        self._pid = None
+        self._reset_locks()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_locks)
+
+    # Fresh locks in a forked child, where a thread of the parent may have held them
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+        self._watch_lock = threading.Lock()
+        self._ready = threading.Event()
+        if self._snapshot is not None:
+            self._ready.set()
+
+    # Build a snapshot of the current dataset and swap it in
+    def load(self):
+        with self._lock:
+            cache = datastore.open_cache(self.source)
+            if self._snapshot is not None and self._snapshot.version == cache.version:
+                cache.close()
+                return self._snapshot
+            snapshot = self.build(cache)
+            self._snapshot = snapshot
+            self.error = None
+        self._ready.set()
+        if self.on_swap is not None:
+            self.on_swap(snapshot)
+        return snapshot
+
+    # Build the first snapshot in the background and return at once
+    def start(self):
+        self._background = True
+        self._watch()
+
+    # The current snapshot, or None while the first one is loading
+    def current(self):
+        self._watch()
+        return self._snapshot
+
+    # The current snapshot, waiting for the first one if needed
+    def snapshot(self):
+        snapshot = self.current()
+        if snapshot is not None:
+            return snapshot
+        if self._background:
+            self._ready.wait()
+        # Not started in the background, or the first load failed there: load here
+        return self._snapshot if self._snapshot is not None else self.load()
+
+    # Start the thread of this process, (re)started after a fork
+    def _watch(self):
+        if (self.interval <= 0 and not self._background) or self._pid == os.getpid():
+            return
+        with self._watch_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="gtd-reloader", daemon=True).start()
+
+    def _run(self):
+        if self._snapshot is None:
+            self._reload()
+            self._ready.set()
+        while self.interval > 0:
+            time.sleep(self.interval)
+            self._reload()
+
+    def _reload(self):
+        try:
+            start = time.perf_counter()
+            previous = self._snapshot
+            snapshot = self.load()
+            if snapshot is not previous:
+                logger.info("loaded %s as version %s in %.1f s", self.source, snapshot.version,
+                            time.perf_counter() - start)
+            # Versions of the cache no snapshot holds any more, in any process
+            del previous, snapshot
+            datastore.prune_caches(self.source)
+        except Exception as err:
+            self.error = repr(err)
+            logger.exception("loading %s failed, keeping version %s", self.source,
+                             getattr(self._snapshot, "version", None))
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            "ready": snapshot is not None,
+            "version": getattr(snapshot, "version", None),
+            "error": self.error,
+            "uptime_seconds": round(time.time() - self._started, 3),
+        }
+
+    # /health answers as long as the process serves requests, /ready once the data has loaded
+    def install(self, server):
+        @server.route("/health")
+        def health():
+            return dict(self.status(), status="ok")
+
+        @server.route("/ready")
+        def ready():
+            status = self.status()
+            return status, 200 if status["ready"] else 503
@@ -0,0 +1,49 @@
+# Substring search over the distinct values of a Chart tool dimension
+#
+# The Chart tool's search box used to run a case-insensitive regex over every
+# grouped row on each keystroke. The values are instead searched once per
+# dimension vocabulary (thousands of names at most, rather than the rows), and
+# the search text is taken literally. A trigram index narrows the candidates
+# down before the plain substring check, and the result is the matching value
+# codes, which the cube turns into counts directly.
+
+import numpy as np
+
+GRAM = 3
+
+
+def _grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class VocabularySearch:
+    def __init__(self, values):
+        self.lower = [str(v).lower() for v in values]
+        postings = {}
+        for code, value in enumerate(self.lower):
+            for gram in _grams(value):
+                postings.setdefault(gram, []).append(code)
+        self.postings = {gram: np.asarray(codes, dtype=np.int32) for gram, codes in postings.items()}
+        self.all_codes = np.arange(len(self.lower), dtype=np.int32)
+
+    # Sorted codes of the values containing text, ignoring case
+    def matching_codes(self, text):
+        text = text.lower()
+        if not text:
+            return self.all_codes
+        if len(text) < GRAM:
+            candidates = self.all_codes
+        else:
+            lists = [self.postings.get(gram) for gram in _grams(text)]
+            if any(codes is None for codes in lists):
+                return self.all_codes[:0]
+            lists.sort(key=len)
+            candidates = lists[0]
+            for codes in lists[1:]:
+                candidates = np.intersect1d(candidates, codes, assume_unique=True)
+        return np.asarray([c for c in candidates if text in self.lower[c]], dtype=np.int32)
+
+
+# One search index per column of the cube
+def build_search_indexes(cube):
+    return {column: VocabularySearch(values) for column, values in cube.values.items()}
@@ -0,0 +1,161 @@
+# Tile index over the map points, for loading only the part of the map in view
+#
+# Every point gets the key of the web mercator tile holding it at MAX_ZOOM,
+# with the bits of the tile's x and y interleaved (Morton / quadkey order). In
+# that order any tile of a lower zoom covers one contiguous key range, so the
+# points of a set of tiles are a few slices of the rows sorted by key.
+#
+# TileIndex has the interface of the filter index posting lists (lookup_codes,
+# count, rows_for, mask_for), with (zoom, x, y) tiles as the values, so that
+# FilterIndex can combine the visible tiles with the other Map tool filters and
+# start from whichever of them is the most selective.
+
+import bisect
+import math
+
+import numpy as np
+
+# Zoom of the finest tiles the keys tell apart (about 600 m across)
+MAX_ZOOM = 16
+
+# Web mercator stops at this latitude
+MAX_LAT = 85.05112878
+
+# Key given to points without coordinates, beyond every tile's range
+NO_TILE = 1 << (2 * MAX_ZOOM)
+
+# Map size in pixels assumed when a viewport only comes as center and zoom
+VIEW_SIZE = (1200, 600)
+
+# Pixels across a tile of the map at its own zoom level (mapbox-gl tiles are 512)
+TILE_PIXELS = 512
+
+
+# Spread the bits of v apart, bit i going to bit 2i
+def _spread(v):
+    v = np.asarray(v, dtype=np.int64) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+
+# Web mercator tile x and y of points at a zoom level
+def tile_xy(lat, lon, zoom):
+    n = 1 << zoom
+    lat = np.radians(np.clip(lat, -MAX_LAT, MAX_LAT))
+    x = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+# Key of the MAX_ZOOM tile of every point, NO_TILE for points without coordinates
+def tile_keys(lat, lon):
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    x, y = tile_xy(lat[valid], lon[valid], MAX_ZOOM)
+    keys = np.full(len(lat), NO_TILE, dtype=np.int64)
+    keys[valid] = _spread(x) | (_spread(y) << 1)
+    return keys
+
+
+# Key range [start, stop) of a tile
+def tile_range(zoom, x, y):
+    shift = 2 * (MAX_ZOOM - zoom)
+    start = int(_spread(x) | (_spread(y) << 1)) << shift
+    return start, start + (1 << shift)
+
+
+class TileIndex:
+    # The index of the points of df, or the one stored with it in an opened
+    # version of the column cache (datastore.Cache), mapped like its columns
+    def __init__(self, df, cache=None):
+        if cache is not None:
+            self.keys, self.rows, self.sorted_keys = cache.tiles()
+            return
+        self.keys = tile_keys(df["latitude"].to_numpy(), df["longitude"].to_numpy())
+        # Row ids ordered by key; the stable sort keeps each tile in row order
+        self.rows = np.argsort(self.keys, kind="stable").astype(np.int32)
+        self.sorted_keys = self.keys[self.rows]
+
+    # Merged, sorted key ranges of a list of (zoom, x, y) tiles
+    def lookup_codes(self, tiles):
+        ranges = []
+        for start, stop in sorted(tile_range(*tile) for tile in tiles):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        return ranges
+
+    def _slices(self, ranges):
+        bounds = np.searchsorted(self.sorted_keys, np.asarray(ranges, dtype=np.int64).ravel())
+        return bounds.reshape(-1, 2)
+
+    def count(self, ranges):
+        return int(sum(stop - start for start, stop in self._slices(ranges)))
+
+    # Sorted row ids in [lo, hi) inside any of the key ranges
+    def rows_for(self, ranges, lo, hi):
+        rows = np.sort(np.concatenate([self.rows[start:stop] for start, stop in self._slices(ranges)]))
+        start, stop = np.searchsorted(rows, [lo, hi])
+        return rows[start:stop]
+
+    # Which of the given rows lie inside any of the key ranges
+    def mask_for(self, ranges, rows):
+        bounds = np.asarray(ranges, dtype=np.int64).ravel()
+        return np.searchsorted(bounds, self.keys[rows], side="right") % 2 == 1
+
+
+# The tiles not wholly inside the merged key ranges of lookup_codes()
+def uncovered_tiles(tiles, ranges):
+    starts = [start for start, stop in ranges]
+    uncovered = []
+    for tile in tiles:
+        start, stop = tile_range(*tile)
+        i = bisect.bisect_right(starts, start) - 1
+        if i < 0 or ranges[i][1] < stop:
+            uncovered.append(tile)
+    return uncovered
+
+
+# Visible part of the map from a dcc.Graph relayoutData event, as
+# {"west", "east", "south", "north", "zoom"}; None when the event is not a
+# mapbox pan or zoom
+def viewport(relayout):
+    if not relayout or "mapbox.zoom" not in relayout:
+        return None
+    zoom = float(relayout["mapbox.zoom"])
+    corners = (relayout.get("mapbox._derived") or {}).get("coordinates")
+    if corners:
+        lons = [point[0] for point in corners]
+        lats = [point[1] for point in corners]
+        return {"west": min(lons), "east": max(lons), "south": min(lats), "north": max(lats), "zoom": zoom}
+
+    # No corners in the event, assume a map of VIEW_SIZE pixels around the center
+    center = relayout["mapbox.center"]
+    half_width = VIEW_SIZE[0] / 2.0 * 360.0 / (TILE_PIXELS * 2 ** zoom)
+    half_height = VIEW_SIZE[1] / 2.0 * 360.0 / (TILE_PIXELS * 2 ** zoom)
+    return {"west": center["lon"] - half_width, "east": center["lon"] + half_width,
+            "south": max(center["lat"] - half_height, -90.0), "north": min(center["lat"] + half_height, 90.0),
+            "zoom": zoom}
+
+
+# Tiles covering a viewport, at the zoom whose tiles are about 256 pixels on screen
+def view_tiles(view):
+    zoom = min(max(int(math.floor(view["zoom"])) + 1, 0), MAX_ZOOM)
+    n = 1 << zoom
+    span = view["east"] - view["west"]
+    if span >= 360.0:
+        xs = range(n)
+    else:
+        # Count tiles eastwards from the west edge, wrapping past the antimeridian
+        west = (view["west"] + 180.0) % 360.0 - 180.0
+        x0 = int(math.floor((west + 180.0) / 360.0 * n))
+        x1 = int(math.floor((west + span + 180.0) / 360.0 * n))
+        xs = sorted({x % n for x in range(x0, min(x1, x0 + n - 1) + 1)})
+    y0 = int(tile_xy(view["north"], 0.0, zoom)[1])
+    y1 = int(tile_xy(view["south"], 0.0, zoom)[1])
+    return [(zoom, x, y) for x in xs for y in range(y0, y1 + 1)]